@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+DownloaderCoordinator矩阵基准
+按 文件大小 x 线程数 x 段大小 组合下载 每个组合在独立子进程中运行 分别统计
+吞吐 CPU时间 峰值RSS 并校验下载结果 服务端在另一个子进程中运行 可以注入网络条件和故障
+结果输出为JSON 可以用--baseline与之前版本的结果对比
+
+python -m benchmark.matrix_benchmark --file_sizes 16,64 --threads 1,4,8 --segment_sizes 1,4 \\
+    --bandwidth 10485760 --rtt 0.02 --reset_rate 0.01 --output result.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from benchmark.receive_benchmark import find_free_port, wait_for_server
+from src import file_downloader, integrity
+from test.range_http_server import make_payload
+
+MB = 1024 * 1024
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def run_case(case):
+    """
+    在当前进程中下载一次 由子进程调用
+    :param case: dict url target file_size threads segment_size seed
+    :return: result dict
+    """
+    file_downloader.be_quiet()
+    request = requests.Request(method='GET', url=case['url'])
+    coordinator = file_downloader.DownloaderCoordinator(case['target'], request, {'timeout': 30},
+                                                        max_thread=case['threads'],
+                                                        segment_size=case['segment_size'],
+                                                        max_error_retry=100,
+                                                        fsync_policy=file_downloader.FileStorage.FSYNC_NONE,
+                                                        progress_interval=0)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    coordinator.start().result()
+    wall_cost = time.perf_counter() - wall_start
+    cpu_cost = time.process_time() - cpu_start
+    # 在校验之前取峰值RSS 只统计下载本身
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    digest = integrity.file_digest(case['target'])
+    os.remove(case['target'])
+    stats = coordinator.get_connection_stats()
+    return {
+        'wall_seconds': round(wall_cost, 4),
+        'cpu_seconds': round(cpu_cost, 4),
+        'throughput_bytes_per_second': int(case['file_size'] / wall_cost) if wall_cost > 0 else None,
+        # Linux为KB macOS为字节
+        'peak_rss_kb': max_rss // 1024 if sys.platform == 'darwin' else max_rss,
+        'failed_segments': len(coordinator.get_all_failed_segment()),
+        'requests': stats['requests'],
+        'connections': stats['connections'],
+        'sha256': digest,
+    }
+
+
+def run_case_in_subprocess(case):
+    output = subprocess.run([sys.executable, '-m', 'benchmark.matrix_benchmark', '--case', json.dumps(case)],
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def start_server(port, args, file_size_mb):
+    command = [sys.executable, '-m', 'test.range_http_server', '--port', str(port), '--size', str(file_size_mb),
+               '--seed', str(args.seed), '--bandwidth', str(args.bandwidth), '--rtt', str(args.rtt),
+               '--reset_rate', str(args.reset_rate), '--short_rate', str(args.short_rate)]
+    if args.no_accept_ranges:
+        command.append('--no_accept_ranges')
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port, timeout=60)
+    except Exception:
+        server.terminate()
+        raise
+    return server
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return result['file_size'], result['threads'], result['segment_size']
+
+
+def compare_with_baseline(results, baseline_file):
+    """
+    :return: 每个组合的吞吐比值 当前/基线
+    """
+    with open(baseline_file) as fd:
+        baseline = {case_key(result): result for result in json.load(fd)['results']}
+    comparison = []
+    for result in results:
+        old = baseline.get(case_key(result))
+        if not old or not old['throughput_bytes_per_second'] or not result['throughput_bytes_per_second']:
+            continue
+        comparison.append({
+            'file_size': result['file_size'],
+            'threads': result['threads'],
+            'segment_size': result['segment_size'],
+            'throughput_ratio': round(result['throughput_bytes_per_second'] / old['throughput_bytes_per_second'], 4),
+            'cpu_ratio': round(result['cpu_seconds'] / old['cpu_seconds'], 4) if old['cpu_seconds'] else None,
+        })
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--file_sizes', type=parse_int_list, default=[16, 64], help='file sizes in MB')
+    parser.add_argument('--threads', type=parse_int_list, default=[1, 4, 8], help='thread numbers')
+    parser.add_argument('--segment_sizes', type=parse_int_list, default=[1, 4], help='segment sizes in MB')
+    parser.add_argument('--rounds', type=int, default=1, help='rounds per case')
+    parser.add_argument('--seed', type=int, default=0, help='payload and fault seed')
+    parser.add_argument('--bandwidth', type=int, default=0, help='server bytes per second per connection')
+    parser.add_argument('--rtt', type=float, default=0.0, help='server delay in seconds per connection and request')
+    parser.add_argument('--reset_rate', type=float, default=0.0, help='probability to reset a response')
+    parser.add_argument('--short_rate', type=float, default=0.0, help='probability to send half of the range')
+    parser.add_argument('--no_accept_ranges', default=False, action='store_true',
+                        help='server does not send Accept-Ranges header')
+    parser.add_argument('--output', type=str, help='write json result to this file, default stdout')
+    parser.add_argument('--baseline', type=str, help='json result of another version to compare with')
+    args = parser.parse_args()
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for file_size_mb in args.file_sizes:
+            file_size = file_size_mb * MB
+            expected_digest = hashlib.sha256(make_payload(file_size, args.seed)).hexdigest()
+            port = find_free_port()
+            server = start_server(port, args, file_size_mb)
+            try:
+                for threads in args.threads:
+                    for segment_size_mb in args.segment_sizes:
+                        for round_index in range(args.rounds):
+                            case = {
+                                'url': 'http://127.0.0.1:%s/file' % port,
+                                'target': os.path.join(work_dir, 'target.bin'),
+                                'file_size': file_size,
+                                'threads': threads,
+                                'segment_size': segment_size_mb * MB,
+                            }
+                            result = run_case_in_subprocess(case)
+                            result.update(file_size=file_size, threads=threads, segment_size=segment_size_mb * MB,
+                                          round=round_index, verified=result.pop('sha256') == expected_digest)
+                            results.append(result)
+                            sys.stderr.write('%s\n' % json.dumps(result))
+            finally:
+                server.terminate()
+                server.wait()
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'server': {
+            'bandwidth': args.bandwidth,
+            'rtt': args.rtt,
+            'reset_rate': args.reset_rate,
+            'short_rate': args.short_rate,
+            'accept_ranges': not args.no_accept_ranges,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.baseline:
+        report['comparison'] = compare_with_baseline(results, args.baseline)
+    content = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(content)
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()
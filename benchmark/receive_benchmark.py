@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+接收路径微基准
+对比 iter_content 与 readinto(复用缓冲区) 两种接收模式 每CPU秒处理的字节数
+服务端在子进程中运行 CPU时间只统计下载进程
+
+python -m benchmark.receive_benchmark --size 256 --rounds 3
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from src import file_downloader
+
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server not ready on port %s' % port)
+
+
+def run_once(url, target, data_length, buffer_pool, write_buffer_size):
+    file_downloader.create_empty_fix_size_binary_file(target, data_length, overwrite_if_already_exists=True)
+    storage = file_downloader.FileStorage(target, fsync_policy=file_downloader.FileStorage.FSYNC_NONE)
+    try:
+        downloader = file_downloader.SegmentDownloader(target, requests.Request(method='GET', url=url), 0, 0,
+                                                       storage=storage,
+                                                       write_buffer_size=write_buffer_size,
+                                                       buffer_pool=buffer_pool,
+                                                       timeout=60)
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        downloader.download()
+        cpu_cost = time.process_time() - cpu_start
+        wall_cost = time.perf_counter() - wall_start
+    finally:
+        storage.close()
+    if downloader.total_downloaded_data_length() != data_length:
+        raise RuntimeError('downloaded %s bytes, expect %s' % (downloader.total_downloaded_data_length(), data_length))
+    return cpu_cost, wall_cost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='file size in MB')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds per mode')
+    parser.add_argument('--receive_buffer', type=int, default=256 * 1024, help='readinto buffer size')
+    parser.add_argument('--write_buffer', type=int, default=256 * 1024, help='write buffer size')
+    args = parser.parse_args()
+    file_downloader.be_quiet()
+    data_length = args.size * 1024 * 1024
+    with tempfile.TemporaryDirectory() as work_dir:
+        source = os.path.join(work_dir, 'source.bin')
+        with open(source, 'wb') as fd:
+            for _ in range(args.size):
+                fd.write(os.urandom(1024 * 1024))
+        port = find_free_port()
+        server = subprocess.Popen([sys.executable, '-m', 'http.server', str(port), '--bind', '127.0.0.1',
+                                   '--directory', work_dir],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(port)
+            url = 'http://127.0.0.1:%s/source.bin' % port
+            target = os.path.join(work_dir, 'target.bin')
+            modes = [
+                ('iter_content', None),
+                ('readinto', file_downloader.BufferPool(args.receive_buffer)),
+            ]
+            for mode, buffer_pool in modes:
+                for round_index in range(args.rounds):
+                    cpu_cost, wall_cost = run_once(url, target, data_length, buffer_pool, args.write_buffer)
+                    print(json.dumps({
+                        'mode': mode,
+                        'round': round_index,
+                        'bytes': data_length,
+                        'cpu_seconds': round(cpu_cost, 4),
+                        'wall_seconds': round(wall_cost, 4),
+                        'bytes_per_cpu_second': int(data_length / cpu_cost) if cpu_cost > 0 else None,
+                    }))
+                    sys.stdout.flush()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,9 @@ setup(name=name,
       install_requires=[
         'requests'
       ],
+      extras_require={
+        'async': ['aiohttp']
+      },
       python_requires='>=3.0, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*',
       classifiers=[
           'Programming Language :: Python :: 3',
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio下载引擎
+与DownloaderCoordinator相同的下载计划、断点续传和失败重试语义 适合大量并发段或者同一进程同时下载多个文件
+依赖aiohttp: pip install file_mt_downloader[async]
+"""
+import asyncio
+import concurrent.futures
+import traceback
+import urllib.parse
+import zlib
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import requests
+
+from .file_downloader import (BreakpointFile, EmptyResponseException, FetchHeaderException, FileStorage, OverWriteException,
+                              PROBE_DRAIN_LIMIT, RetryPolicy, check_range_status, create_empty_fix_size_binary_file,
+                              debug_log, get_content_length, is_support_multi_range, plan_segments, split_segments,
+                              std_log)
+from .metrics import ProgressReporter
+from .rate_limiter import RateLimiter
+
+
+def to_aiohttp_request_args(url, request_ctl_args):
+    """
+    将requests风格的控制参数转换为aiohttp参数
+    :param url: 请求地址
+    :param request_ctl_args: timeout proxies verify allow_redirects
+    :return: aiohttp request kwargs
+    """
+    args = {}
+    timeout = request_ctl_args.get('timeout')
+    connect_timeout, read_timeout = timeout if isinstance(timeout, (tuple, list)) else (timeout, timeout)
+    # 与requests一致 不限制整个请求的总时长
+    args['timeout'] = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+    proxies = request_ctl_args.get('proxies') or {}
+    proxy = proxies.get(url.split(':', 1)[0].lower())
+    if proxy:
+        args['proxy'] = proxy if '://' in proxy else 'http://%s' % proxy
+    if request_ctl_args.get('verify') is False:
+        args['ssl'] = False
+    if 'allow_redirects' in request_ctl_args:
+        args['allow_redirects'] = request_ctl_args['allow_redirects']
+    return args
+
+
+def raise_for_status(response):
+    """
+    aiohttp响应为错误状态(4xx 5xx)时抛出requests.HTTPError 与线程引擎一致 RetryPolicy据此判断致命错误和Retry-After
+    :param response: aiohttp.ClientResponse
+    """
+    if response.status < 400:
+        return
+    error_response = requests.Response()
+    error_response.status_code = response.status
+    error_response.reason = response.reason
+    error_response.url = str(response.url)
+    error_response.headers.update(response.headers)
+    raise requests.HTTPError('%s %s for url: %s' % (response.status, response.reason, response.url),
+                             response=error_response)
+
+
+class AsyncSegmentWriter(object):
+    """
+    异步段写入器 数据先合并到缓冲区 缓冲区满时在线程池中pwrite 不阻塞事件循环
+    storage: 共享的FileStorage
+    seek_offset: 文件写入的初始offset
+    length: 需要写入的数据长度 如果小于等于0 则不控制大小
+    buffer_size: 合并缓冲区大小
+    executor: 执行磁盘写入的线程池
+    crc32: 已写入数据的CRC32
+    """
+    def __init__(self, storage, seek_offset, length, buffer_size, executor):
+        self.storage = storage
+        self.seek_offset = seek_offset
+        self.offset = seek_offset
+        self.length = length
+        self.limit = 0 if self.length <= 0 else (self.offset + length - 1)
+        self.buffer_size = buffer_size
+        self.executor = executor
+        self.crc32 = 0
+        self._buffer = bytearray()
+
+    async def write(self, data):
+        if data is None:
+            return
+        if self.length > 0 and self.offset + len(data) - 1 > self.limit:
+            raise OverWriteException('write to much data, cur offset %s, limit %s, prepare to write data length %s' %
+                                     (self.offset, self.limit, len(data)))
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self._buffer += data
+        self.offset += len(data)
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        data, self._buffer = self._buffer, bytearray()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.storage.pwrite,
+                                                         data, self.offset - len(data))
+
+    def total_write_data_length(self):
+        """已经写入的总数据长度"""
+        return self.offset - self.seek_offset
+
+    def left_capacity(self):
+        """剩余可写空间 如果0表示不限制"""
+        return 0 if self.limit == 0 else (self.limit - self.offset + 1)
+
+    async def close(self):
+        await self.flush()
+
+
+class AsyncSegmentDownloader(object):
+    """
+    异步段下载器 语义同SegmentDownloader
+    session: aiohttp.ClientSession
+    request: requests.Request
+    range_start: Range 开始字节
+    range_end: Range 结束字节 如果range_end <= 0表示全文件下载不分段
+    storage: 共享的FileStorage
+    executor: 执行磁盘写入的线程池
+    write_buffer_size: 写入合并缓冲区大小
+    rate_limiter: 共享的RateLimiter 令牌不足时在事件循环中等待 不阻塞其它段
+    request_args: aiohttp请求参数
+    """
+    def __init__(self, session, request: requests.Request, range_start: int, range_end: int, storage: FileStorage,
+                 executor, write_buffer_size: int = 256 * 1024, rate_limiter: RateLimiter = None, **request_args):
+        self.session = session
+        self.raw_request = request
+        self.range_start = range_start
+        self.range_end = range_end
+        self.range_real_end = -1
+        self.storage = storage
+        self.executor = executor
+        self.write_buffer_size = write_buffer_size
+        self.rate_limiter = rate_limiter
+        self.host = urllib.parse.urlsplit(request.url).netloc
+        self.request_args = request_args
+        self._segment_writer = None
+
+    def total_downloaded_data_length(self):
+        """
+        :return: 下载回来的数据长度
+        """
+        if self.range_real_end < self.range_start:
+            return 0
+        return self.range_real_end - self.range_start + 1
+
+    def written_length(self):
+        """
+        :return: 已经写入的数据长度 包括还在缓冲区中的数据
+        """
+        return 0 if self._segment_writer is None else self._segment_writer.total_write_data_length()
+
+    def crc32(self):
+        """
+        :return: 已写入数据的CRC32
+        """
+        return 0 if self._segment_writer is None else self._segment_writer.crc32
+
+    async def download(self):
+        try:
+            self._segment_writer = AsyncSegmentWriter(self.storage,
+                                                      self.range_start,
+                                                      0 if self.range_end <= 0 else (self.range_end - self.range_start + 1),
+                                                      self.write_buffer_size,
+                                                      self.executor)
+            req = self.raw_request.prepare()
+            headers = dict(req.headers)
+            if self.range_end > 0:
+                headers['Range'] = 'bytes=%s-%s' % (self.range_start, self.range_end)
+            async with self.session.request(req.method or 'GET', req.url, headers=headers, data=req.body,
+                                            **self.request_args) as res:
+                # 错误响应和不是从range_start开始的响应不能写入段的位置
+                raise_for_status(res)
+                if self.range_end > 0:
+                    check_range_status(str(res.url), res.status, headers, res.headers.get('Content-Range'),
+                                       self.range_start)
+                debug_log('start request for range %s' % res.headers.get('Content-Range'))
+                async for chunk in res.content.iter_chunked(64 * 1024):
+                    if self.rate_limiter is not None:
+                        wait = self.rate_limiter.reserve(self.host, len(chunk))
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                    # 如果返回的数据比预设的数据要多 那么截断 不继续下载
+                    if self.range_end > 0 and len(chunk) > self._segment_writer.left_capacity():
+                        await self._segment_writer.write(chunk[:self._segment_writer.left_capacity()])
+                        break
+                    await self._segment_writer.write(chunk)
+        finally:
+            if self._segment_writer:
+                await self._segment_writer.close()
+                # 出错时也记录已经写入文件的位置 重试时从这里继续
+                self.range_real_end = self.range_start + self._segment_writer.total_write_data_length() - 1
+            debug_log('finish range %s-%s' % (self.range_start, self.range_real_end))
+
+
+class AsyncDownloaderCoordinator(object):
+    """
+    asyncio分段下载协调器 参数和语义同DownloaderCoordinator
+    所有段在一个事件循环中并发下载 磁盘写入在小线程池中执行
+    path: 文件存储路径
+    request: requests请求
+    request_ctl_args: 请求其它参数 比如 timeout proxies 等
+    max_concurrency: 最大并发段数
+    force_segment: 是否强制分段下载
+    segment_size: 每段大小
+    max_error_retry: 最段大重试下载次数
+    finished_segment_file: 断点文件
+    write_buffer_size: 每个段的写入合并缓冲区大小
+    fsync_policy: 持久化策略 见FileStorage
+    breakpoint_journal: 断点记录 BreakpointFile或BitmapJournal 设置后不再使用finished_segment_file
+    rate_limiter: 带宽限速 见RateLimiter
+    retry_policy: 重试策略 见RetryPolicy 遇到致命错误(例如404)时停止整个下载 start抛出该错误
+    progress_interval: 进度输出间隔(秒) 见ProgressReporter 0不输出
+    """
+
+    def __init__(self, path: str, request: requests.Request, request_ctl_args: dict, max_concurrency: int = 5,
+                 force_segment: bool = True,
+                 segment_size: int = 5 * 1024 * 1024,
+                 max_error_retry: int = 10,
+                 finished_segment_file=None,
+                 write_buffer_size: int = 256 * 1024,
+                 fsync_policy: str = FileStorage.FSYNC_CLOSE,
+                 breakpoint_journal=None,
+                 rate_limiter: RateLimiter = None,
+                 retry_policy: RetryPolicy = None,
+                 progress_interval: float = 1.0):
+        if aiohttp is None:
+            raise ImportError('AsyncDownloaderCoordinator requires aiohttp, pip install file_mt_downloader[async]')
+        self.path = path
+        self.request = request
+        self.request_ctl_args = request_ctl_args
+        if self.request_ctl_args is None:
+            self.request_ctl_args = {}
+        self.max_concurrency = max_concurrency
+        self.segment_size = segment_size
+        self.force_segment = force_segment
+        self.max_error_retry = max_error_retry
+        self.finished_segment_file = finished_segment_file
+        self.write_buffer_size = write_buffer_size
+        self.fsync_policy = fsync_policy
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.progress_interval = progress_interval
+        self._breakpoint = breakpoint_journal if breakpoint_journal is not None \
+            else BreakpointFile(finished_segment_file)
+        self._storage = None
+        self._executor = None
+        self._data_length = 1
+        self._finished_length = 0
+        self._failed_segment_list = []
+        self._abort_error = None
+        self._inflight_downloaders = set()
+
+    def get_all_failed_segment(self):
+        """获取到所有失败的段区间列表"""
+        return self._failed_segment_list[:]
+
+    def _downloaded_bytes(self):
+        """已完成的段加上在途段已经写入的数据 由ProgressReporter在后台线程中采样"""
+        return self._finished_length + sum(downloader.written_length()
+                                           for downloader in list(self._inflight_downloaders))
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _probe(self, session, request_args):
+        req = self.request.prepare()
+        try:
+            async with session.request(req.method or 'GET', req.url, headers=dict(req.headers), data=req.body,
+                                       **request_args) as response:
+                # 错误页面的长度不是文件长度
+                raise_for_status(response)
+                headers = response.headers
+                # 响应体足够小则读完 让连接回到连接池
+                if 0 <= get_content_length(headers) <= PROBE_DRAIN_LIMIT:
+                    await response.read()
+                return headers
+        except Exception as error:
+            raise FetchHeaderException(error)
+
+    async def start(self, from_breakpoint=False, data_length=None, breakpoint_segment_list=None):
+        """
+        开启下载 所有段结束后返回
+        :param from_breakpoint: 断点续传
+        :param data_length: 数据总长度
+        :param breakpoint_segment_list: 断点时的未完成的segment list
+        :return: True 遇到致命错误时抛出该错误
+        """
+        self._abort_error = None
+        request_args = to_aiohttp_request_args(self.request.url, self.request_ctl_args)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(4, self.max_concurrency),
+                                                               thread_name_prefix='async-writer')
+        progress = None
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                try_to_segment = True
+                if not from_breakpoint:
+                    headers = await self._probe(session, request_args)
+                    self._data_length = get_content_length(headers)
+                    try_to_segment = is_support_multi_range(headers)
+                    await self._run_in_executor(self._breakpoint.record_data_length, self._data_length)
+                    await self._run_in_executor(create_empty_fix_size_binary_file, self.path,
+                                                0 if self._data_length < 0 else self._data_length)
+                else:
+                    self._data_length = data_length
+                self._storage = FileStorage(self.path, fsync_policy=self.fsync_policy)
+                if self.force_segment:
+                    try_to_segment = True
+                if from_breakpoint:
+                    self._finished_length = self._data_length - sum(end - start + 1
+                                                                    for start, end in breakpoint_segment_list)
+                    tasks = split_segments(breakpoint_segment_list, self.segment_size)
+                else:
+                    tasks = plan_segments(self._data_length, self.segment_size, try_to_segment)
+                task_queue = asyncio.Queue()
+                for task in tasks:
+                    task_queue.put_nowait(task)
+                workers = [self._work(session, task_queue, request_args)
+                           for _ in range(min(len(tasks), self.max_concurrency))]
+                if self.progress_interval and self.progress_interval > 0:
+                    progress = ProgressReporter(self._data_length, self._downloaded_bytes, self.progress_interval,
+                                                log=std_log).start()
+                await asyncio.gather(*workers)
+        finally:
+            if progress is not None:
+                progress.stop()
+            if self._storage is not None:
+                await self._run_in_executor(self._storage.close)
+            await self._run_in_executor(self._breakpoint.close)
+            self._executor.shutdown(wait=True)
+        if self._abort_error is not None:
+            raise self._abort_error
+        return True
+
+    async def _work(self, session, task_queue, request_args):
+        while True:
+            try:
+                # [start, end]
+                task = task_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            retry = 0
+            while True:
+                if self._abort_error is not None:
+                    return
+                if retry > self.max_error_retry:
+                    std_log('segment download failed times exceed max retry time %s' % self.max_error_retry)
+                    self._failed_segment_list.append((task[0], task[1]))
+                    break
+                downloader = AsyncSegmentDownloader(session, self.request, task[0], task[1], self._storage,
+                                                    self._executor,
+                                                    write_buffer_size=self.write_buffer_size,
+                                                    rate_limiter=self.rate_limiter,
+                                                    **request_args)
+                whole_file = task[0] == 0 and task[1] == 0
+                error = None
+                self._inflight_downloaders.add(downloader)
+                try:
+                    await downloader.download()
+                except Exception as download_error:
+                    error = download_error
+                finally:
+                    self._inflight_downloaders.discard(downloader)
+                progressed = not whole_file and downloader.range_real_end >= task[0]
+                if progressed:
+                    await self._run_in_executor(self._storage.checkpoint)
+                    self._finished_length += downloader.total_downloaded_data_length()
+                    if downloader.range_real_end > task[1]:
+                        raise RuntimeError('range real end is exceed expected value')
+                    # 只记录已经写入的区间 没有数据时不记录
+                    await self._run_in_executor(self._breakpoint.record_finished_segment,
+                                                task[0], downloader.range_real_end, downloader.crc32())
+                    if downloader.range_real_end == task[1]:
+                        # 正常区间全部下载完毕
+                        break
+                    # 保留已经写入的数据 从最后写入的位置继续
+                    task = (downloader.range_real_end + 1, task[1])
+                    retry = 0
+                if error is None:
+                    # 从头下载到尾部
+                    if whole_file:
+                        self._finished_length += downloader.total_downloaded_data_length()
+                        break
+                    if progressed:
+                        # 服务端返回的区间不完整 继续补充下载
+                        continue
+                    error = EmptyResponseException('range %s-%s returns no data' % task)
+                else:
+                    std_log('download worker occurs error and retry, %s' %
+                            ''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                if self.retry_policy.is_fatal(error):
+                    std_log('fatal error %r, stop downloading' % error)
+                    self._failed_segment_list.append((task[0], task[1]))
+                    if self._abort_error is None:
+                        self._abort_error = error
+                    return
+                retry += 1
+                await asyncio.sleep(self.retry_policy.delay(retry, error))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+块校验增量更新(类似zsync)
+远端文件发布块校验索引 每块一个可滚动的弱校验(adler32)和一个强校验(blake2b 16字节)
+用旧的本地文件按滚动弱校验查找与新文件相同的块 复制到目标文件 剩余空洞交给DownloaderCoordinator断点续传下载
+复制的块按段记录到断点文件 中断后可以用-b继续
+
+生成索引
+python -m file_mt_downloader.delta_update new.img new.img.zidx --block_size 4096
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import requests
+
+from .download_manager import SegmentFailedException
+from .file_downloader import (BreakpointFile, DownloaderCoordinator, create_empty_fix_size_binary_file, find_holes,
+                              merge_segments, std_log)
+
+INDEX_VERSION = 1
+ADLER_MOD = 65521
+_BLOCK_RECORD = struct.Struct('<I16s')
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class BlockIndex(object):
+    """
+    块校验索引
+    格式: 第一行为JSON头 {"version", "length", "block_size", "sha256"} 之后每块20字节 弱校验(<I) 强校验(16字节)
+    length: 文件长度
+    block_size: 块大小 最后一块可以较短
+    sha256: 整个文件的SHA-256 下载结束后校验
+    """
+    def __init__(self, length, block_size, sha256, weak, strong):
+        self.length = length
+        self.block_size = block_size
+        self.sha256 = sha256
+        self.weak = weak
+        self.strong = strong
+
+    def block_range(self, block):
+        start = block * self.block_size
+        return start, min(start + self.block_size, self.length) - 1
+
+    @classmethod
+    def generate(cls, path, block_size=4096):
+        """计算path的块校验索引"""
+        weak, strong = [], []
+        file_hash = hashlib.sha256()
+        length = 0
+        with open(path, 'rb') as fd:
+            while True:
+                block = fd.read(block_size)
+                if not block:
+                    break
+                length += len(block)
+                file_hash.update(block)
+                weak.append(zlib.adler32(block))
+                strong.append(strong_digest(block))
+        return cls(length, block_size, file_hash.hexdigest(), weak, strong)
+
+    def dumps(self):
+        header = json.dumps({'version': INDEX_VERSION, 'length': self.length, 'block_size': self.block_size,
+                             'sha256': self.sha256})
+        return header.encode() + b'\n' + b''.join(_BLOCK_RECORD.pack(weak, strong)
+                                                  for weak, strong in zip(self.weak, self.strong))
+
+    def save(self, index_path):
+        with open(index_path, 'wb') as fd:
+            fd.write(self.dumps())
+
+    @classmethod
+    def loads(cls, content):
+        header, _, records = content.partition(b'\n')
+        header = json.loads(header.decode())
+        if header.get('version') != INDEX_VERSION:
+            raise ValueError('unsupported block index version %s' % header.get('version'))
+        block_count = -(-header['length'] // header['block_size'])
+        if len(records) != block_count * _BLOCK_RECORD.size:
+            raise ValueError('block index has %s bytes of records, expected %s blocks' % (len(records), block_count))
+        weak, strong = [], []
+        for record_weak, record_strong in _BLOCK_RECORD.iter_unpack(records):
+            weak.append(record_weak)
+            strong.append(record_strong)
+        return cls(header['length'], header['block_size'], header['sha256'], weak, strong)
+
+    @classmethod
+    def load(cls, index, request_ctl_args=None):
+        """
+        :param index: 索引文件路径或者http(s) URL
+        """
+        if index.startswith('http://') or index.startswith('https://'):
+            response = requests.get(index, **(request_ctl_args or {}))
+            response.raise_for_status()
+            return cls.loads(response.content)
+        with open(index, 'rb') as fd:
+            return cls.loads(fd.read())
+
+
+def find_local_blocks(index, local_path):
+    """
+    在本地旧文件中查找与索引相同的块
+    先比较对齐位置的块 再对剩余部分逐字节滚动adler32 弱校验命中后用强校验确认 确认后跳过整块
+    :return: {块序号: 本地文件偏移}
+    """
+    size = os.path.getsize(local_path)
+    block_size = index.block_size
+    block_count = len(index.weak)
+    matches = {}
+    if size == 0 or block_count == 0:
+        return matches
+    full_blocks = index.length // block_size
+    candidates = {}
+    for block in range(full_blocks):
+        candidates.setdefault(index.weak[block], []).append(block)
+    with open(local_path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # 原地修改的文件大部分块位置不变
+        aligned = set()
+        for block in range(block_count):
+            start, end = index.block_range(block)
+            if end >= size:
+                break
+            window = data[start:end + 1]
+            if zlib.adler32(window) == index.weak[block] and strong_digest(window) == index.strong[block]:
+                matches[block] = start
+                aligned.add(start)
+        if len(matches) == block_count or size < block_size:
+            return matches
+        aligned_offsets = sorted(aligned) + [size]
+        last_offset = size - block_size
+        offset = 0
+        checksum = zlib.adler32(data[0:block_size])
+        a, b = checksum & 0xffff, checksum >> 16
+        while True:
+            # 滚动到弱校验命中 对齐命中的位置或者文件结尾 热点循环只做取模运算和一次dict查找
+            limit = min(last_offset, aligned_offsets[bisect.bisect_left(aligned_offsets, offset)])
+            while offset < limit and (b << 16 | a) not in candidates:
+                old = data[offset]
+                a = (a - old + data[offset + block_size]) % ADLER_MOD
+                b = (b - block_size * old + a - 1) % ADLER_MOD
+                offset += 1
+            skip = offset in aligned
+            if not skip:
+                blocks = candidates.get((b << 16) | a)
+                if blocks and any(block not in matches for block in blocks):
+                    digest = strong_digest(data[offset:offset + block_size])
+                    for block in blocks:
+                        if block not in matches and index.strong[block] == digest:
+                            matches[block] = offset
+                            skip = True
+                    if skip and len(matches) == block_count:
+                        break
+            if skip:
+                offset += block_size
+                if offset > last_offset:
+                    break
+                checksum = zlib.adler32(data[offset:offset + block_size])
+                a, b = checksum & 0xffff, checksum >> 16
+                continue
+            if offset >= last_offset:
+                break
+            old = data[offset]
+            a = (a - old + data[offset + block_size]) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            offset += 1
+    return matches
+
+
+def plan_local_copies(index, matches, merge_gap=0):
+    """
+    把命中的块合并为连续的复制区间
+    两个空洞之间短于merge_gap的复制区间放弃 相邻空洞合并为一个请求
+    :return: [(目标start, 目标end, 本地偏移), ...]
+    """
+    copies = []
+    for block in sorted(matches):
+        start, end = index.block_range(block)
+        local_offset = matches[block]
+        if copies and copies[-1][1] + 1 == start and copies[-1][2] + start - copies[-1][0] == local_offset:
+            copies[-1] = (copies[-1][0], end, copies[-1][2])
+        else:
+            copies.append((start, end, local_offset))
+    if merge_gap <= 0:
+        return copies
+    dropped = set()
+    for start, end in merge_segments([[start, end] for start, end, _ in copies]):
+        if end - start + 1 < merge_gap and start > 0 and end < index.length - 1:
+            dropped.update(copy for copy in copies if start <= copy[0] <= end)
+    return [copy for copy in copies if copy not in dropped]
+
+
+def copy_local_ranges(local_path, path, copies, breakpoint, chunk_size=1024 * 1024):
+    """把本地区间复制到目标文件 每个区间连同CRC32记录为已完成的段"""
+    with open(local_path, 'rb') as source, open(path, 'r+b') as target:
+        for start, end, local_offset in copies:
+            crc32 = 0
+            position = start
+            while position <= end:
+                length = min(chunk_size, end - position + 1)
+                # 单线程顺序复制 seek + read/write在没有pread/pwrite的平台也可用
+                source.seek(local_offset + position - start)
+                chunk = source.read(length)
+                target.seek(position)
+                target.write(chunk)
+                crc32 = zlib.crc32(chunk, crc32)
+                position += length
+            breakpoint.record_finished_segment(start, end, crc32)
+
+
+def delta_update(path, request, request_ctl_args, local_path, index, finished_segment_file=None,
+                 merge_gap=64 * 1024, coordinator_class=DownloaderCoordinator, **coordinator_kwargs):
+    """
+    用本地旧文件和块校验索引增量更新 写入path 只下载旧文件中没有的区间 结束后按索引的SHA-256校验整个文件
+    :param local_path: 本地旧文件 不能与path相同
+    :param index: BlockIndex 或者索引文件路径/URL
+    :param finished_segment_file: 断点文件 复制的区间和下载的段都记录在这里
+    :param merge_gap: 短于该长度的复制区间放弃 让两侧空洞合并为一个请求
+    :return: dict reused_bytes downloaded_bytes requests
+    """
+    if not isinstance(index, BlockIndex):
+        index = BlockIndex.load(index, request_ctl_args)
+    if os.path.abspath(local_path) == os.path.abspath(path):
+        raise ValueError('local file must not be the target file')
+    matches = find_local_blocks(index, local_path)
+    copies = plan_local_copies(index, matches, merge_gap)
+    create_empty_fix_size_binary_file(path, index.length, overwrite_if_already_exists=True)
+    breakpoint = BreakpointFile(finished_segment_file)
+    breakpoint.record_data_length(index.length)
+    copy_local_ranges(local_path, path, copies, breakpoint)
+    holes = find_holes(index.length, merge_segments([[start, end] for start, end, _ in copies]))
+    reused = index.length - sum(end - start + 1 for start, end in holes)
+    std_log('delta update reuses %s bytes from %s, %s holes to download' % (reused, local_path, len(holes)))
+    coordinator = coordinator_class(path, request, request_ctl_args, finished_segment_file=finished_segment_file,
+                                    verify_digest=True, expected_digest='sha256:' + index.sha256,
+                                    **coordinator_kwargs)
+    coordinator.start(True, index.length, holes).result()
+    failed_segment_list = coordinator.get_all_failed_segment()
+    if failed_segment_list:
+        raise SegmentFailedException(path, failed_segment_list)
+    return {
+        'reused_bytes': reused,
+        'downloaded_bytes': index.length - reused,
+        'requests': coordinator.get_connection_stats()['requests'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate block checksum index for delta update')
+    parser.add_argument('file', type=str, help='file to index')
+    parser.add_argument('index', type=str, help='index output path')
+    parser.add_argument('-bs', '--block_size', type=int, default=4096, help='block size')
+    args = parser.parse_args()
+    index = BlockIndex.generate(args.file, args.block_size)
+    index.save(args.index)
+    print('%s blocks of %s bytes, sha256 %s' % (len(index.weak), index.block_size, index.sha256))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+本地内容寻址下载缓存
+对象按SHA-256存放在objects目录 同一内容只存一份 索引记录URL对应的对象 ETag和Last-Modified
+已知期望的SHA-256并且对象存在时不发请求直接命中 否则用条件请求(If-None-Match/If-Modified-Since)确认 304时命中
+命中时用reflink 硬链接或者复制把对象放到目标路径 未命中时用DownloaderCoordinator下载后放入缓存
+超过存放时间的对象失效 超过容量时按最近使用时间淘汰
+索引读写用flock加锁 同一个URL同时只有一个进程下载 多个进程可以共享一个缓存目录
+"""
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import requests
+
+from .download_manager import SegmentFailedException
+from .file_downloader import DownloaderCoordinator, release_response, std_log
+from .integrity import file_digest, parse_expected_digest
+
+# linux ioctl FICLONE 文件系统支持时(btrfs xfs)共享数据块 写时复制
+FICLONE = 0x40049409
+# 这些错误表示当前方式不可用 换下一种方式
+_UNSUPPORTED_LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP,
+                            errno.ENOSYS, errno.EBADF)
+
+
+def reflink_file(source, target):
+    with open(source, 'rb') as source_fd, open(target, 'wb') as target_fd:
+        fcntl.ioctl(target_fd.fileno(), FICLONE, source_fd.fileno())
+
+
+class DownloadCache(object):
+    """
+    directory: 缓存目录
+    max_size: 对象总大小上限(字节) 0不限制
+    max_age: 对象放入缓存后的最长有效时间(秒) 0不限制
+    link_modes: 依次尝试的放置方式 reflink hardlink copy
+        硬链接与缓存共享同一个文件 修改目标文件会破坏缓存 默认不使用
+    metrics: 设置后统计cache_requests_total{result=hit|revalidated|miss|bypass}和cache_evictions_total
+    """
+    HIT = 'hit'
+    REVALIDATED = 'revalidated'
+    MISS = 'miss'
+    BYPASS = 'bypass'
+    LINK_MODES = ('reflink', 'hardlink', 'copy')
+
+    def __init__(self, directory, max_size=0, max_age=0, link_modes=('reflink', 'copy'), metrics=None):
+        for mode in link_modes:
+            if mode not in self.LINK_MODES:
+                raise ValueError('link mode must be one of %s' % (self.LINK_MODES,))
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.link_modes = tuple(link_modes)
+        self.metrics = metrics
+        for name in ('objects', 'locks', 'tmp'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.json')
+
+    @contextlib.contextmanager
+    def _flock(self, path, shared=False):
+        with open(path, 'a+') as fd:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+
+    def _index_lock(self, shared=False):
+        return self._flock(os.path.join(self.directory, 'index.lock'), shared)
+
+    def _url_lock(self, url):
+        name = hashlib.sha256(url.encode()).hexdigest() + '.lock'
+        return self._flock(os.path.join(self.directory, 'locks', name))
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return {'entries': {}, 'stats': {}}
+        with open(self._index_path, 'r') as fd:
+            return json.load(fd)
+
+    def _save_index(self, index):
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            json.dump(index, fd)
+        os.replace(temp_path, self._index_path)
+
+    def _expired(self, entry, now):
+        return self.max_age > 0 and now - entry['stored'] > self.max_age
+
+    def _count(self, result):
+        if self.metrics is not None:
+            self.metrics.inc('cache_requests_total', result=result)
+        return result
+
+    def fetch(self, path, request, request_ctl_args=None, expected_digest=None,
+              coordinator_class=DownloaderCoordinator, **coordinator_kwargs):
+        """
+        下载到path 优先使用缓存 只缓存不带请求体的GET请求
+        :param expected_digest: algorithm:hex 为sha256时可以不发请求直接命中 未命中时下载后校验
+        :param coordinator_class: 未命中时使用的下载协调器 coordinator_kwargs为其它参数
+        :return: hit revalidated miss 或者不可缓存时为bypass
+        """
+        request_ctl_args = dict(request_ctl_args or {})
+        if (request.method or 'GET').upper() != 'GET' or request.data:
+            coordinator = coordinator_class(path, request, request_ctl_args, expected_digest=expected_digest,
+                                            verify_digest=bool(expected_digest), **coordinator_kwargs)
+            coordinator.start().result()
+            return self._count(self.BYPASS)
+        known_digest = None
+        if expected_digest:
+            algorithm, hexdigest = parse_expected_digest(expected_digest)
+            known_digest = hexdigest if algorithm == 'sha256' and re.fullmatch('[0-9a-f]{64}', hexdigest) else None
+        with self._url_lock(request.url):
+            if known_digest and self._serve(request.url, known_digest, path):
+                return self._count(self.HIT)
+            with self._index_lock(shared=True):
+                entry = self._load_index()['entries'].get(request.url)
+            if entry is not None and not self._expired(entry, time.time()) and \
+                    self._revalidate(request, request_ctl_args, entry) and self._serve(request.url, entry['digest'],
+                                                                                        path):
+                return self._count(self.REVALIDATED)
+            self._download(path, request, request_ctl_args, expected_digest, known_digest, coordinator_class,
+                           coordinator_kwargs)
+            return self._count(self.MISS)
+
+    def _revalidate(self, request, request_ctl_args, entry):
+        """
+        :return: 远端文件是否没有改变 没有记录ETag和Last-Modified时无法确认
+        """
+        if not entry.get('etag') and not entry.get('last_modified'):
+            return False
+        prepared = request.prepare()
+        if entry.get('etag'):
+            prepared.headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            prepared.headers['If-Modified-Since'] = entry['last_modified']
+        request_ctl_args = dict(request_ctl_args, stream=True)
+        with requests.Session() as session:
+            response = session.send(prepared, **request_ctl_args)
+        release_response(response)
+        return response.status_code == 304
+
+    def _serve(self, url, digest, path):
+        """
+        把对象放到path 并更新最近使用时间
+        :return: 对象不存在时返回False
+        """
+        with self._index_lock(shared=True):
+            object_path = self._object_path(digest)
+            if not os.path.exists(object_path):
+                return False
+            mode = self._place(object_path, path)
+        with self._index_lock():
+            index = self._load_index()
+            entry = index['entries'].get(url)
+            if entry is not None and entry['digest'] == digest:
+                entry['accessed'] = time.time()
+            stats = index['stats']
+            stats['hits'] = stats.get('hits', 0) + 1
+            stats['served_bytes'] = stats.get('served_bytes', 0) + os.path.getsize(path)
+            self._save_index(index)
+        std_log('%s served from cache by %s' % (url, mode))
+        return True
+
+    def _place(self, source, path):
+        """
+        依次尝试link_modes 先写临时文件再替换目标
+        :return: 使用的方式
+        """
+        temp_path = '%s.%s.cache.tmp' % (path, uuid.uuid4().hex[:8])
+        try:
+            for mode in self.link_modes:
+                try:
+                    if mode == 'reflink':
+                        reflink_file(source, temp_path)
+                    elif mode == 'hardlink':
+                        os.link(source, temp_path)
+                    else:
+                        shutil.copyfile(source, temp_path)
+                except OSError as error:
+                    if error.errno not in _UNSUPPORTED_LINK_ERRORS or mode == 'copy':
+                        raise
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    continue
+                os.replace(temp_path, path)
+                return mode
+            raise OSError(errno.EOPNOTSUPP, 'no link mode of %s is supported' % (self.link_modes,))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _download(self, path, request, request_ctl_args, expected_digest, known_digest, coordinator_class,
+                  coordinator_kwargs):
+        temp_path = os.path.join(self.directory, 'tmp', uuid.uuid4().hex)
+        try:
+            coordinator = coordinator_class(temp_path, request, request_ctl_args, expected_digest=expected_digest,
+                                            verify_digest=bool(expected_digest), **coordinator_kwargs)
+            coordinator.start().result()
+            failed_segment_list = coordinator.get_all_failed_segment()
+            if failed_segment_list:
+                raise SegmentFailedException(path, failed_segment_list)
+            # 已经按期望的sha256校验过 不再重复计算
+            digest = known_digest or file_digest(temp_path)
+            self._place(temp_path, path)
+            etag, last_modified = coordinator.get_validators()
+            now = time.time()
+            with self._index_lock():
+                object_path = self._object_path(digest)
+                if not os.path.exists(object_path):
+                    os.chmod(temp_path, 0o444)
+                    os.replace(temp_path, object_path)
+                index = self._load_index()
+                index['entries'][request.url] = {
+                    'digest': digest,
+                    'size': os.path.getsize(object_path),
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'stored': now,
+                    'accessed': now,
+                }
+                stats = index['stats']
+                stats['misses'] = stats.get('misses', 0) + 1
+                self._evict(index, now)
+                self._save_index(index)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _evict(self, index, now):
+        """
+        删除失效的记录 超过容量时按最近使用时间淘汰对象 删除不再被引用的对象 调用方持有索引锁
+        """
+        entries = index['entries']
+        for url in [url for url, entry in entries.items() if self._expired(entry, now)]:
+            del entries[url]
+        objects = {}
+        for entry in entries.values():
+            size, accessed = objects.get(entry['digest'], (entry['size'], 0))
+            objects[entry['digest']] = (size, max(accessed, entry['accessed']))
+        total = sum(size for size, _ in objects.values())
+        if self.max_size > 0:
+            for digest, (size, _) in sorted(objects.items(), key=lambda item: item[1][1]):
+                if total <= self.max_size:
+                    break
+                total -= size
+                del objects[digest]
+            for url in [url for url, entry in entries.items() if entry['digest'] not in objects]:
+                del entries[url]
+        evicted = 0
+        objects_dir = os.path.join(self.directory, 'objects')
+        for name in os.listdir(objects_dir):
+            if name not in objects:
+                os.remove(os.path.join(objects_dir, name))
+                evicted += 1
+        if evicted:
+            index['stats']['evictions'] = index['stats'].get('evictions', 0) + evicted
+            if self.metrics is not None:
+                self.metrics.inc('cache_evictions_total', evicted)
+
+    def prune(self):
+        """立即删除失效和超过容量的对象"""
+        with self._index_lock():
+            index = self._load_index()
+            self._evict(index, time.time())
+            self._save_index(index)
+
+    def stats(self):
+        """
+        :return: dict hits misses evictions served_bytes entries size 所有使用该目录的进程累计
+        """
+        with self._index_lock(shared=True):
+            index = self._load_index()
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'served_bytes': 0}
+        stats.update(index['stats'])
+        sizes = {entry['digest']: entry['size'] for entry in index['entries'].values()}
+        stats['entries'] = len(index['entries'])
+        stats['size'] = sum(sizes.values())
+        return stats
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+批量下载管理器
+多个文件的段调度到同一个有界工作线程池 每个host有连接数上限 小文件不分段 用一次请求下载完成
+"""
+import atexit
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+import weakref
+
+import requests
+
+from .file_downloader import (BreakpointFile, FetchHeaderException, FileStorage, RetryPolicy, SegmentDownloader,
+                              SessionPool, create_empty_fix_size_binary_file, find_holes, get_content_length,
+                              is_support_multi_range, read_all_finished_segment_list, release_response,
+                              split_segments, std_log)
+from .rate_limiter import RateLimiter
+
+# 没有调用shutdown的管理器 解释器退出时等待已提交的文件下载完成 与ThreadPoolExecutor一致
+_live_managers = weakref.WeakSet()
+
+
+@atexit.register
+def _shutdown_live_managers():
+    for manager in list(_live_managers):
+        manager.shutdown(wait=True)
+
+
+class SegmentFailedException(Exception):
+    """文件有段超过最大重试次数仍然下载失败"""
+    def __init__(self, path, failed_segment_list):
+        super().__init__('%s has %s failed segments' % (path, len(failed_segment_list)))
+        self.path = path
+        self.failed_segment_list = failed_segment_list
+
+
+def read_manifest(manifest_file):
+    """
+    读取JSONL格式的下载清单 每行一个文件
+    {"url": "...", "path": "...", "method": "GET", "headers": {...}, "data": "...",
+     "breakpoint_file": "...", "resume": false}
+    :param manifest_file: 清单文件路径
+    :return: entry list
+    """
+    entries = []
+    with open(manifest_file, 'r', encoding='utf8') as fd:
+        for line_number, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not entry.get('url') or not entry.get('path'):
+                raise ValueError('manifest line %s must contain url and path' % line_number)
+            entries.append(entry)
+    return entries
+
+
+class _FileJob(object):
+    """单个文件的下载状态"""
+    def __init__(self, path, request, finished_segment_file):
+        self.path = path
+        self.request = request
+        self.host = urllib.parse.urlsplit(request.url).netloc
+        self.breakpoint = BreakpointFile(finished_segment_file)
+        self.future = concurrent.futures.Future()
+        self.future.set_running_or_notify_cancel()
+        self.storage = None
+        self.data_length = -1
+        self.downloaded_length = 0
+        self.pending_count = 0
+        # 探测响应没有Accept-Ranges时为False 重试只能重新下载完整文件
+        self.accept_ranges = True
+        self.failed_segment_list = []
+        self.error = None
+
+
+class DownloadManager(object):
+    """
+    批量下载管理器
+    max_workers: 全局连接数(工作线程数) 所有文件共享
+    per_host_connections: 每个host的最大连接数
+    request_ctl_args: 请求其它参数 比如 timeout proxies 等
+    segment_size: 每段大小
+    small_file_size: 不超过该大小的文件直接用探测请求的响应下载 不分段 默认等于segment_size
+    max_error_retry: 每段最大重试次数
+    write_buffer_size: 写入合并缓冲区大小
+    fsync_policy: 持久化策略 见FileStorage
+    rate_limiter: 所有文件共享的带宽限速 见RateLimiter
+    retry_policy: 重试策略 见RetryPolicy 重试的任务退避等待后才会被取出 不占用工作线程 致命错误(例如404)时文件直接失败
+    """
+
+    def __init__(self, max_workers: int = 16, per_host_connections: int = 4, request_ctl_args: dict = None,
+                 segment_size: int = 5 * 1024 * 1024,
+                 small_file_size: int = None,
+                 max_error_retry: int = 10,
+                 write_buffer_size: int = 256 * 1024,
+                 fsync_policy: str = FileStorage.FSYNC_CLOSE,
+                 rate_limiter: RateLimiter = None,
+                 retry_policy: RetryPolicy = None):
+        self.max_workers = max_workers
+        self.per_host_connections = per_host_connections
+        self.request_ctl_args = dict(request_ctl_args or {})
+        self.request_ctl_args['stream'] = True
+        self.segment_size = segment_size
+        self.small_file_size = segment_size if small_file_size is None else small_file_size
+        self.max_error_retry = max_error_retry
+        self.write_buffer_size = write_buffer_size
+        self.fsync_policy = fsync_policy
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._session_pool = SessionPool(max_workers)
+        # host -> deque[(job, task, retry, ready_time)] task为None表示探测请求 ready_time之前不取出
+        self._host_queues = collections.OrderedDict()
+        self._host_active = collections.Counter()
+        self._jobs = []
+        self._pending_count = 0
+        self._transferred_length = 0
+        self._workers = []
+        self._shutdown = False
+        self._start_time = None
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def submit(self, path: str, request: requests.Request, finished_segment_file=None, from_breakpoint=False):
+        """
+        提交一个文件下载
+        :param path: 文件存储路径
+        :param request: requests请求
+        :param finished_segment_file: 断点文件
+        :param from_breakpoint: 是否从断点文件续传
+        :return: Future 成功时结果为True 有段失败时异常为SegmentFailedException
+        """
+        job = _FileJob(path, request, finished_segment_file)
+        data_length, segments = None, None
+        if from_breakpoint and finished_segment_file and os.path.exists(finished_segment_file):
+            data_length, segments = read_all_finished_segment_list(finished_segment_file)
+        if from_breakpoint and data_length is None:
+            std_log('%s has no break point record, download from start' % path)
+            from_breakpoint = False
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('download manager is shutdown')
+            self._jobs.append(job)
+        if from_breakpoint:
+            job.data_length = data_length
+            holes = find_holes(data_length, segments or [])
+            job.downloaded_length = data_length - sum(end - start + 1 for start, end in holes)
+            if not holes:
+                job.future.set_result(True)
+                return job.future
+            job.storage = FileStorage(path, fsync_policy=self.fsync_policy)
+            self._schedule(job, split_segments(holes, self.segment_size))
+        else:
+            self._schedule(job, [None])
+        self._ensure_workers()
+        return job.future
+
+    def submit_manifest(self, manifest_file):
+        """
+        提交清单中的所有文件
+        :param manifest_file: JSONL清单 见read_manifest
+        :return: [(entry, future), ...]
+        """
+        submitted = []
+        for entry in read_manifest(manifest_file):
+            request = requests.Request(method=entry.get('method', 'GET'),
+                                       url=entry['url'],
+                                       headers=entry.get('headers') or {},
+                                       data=entry.get('data'))
+            future = self.submit(entry['path'], request,
+                                 finished_segment_file=entry.get('breakpoint_file'),
+                                 from_breakpoint=bool(entry.get('resume')))
+            submitted.append((entry, future))
+        return submitted
+
+    def progress(self):
+        """
+        汇总进度
+        :return: dict files finished_files failed_files total_bytes(已知长度的文件) downloaded_bytes
+                 speed(bytes/s) pending_tasks active_connections
+        """
+        with self._condition:
+            jobs = self._jobs[:]
+            pending_tasks = sum(len(tasks) for tasks in self._host_queues.values())
+            active_connections = sum(self._host_active.values())
+        downloaded_bytes = sum(job.downloaded_length for job in jobs)
+        elapsed = time.monotonic() - self._start_time if self._start_time else 0
+        return {
+            'files': len(jobs),
+            'finished_files': sum(1 for job in jobs if job.future.done()),
+            'failed_files': sum(1 for job in jobs if job.future.done() and job.future.exception() is not None),
+            'total_bytes': sum(job.data_length for job in jobs if job.data_length > 0),
+            'downloaded_bytes': downloaded_bytes,
+            'speed': self._transferred_length / elapsed if elapsed > 0 else 0,
+            'pending_tasks': pending_tasks,
+            'active_connections': active_connections,
+        }
+
+    def shutdown(self, wait=True):
+        """
+        不再接受新文件 已提交的文件下载完成后工作线程退出
+        :param wait: 是否等待工作线程退出
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+            workers = self._workers[:]
+        if wait:
+            for worker in workers:
+                worker.join()
+            self._session_pool.close()
+
+    def _ensure_workers(self):
+        with self._condition:
+            if self._start_time is None:
+                self._start_time = time.monotonic()
+            if not self._workers:
+                _live_managers.add(self)
+            while len(self._workers) < self.max_workers:
+                # 守护线程 没有调用shutdown时由退出钩子等待
+                worker = threading.Thread(name='manager-work-%s' % len(self._workers), target=self._work,
+                                          daemon=True)
+                self._workers.append(worker)
+                worker.start()
+
+    def _schedule(self, job, tasks, retry=0, delay=0):
+        """
+        把任务放到host队列最前面 先完成已经开始的文件
+        :param delay: 退避等待的秒数 等待期间同一host的其它任务可以先执行
+        """
+        ready_time = time.monotonic() + delay
+        with self._condition:
+            queue = self._host_queues.setdefault(job.host, collections.deque())
+            for task in reversed(tasks):
+                queue.appendleft((job, task, retry, ready_time))
+            job.pending_count += len(tasks)
+            self._pending_count += len(tasks)
+            self._condition.notify_all()
+
+    def _take(self):
+        """取一个所在host还有空闲连接的任务 没有时等待"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for host, queue in self._host_queues.items():
+                    if not queue or self._host_active[host] >= self.per_host_connections:
+                        continue
+                    for index, item in enumerate(queue):
+                        if item[3] > now:
+                            # 还在退避等待
+                            timeout = item[3] - now if timeout is None else min(timeout, item[3] - now)
+                            continue
+                        del queue[index]
+                        self._host_active[host] += 1
+                        # 轮转 避免一直优先同一个host
+                        self._host_queues.move_to_end(host)
+                        return item[:3]
+                if self._shutdown and self._pending_count == 0:
+                    return None
+                self._condition.wait(timeout)
+
+    def _task_done(self, job, host):
+        with self._condition:
+            self._host_active[host] -= 1
+            job.pending_count -= 1
+            self._pending_count -= 1
+            finished = job.pending_count == 0
+            self._condition.notify_all()
+        if finished:
+            self._finish_job(job)
+
+    def _finish_job(self, job):
+        try:
+            if job.storage is not None:
+                job.storage.close()
+        except Exception as error:
+            job.error = job.error or error
+        if job.error is not None:
+            job.future.set_exception(job.error)
+        elif job.failed_segment_list:
+            job.future.set_exception(SegmentFailedException(job.path, job.failed_segment_list))
+        else:
+            job.future.set_result(True)
+
+    def _work(self):
+        with self._session_pool.session() as session:
+            while True:
+                item = self._take()
+                if item is None:
+                    return
+                job, task, retry = item
+                try:
+                    if task is None:
+                        self._probe(job, session)
+                    else:
+                        self._download_segment(job, task, retry, session)
+                except Exception as error:
+                    std_log('download %s error, %s' % (job.path, traceback.format_exc()))
+                    job.error = job.error or error
+                finally:
+                    self._task_done(job, job.host)
+
+    def _probe(self, job, session):
+        try:
+            response = session.send(job.request.prepare(), **self.request_ctl_args)
+        except Exception as error:
+            raise FetchHeaderException(error)
+        with response:
+            response.raise_for_status()
+            job.data_length = get_content_length(response.headers)
+            job.breakpoint.record_data_length(job.data_length)
+            create_empty_fix_size_binary_file(job.path, max(0, job.data_length), overwrite_if_already_exists=True)
+            job.storage = FileStorage(job.path, fsync_policy=self.fsync_policy)
+            job.accept_ranges = is_support_multi_range(response.headers)
+            if job.data_length > self.small_file_size and job.accept_ranges:
+                release_response(response)
+                self._schedule(job, split_segments([(0, job.data_length - 1)], self.segment_size))
+                return
+            # 小文件或者不支持分段 直接用探测请求的响应下载
+            range_end = job.data_length - 1 if job.data_length > 1 else 0
+            downloader = SegmentDownloader(job.path, job.request, 0, range_end,
+                                           session=session,
+                                           storage=job.storage,
+                                           write_buffer_size=self.write_buffer_size,
+                                           rate_limiter=self.rate_limiter,
+                                           **self.request_ctl_args)
+            try:
+                downloader.receive(response)
+            except Exception as error:
+                std_log('download %s from probe response error, %s' % (job.path, traceback.format_exc()))
+                # 不支持Range时不能带Range重试 重新下载完整文件
+                self._retry(job, (0, range_end) if job.accept_ranges else (0, 0), 0, error)
+                return
+        self._finish_segment(job, (0, range_end), downloader)
+
+    def _download_segment(self, job, task, retry, session):
+        downloader = SegmentDownloader(job.path, job.request, task[0], task[1],
+                                       session=session,
+                                       storage=job.storage,
+                                       write_buffer_size=self.write_buffer_size,
+                                       rate_limiter=self.rate_limiter,
+                                       **self.request_ctl_args)
+        try:
+            downloader.download()
+        except Exception as error:
+            std_log('download %s range %s-%s error and retry, %s' % (job.path, task[0], task[1],
+                                                                     traceback.format_exc()))
+            self._retry(job, task, retry, error)
+            return
+        self._finish_segment(job, task, downloader, retry)
+
+    def _retry(self, job, task, retry, error=None):
+        """
+        按重试策略退避后重新调度任务
+        :param retry: 已经重试的次数
+        :param error: 本次失败的异常 致命错误时不再重试
+        """
+        if error is not None and self.retry_policy.is_fatal(error):
+            std_log('download %s fatal error %r' % (job.path, error))
+            with self._condition:
+                job.failed_segment_list.append(task)
+        elif retry + 1 > self.max_error_retry:
+            std_log('segment download failed times exceed max retry time %s' % self.max_error_retry)
+            with self._condition:
+                job.failed_segment_list.append(task)
+        else:
+            self._schedule(job, [task], retry=retry + 1, delay=self.retry_policy.delay(retry + 1, error))
+
+    def _finish_segment(self, job, task, downloader, retry=0):
+        whole_file = task[0] == 0 and task[1] == 0
+        if whole_file:
+            complete = job.data_length < 0 or downloader.total_downloaded_data_length() >= job.data_length
+        else:
+            complete = downloader.range_real_end >= task[1]
+        with self._condition:
+            # 不支持Range时不完整的数据会被重新下载覆盖 不计入文件进度
+            if complete or job.accept_ranges:
+                job.downloaded_length += downloader.total_downloaded_data_length()
+            self._transferred_length += downloader.total_downloaded_data_length()
+        if not complete and not job.accept_ranges:
+            std_log('%s does not support range, download the whole file again' % job.path)
+            self._retry(job, (0, 0), retry)
+            return
+        # 从头下载到尾部
+        if whole_file:
+            return
+        job.storage.checkpoint()
+        if downloader.range_real_end >= task[0]:
+            job.breakpoint.record_finished_segment(task[0], downloader.range_real_end, downloader.crc32())
+        if downloader.range_real_end < task[1]:
+            # 区间下载不完整 继续补充下载 没有任何进展时计为一次重试
+            remain_task = (downloader.range_real_end + 1, task[1])
+            if downloader.total_downloaded_data_length() > 0:
+                self._schedule(job, [remain_task])
+            else:
+                self._retry(job, remain_task, retry)
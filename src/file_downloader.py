@@ -1,15 +1,41 @@
 # -*- coding: utf-8 -*-
+import collections
 import concurrent.futures
+import contextlib
+import email.utils
+import functools
+import hashlib
+import itertools
+import json
+import mmap
 import os.path
 import queue
+import random
+import re
+import statistics
+import struct
 import sys
 import threading
+import time
 import traceback
+import urllib.parse
+import zlib
 
 import requests
+import requests.adapters
+import urllib3
+
+from .integrity import (IntegrityException, file_digest, get_digest_from_headers, parse_expected_digest, pread,
+                        sample_segment_digests, verify_segment_digests)
+from .metrics import Metrics, MetricsExporter, ProgressReporter
+from .rate_limiter import RateLimiter
 
 # LOG QUIET
 QUIET = False
+# LOG VERBOSE 输出每个段的开始和结束
+VERBOSE = False
+# 日志写到stderr 数据输出到stdout时使用
+LOG_TO_STDERR = False
 
 
 def be_quiet():
@@ -17,11 +43,27 @@ def be_quiet():
     QUIET = True
 
 
+def be_verbose():
+    global VERBOSE
+    VERBOSE = True
+
+
+def log_to_stderr():
+    global LOG_TO_STDERR
+    LOG_TO_STDERR = True
+
+
 def std_log(string):
     global QUIET
     if not QUIET:
-        sys.stdout.write('[%s-%s] %s\n' % (threading.current_thread().name, threading.current_thread().ident, string))
-        sys.stdout.flush()
+        output = sys.stderr if LOG_TO_STDERR else sys.stdout
+        output.write('[%s-%s] %s\n' % (threading.current_thread().name, threading.current_thread().ident, string))
+        output.flush()
+
+
+def debug_log(string):
+    if VERBOSE:
+        std_log(string)
 
 
 def create_empty_fix_size_binary_file(path, size, mode='wb', overwrite_if_already_exists=False):
@@ -38,9 +80,252 @@ def create_empty_fix_size_binary_file(path, size, mode='wb', overwrite_if_alread
         mode = 'wb'
     if not overwrite_if_already_exists and os.path.exists(path):
         raise Exception('path already exists')
-    open_file = open(path, mode)
-    open_file.truncate(size)
-    open_file.close()
+    with open(path, mode) as open_file:
+        preallocate_file(open_file.fileno(), size)
+
+
+def preallocate_file(fd, size):
+    """
+    为文件预分配磁盘空间 文件系统支持时使用posix_fallocate分配真实块 避免稀疏文件在并发写入时产生碎片
+    不支持时退化为truncate
+    :param fd: 文件描述符
+    :param size: 文件大小
+    """
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # 文件系统不支持(EOPNOTSUPP/EINVAL等)
+            pass
+    os.ftruncate(fd, size)
+
+
+class FileStorage(object):
+    """
+    下载文件存储 一次下载只打开一次文件 所有工作线程按偏移并发写入(os.pwrite)
+    path: 文件路径 文件必须已经存在
+    fsync_policy: 持久化策略
+        none: 不主动fsync 由操作系统决定刷盘时机
+        close: 关闭时fsync
+        segment: 每个段完成时fsync 保证断点文件记录的段已经落盘
+    """
+    FSYNC_NONE = 'none'
+    FSYNC_CLOSE = 'close'
+    FSYNC_SEGMENT = 'segment'
+    FSYNC_POLICIES = (FSYNC_NONE, FSYNC_CLOSE, FSYNC_SEGMENT)
+
+    def __init__(self, path, fsync_policy=FSYNC_CLOSE, fd=None):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy %s' % fsync_policy)
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0)) if fd is None else fd
+        self._closed = False
+        # 不支持pwrite/pread的平台 用锁保护seek + write/read
+        self._seek_lock = None if hasattr(os, 'pwrite') and hasattr(os, 'pread') else threading.Lock()
+
+    @classmethod
+    def create(cls, path, size, fsync_policy=FSYNC_CLOSE, overwrite=False):
+        """
+        创建并预分配文件 只打开一次
+        :param overwrite: 文件已经存在时是否覆盖 否则抛出FileExistsError
+        """
+        flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        if not overwrite:
+            flags |= os.O_EXCL
+        fd = os.open(path, flags, 0o666)
+        try:
+            preallocate_file(fd, size)
+            return cls(path, fsync_policy, fd)
+        except Exception:
+            os.close(fd)
+            raise
+
+    def preallocate(self, size):
+        """预分配文件空间"""
+        preallocate_file(self.fd, size)
+
+    def pwrite(self, data, offset):
+        """
+        在offset处写入全部数据
+        :param data: bytes-like
+        :param offset: 文件偏移
+        """
+        view = memoryview(data)
+        while view:
+            if self._seek_lock is None:
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                with self._seek_lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+
+    def pread(self, offset, length):
+        """
+        在offset处读取最多length字节
+        """
+        return pread(self.fd, length, offset, self._seek_lock)
+
+    def sync(self):
+        """fsync到磁盘"""
+        os.fsync(self.fd)
+
+    def checkpoint(self):
+        """段完成 按持久化策略决定是否fsync"""
+        if self.fsync_policy == self.FSYNC_SEGMENT:
+            self.sync()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self.fsync_policy != self.FSYNC_NONE:
+                self.sync()
+        finally:
+            os.close(self.fd)
+
+
+class DownloadSink(object):
+    """
+    下载数据的写入目标 所有工作线程共享 按偏移并发调用pwrite
+    DownloaderCoordinator在长度确定后调用open 成功后调用finalize 失败或者远端文件改变重新下载前调用abort
+    自定义写入目标继承该类 至少实现open和pwrite 下载后校验需要read
+    path: 对应的文件路径 不是文件时为None 多进程引擎需要文件
+    """
+    path = None
+
+    def open(self, data_length, resume=False, overwrite=False):
+        """
+        :param data_length: 数据长度 小于0表示未知 此时只有一个线程从0开始顺序写入
+        :param resume: 断点续传 保留已经写入的数据
+        :param overwrite: 已经存在的数据是否可以覆盖
+        """
+        raise NotImplementedError
+
+    def pwrite(self, data, offset):
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """段完成"""
+
+    def read(self, offset, length):
+        """读取已经写入的数据"""
+        raise NotImplementedError
+
+    def verify_segment_digests(self, segment_digests):
+        """
+        :param segment_digests: {(start, end): crc32}
+        :return: 不匹配的段列表 按start排序
+        """
+        return sorted(segment for segment, crc32 in segment_digests.items()
+                      if zlib.crc32(self.read(segment[0], segment[1] - segment[0] + 1)) != crc32)
+
+    def digest(self, algorithm):
+        """:return: 全部数据的hexdigest"""
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        下载成功后调用
+        :return: 作为start()返回的Future的结果
+        """
+        return True
+
+    def abort(self):
+        """下载失败时调用 可能调用多次"""
+
+
+class FileSink(DownloadSink):
+    """
+    写入本地文件 默认的写入目标 创建时预分配空间 一次下载只打开一次文件 见FileStorage
+    失败时保留文件 可以断点续传
+    """
+    def __init__(self, path, fsync_policy=FileStorage.FSYNC_CLOSE):
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self._storage = None
+
+    def open(self, data_length, resume=False, overwrite=False):
+        if resume:
+            self._storage = FileStorage(self.path, fsync_policy=self.fsync_policy)
+        else:
+            self._storage = FileStorage.create(self.path, max(0, data_length), fsync_policy=self.fsync_policy,
+                                               overwrite=overwrite)
+
+    def pwrite(self, data, offset):
+        self._storage.pwrite(data, offset)
+
+    def checkpoint(self):
+        self._storage.checkpoint()
+
+    def read(self, offset, length):
+        return self._storage.pread(offset, length)
+
+    def verify_segment_digests(self, segment_digests):
+        return verify_segment_digests(self.path, segment_digests)
+
+    def digest(self, algorithm):
+        return file_digest(self.path, algorithm)
+
+    def _close(self):
+        storage, self._storage = self._storage, None
+        if storage is not None:
+            storage.close()
+
+    def finalize(self):
+        self._close()
+        return True
+
+    def abort(self):
+        self._close()
+
+
+class MemorySink(DownloadSink):
+    """
+    写入预分配的内存缓冲区 不创建文件 适合小对象 不支持断点续传
+    zero_copy: finalize返回缓冲区的memoryview 否则返回bytes
+    max_size: 数据长度上限 超过时抛出ValueError 0不限制
+    """
+    def __init__(self, zero_copy=False, max_size=0):
+        self.zero_copy = zero_copy
+        self.max_size = max_size
+        self._buffer = bytearray()
+
+    def _check_size(self, size):
+        if self.max_size and size > self.max_size:
+            raise ValueError('data length %s exceeds memory sink max size %s' % (size, self.max_size))
+
+    def open(self, data_length, resume=False, overwrite=False):
+        if resume:
+            raise ValueError('memory sink does not support resume')
+        self._check_size(data_length)
+        self._buffer = bytearray(max(0, data_length))
+
+    def pwrite(self, data, offset):
+        end = offset + len(data)
+        if end > len(self._buffer):
+            # 长度未知 只有一个线程顺序写入
+            self._check_size(end)
+            self._buffer.extend(bytes(end - len(self._buffer)))
+        self._buffer[offset:end] = data
+
+    def read(self, offset, length):
+        return memoryview(self._buffer)[offset:offset + length]
+
+    def digest(self, algorithm):
+        return hashlib.new(algorithm, self._buffer).hexdigest()
+
+    def getvalue(self):
+        return bytes(self._buffer)
+
+    def finalize(self):
+        return memoryview(self._buffer) if self.zero_copy else bytes(self._buffer)
+
+    def abort(self):
+        self._buffer = bytearray()
 
 
 def is_support_multi_range(headers):
@@ -56,6 +341,74 @@ def get_content_length(headers):
     return int(headers.get('Content-Length', -1))
 
 
+def get_probe_data_length(response):
+    """
+    :param response: 探测请求的响应 可能带Range
+    :return: 数据总长度 未知时返回-1
+    """
+    if response.status_code == 206:
+        content_range = parse_content_range(response.headers.get('Content-Range'))
+        return content_range[2] if content_range else -1
+    if response.status_code == 416:
+        # 空文件 Content-Range: bytes */0
+        match = re.match(r'\s*bytes\s+\*/(\d+)', response.headers.get('Content-Range') or '')
+        return int(match.group(1)) if match else -1
+    return get_content_length(response.headers)
+
+
+def discover_data_length(session, request, request_ctl_args, known_end, if_range=None, max_probes=64):
+    """
+    Content-Range没有总长度(bytes 0-N/*)时 用单字节Range请求找出数据总长度
+    从known_end开始按2倍递增请求 直到返回416 再二分查找最后一个字节 响应带有总长度时直接使用
+    :param known_end: 已知存在的字节位置
+    :param if_range: 带上If-Range 远端文件改变时返回200 停止探测
+    :param max_probes: 最多请求次数
+    :return: 数据总长度 无法确定时返回-1
+    """
+    # low已知存在 high已知超出结尾
+    low, high = known_end, -1
+    for _ in range(max_probes):
+        if high >= 0 and high - low <= 1:
+            return high
+        position = 2 * low + 1 if high < 0 else (low + high) // 2
+        prepared = request.prepare()
+        prepared.headers['Range'] = 'bytes=%s-%s' % (position, position)
+        if if_range:
+            prepared.headers['If-Range'] = if_range
+        response = session.send(prepared, **dict(request_ctl_args, stream=True))
+        release_response(response)
+        if response.status_code not in (206, 416):
+            return -1
+        total = get_probe_data_length(response)
+        if total >= 0:
+            return total
+        if response.status_code == 206:
+            low = position
+        else:
+            high = position
+    return -1
+
+
+def get_if_range(etag, last_modified):
+    """
+    If-Range只能使用强ETag或者Last-Modified
+    :return: If-Range的值 没有可用的校验值时返回None
+    """
+    if etag and not etag.strip().startswith('W/'):
+        return etag.strip()
+    return last_modified or None
+
+
+def parse_breakpoint_header(line):
+    """
+    :param line: 断点文件第一行 data_length[\tETag\tLast-Modified]
+    :return: (data_length, etag, last_modified) 没有记录的校验值为None
+    """
+    fields = line.rstrip('\r\n').split('\t')
+    fields += [''] * (3 - len(fields))
+    return int(fields[0]), fields[1] or None, fields[2] or None
+
+
 def read_all_finished_segment_list(segment_list_file):
     """
     读取文件下载成功段记录
@@ -66,28 +419,50 @@ def read_all_finished_segment_list(segment_list_file):
         lines = [line.strip() for line in fd]
         if not lines:
             return None, None
-        data_length = int(lines[0])
+        data_length = parse_breakpoint_header(lines[0])[0]
         # (0, 10), (11, 20), (11, 20), (12, 15), (9, 12)
+        # 每行 start,end 或者 start,end,crc32
         segments = [line.split(',') for line in lines[1:] if line != '']
-        segments = [[int(start), int(end)] for start, end in segments]
-        # sort by start and  merge
-        sorted_segments = sorted(segments, key=lambda se: se[0])
-        merged_segments = []
-        prev = None
-        for segment in sorted_segments:
-            if len(segment) != 2:
-                continue
-            if prev is None:
-                prev = segment
-                continue
-            if segment[0] <= prev[1] or segment[0] == prev[1] + 1:
-                prev = [prev[0], max(segment[1], prev[1])]
-            else:
-                merged_segments.append(prev)
-                prev = segment
-        if prev is not None:
+        segments = [[int(fields[0]), int(fields[1])] for fields in segments if len(fields) >= 2]
+        return data_length, merge_segments(segments)
+
+
+def merge_segments(segments):
+    """
+    排序并合并重合或相邻的段
+    :param segments: [[start, end], ...]
+    :return: merged segment list
+    """
+    sorted_segments = sorted(([start, end] for start, end in segments), key=lambda se: se[0])
+    merged_segments = []
+    prev = None
+    for segment in sorted_segments:
+        if prev is None:
+            prev = segment
+            continue
+        if segment[0] <= prev[1] or segment[0] == prev[1] + 1:
+            prev = [prev[0], max(segment[1], prev[1])]
+        else:
             merged_segments.append(prev)
-        return data_length, merged_segments
+            prev = segment
+    if prev is not None:
+        merged_segments.append(prev)
+    return merged_segments
+
+
+def read_segment_digests(segment_list_file):
+    """
+    读取断点文件中段的CRC32 同一段多次记录时以最后一次为准
+    :param segment_list_file: segment list file
+    :return: {(start, end): crc32}
+    """
+    digests = {}
+    with open(segment_list_file, 'r') as fd:
+        for line in list(fd)[1:]:
+            fields = line.strip().split(',')
+            if len(fields) == 3:
+                digests[(int(fields[0]), int(fields[1]))] = int(fields[2], 16)
+    return digests
 
 
 def find_holes(data_length, merged_segment_list):
@@ -116,6 +491,418 @@ def find_holes(data_length, merged_segment_list):
     return segments
 
 
+def plan_segments(data_length, segment_size, try_to_segment=True):
+    """
+    从0开始制定分段下载计划
+    :param data_length: 数据长度 小于0表示未知
+    :param segment_size: 每段大小
+    :param try_to_segment: 是否分段
+    :return: segment list [(start, end), ...] 不分段时为[(0, 0)] 表示全文件下载
+    """
+    if not try_to_segment or data_length <= segment_size:
+        return [(0, 0)]
+    return split_segments([(0, data_length - 1)], segment_size)
+
+
+def split_segments(segment_list, segment_size):
+    """
+    将大段切分成不超过segment_size的段
+    :param segment_list: [(start, end), ...]
+    :param segment_size: 每段大小
+    :return: segment list
+    """
+    segments = []
+    for segment in segment_list:
+        offset = segment[0]
+        while offset <= segment[1]:
+            segments.append((offset, min(offset + segment_size - 1, segment[1])))
+            offset += segment_size
+    return segments
+
+
+def subtract_segments(segment_list, done_segment_list):
+    """
+    从段列表中减去已经完成的段
+    :param segment_list: [(start, end), ...]
+    :param done_segment_list: [(start, end), ...]
+    :return: 剩余的段列表
+    """
+    remains = []
+    for start, end in segment_list:
+        pieces = [(start, end)]
+        for done_start, done_end in done_segment_list:
+            next_pieces = []
+            for piece_start, piece_end in pieces:
+                if done_end < piece_start or done_start > piece_end:
+                    next_pieces.append((piece_start, piece_end))
+                    continue
+                if piece_start < done_start:
+                    next_pieces.append((piece_start, done_start - 1))
+                if done_end < piece_end:
+                    next_pieces.append((done_end + 1, piece_end))
+            pieces = next_pieces
+        remains.extend(pieces)
+    return remains
+
+
+class MultiRangeTask(object):
+    """
+    用一个multi-range请求下载的一组小段
+    ranges: [(start, end), ...] 按start排序且互不相邻
+    """
+    def __init__(self, ranges):
+        self.ranges = list(ranges)
+
+    def __repr__(self):
+        return 'MultiRangeTask(%s)' % self.ranges
+
+
+def group_small_segments(segment_list, max_segment_size, max_ranges, max_batch_size):
+    """
+    把相邻的小段合并为MultiRangeTask
+    :param segment_list: [(start, end), ...]
+    :param max_segment_size: 不超过该长度的段才参与合并
+    :param max_ranges: 每个请求最多的Range数
+    :param max_batch_size: 每个请求最多的数据量
+    :return: (MultiRangeTask list, 没有合并的段列表)
+    """
+    batches = []
+    others = []
+    batch = []
+    batch_size = 0
+
+    def close_batch():
+        if len(batch) > 1:
+            batches.append(MultiRangeTask(batch))
+        else:
+            others.extend(batch)
+
+    for start, end in sorted(segment_list, key=lambda se: se[0]):
+        length = end - start + 1
+        if length > max_segment_size:
+            others.append((start, end))
+            continue
+        if batch and (len(batch) >= max_ranges or batch_size + length > max_batch_size):
+            close_batch()
+            batch, batch_size = [], 0
+        batch.append((start, end))
+        batch_size += length
+    close_batch()
+    return batches, others
+
+
+def get_multipart_boundary(headers):
+    """
+    :param headers: response headers
+    :return: multipart/byteranges的boundary 不是multipart响应时返回None
+    """
+    content_type = headers.get('Content-Type', '')
+    if not content_type.strip().lower().startswith('multipart/byteranges'):
+        return None
+    match = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+
+def parse_content_range(value):
+    """
+    :param value: Content-Range 例如 bytes 0-99/1000 或 bytes 0-99/*
+    :return: (start, end, total) total未知时为-1 无法解析时返回None
+    """
+    match = re.match(r'\s*bytes\s+(\d+)-(\d+)/(\d+|\*)', value or '')
+    if not match:
+        return None
+    total = -1 if match.group(3) == '*' else int(match.group(3))
+    return int(match.group(1)), int(match.group(2)), total
+
+
+class BreakpointFile(object):
+    """
+    文本断点文件 记录数据总长度 远端文件的校验值和已经完成的段
+    格式: data_length[\tETag\tLast-Modified] \n start,end[,crc32] \n start,end[,crc32] \n ...
+    path: 断点文件路径 为空时不记录
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record_data_length(self, data_length, etag=None, last_modified=None):
+        """新下载 重写断点文件 ETag和Last-Modified用于续传时的If-Range"""
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path, 'w') as fd:
+                if etag or last_modified:
+                    fd.write('%s\t%s\t%s\n' % (data_length, etag or '', last_modified or ''))
+                else:
+                    fd.write('%s\n' % data_length)
+
+    def validators(self):
+        """
+        :return: (etag, last_modified) 没有记录时为None
+        """
+        if not self.path or not os.path.exists(self.path):
+            return None, None
+        with open(self.path, 'r') as fd:
+            line = fd.readline()
+        if not line.strip():
+            return None, None
+        return parse_breakpoint_header(line)[1:]
+
+    def record_finished_segment(self, start, end, crc32=None):
+        """追加已完成的段 crc32为段数据的CRC32"""
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path, 'a+') as fd:
+                if crc32 is None:
+                    fd.write('%s,%s\n' % (start, end))
+                else:
+                    fd.write('%s,%s,%08x\n' % (start, end, crc32))
+
+    def segment_digests(self):
+        """
+        :return: {(start, end): crc32}
+        """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        return read_segment_digests(self.path)
+
+    def find_holes(self):
+        """
+        :return: data_length, 未完成的段列表
+        """
+        data_length, segments = read_all_finished_segment_list(self.path)
+        return data_length, find_holes(data_length, segments or [])
+
+    def close(self):
+        pass
+
+
+class BitmapJournal(object):
+    """
+    内存映射的块位图断点文件
+    文件头(HEADER_SIZE字节): magic version 校验值长度 block_size data_length 校验值
+    校验值为ETag 有Last-Modified时为ETag\nLast-Modified
+    位图: 每个块一个字节 0未完成 1已完成
+    每块用一个字节而不是一位 多个线程标记相邻块时不需要读改写 也就不需要加锁
+    段完成时只标记被完整覆盖的块 段边缘不完整的块在续传时重新下载
+    path: 断点文件路径
+    block_size: 块大小
+    sync_interval: 后台批量刷盘间隔(秒)
+    """
+    MAGIC = b'FDBM'
+    VERSION = 1
+    HEADER_FORMAT = '<4sHHqq'
+    HEADER_SIZE = 4096
+    MAX_ETAG_LENGTH = HEADER_SIZE - struct.calcsize(HEADER_FORMAT)
+
+    def __init__(self, path, block_size=1024 * 1024, sync_interval=1.0):
+        self.path = path
+        self.block_size = block_size
+        self.sync_interval = sync_interval
+        self.data_length = -1
+        self.etag = ''
+        self.last_modified = ''
+        self._fd = None
+        self._map = None
+        self._dirty = False
+        # 段边缘只完成了一部分的块 block -> [[start, end], ...]
+        self._partial_blocks = {}
+        self._partial_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._sync_thread = None
+
+    @classmethod
+    def is_bitmap_journal(cls, path):
+        """判断断点文件是否为位图格式"""
+        with open(path, 'rb') as fd:
+            return fd.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def load(cls, path, sync_interval=1.0):
+        """打开已经存在的位图断点文件"""
+        journal = cls(path, sync_interval=sync_interval)
+        journal._open()
+        magic, version, etag_length, journal.block_size, journal.data_length = struct.unpack_from(
+            cls.HEADER_FORMAT, journal._map, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            journal.close()
+            raise ValueError('%s is not a bitmap breakpoint file' % path)
+        etag_offset = struct.calcsize(cls.HEADER_FORMAT)
+        validator = journal._map[etag_offset:etag_offset + etag_length].decode('utf8')
+        journal.etag, _, journal.last_modified = validator.partition('\n')
+        journal._start_sync_thread()
+        return journal
+
+    def block_count(self):
+        if self.data_length <= 0:
+            return 0
+        return (self.data_length + self.block_size - 1) // self.block_size
+
+    def record_data_length(self, data_length, etag=None, last_modified=None):
+        """新下载 重建断点文件"""
+        self.close()
+        self._closed.clear()
+        self.data_length = data_length
+        self.etag = etag or ''
+        self.last_modified = last_modified or ''
+        self._partial_blocks = {}
+        validator = self.etag + '\n' + self.last_modified if self.last_modified else self.etag
+        etag_bytes = validator.encode('utf8')[:self.MAX_ETAG_LENGTH]
+        header = struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, len(etag_bytes), self.block_size,
+                             data_length) + etag_bytes
+        with open(self.path, 'wb') as fd:
+            fd.write(header.ljust(self.HEADER_SIZE, b'\0'))
+            fd.truncate(self.HEADER_SIZE + self.block_count())
+        self._open()
+        self._start_sync_thread()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self._map = mmap.mmap(self._fd, 0)
+
+    def _start_sync_thread(self):
+        if self.sync_interval and self.sync_interval > 0:
+            self._sync_thread = threading.Thread(name='journal-sync', target=self._sync_loop, daemon=True)
+            self._sync_thread.start()
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+    def record_finished_segment(self, start, end, crc32=None):
+        """
+        标记[start, end]完整覆盖的块 无锁 位图不保存段的CRC32
+        段边缘只覆盖了一部分的块在内存中合并 相邻的段把它补齐后再标记
+        """
+        end = min(end, self.data_length - 1)
+        if end < start:
+            return
+        first_block = start // self.block_size
+        last_block = end // self.block_size
+        full_first_block, full_last_block = first_block, last_block
+        for block in sorted({first_block, last_block}):
+            block_start, block_end = self._block_range(block)
+            if start > block_start or end < block_end:
+                if block == first_block:
+                    full_first_block = first_block + 1
+                if block == last_block:
+                    full_last_block = last_block - 1
+                self._record_partial_block(block, max(start, block_start), min(end, block_end))
+        if full_last_block >= full_first_block:
+            self._mark_blocks(full_first_block, full_last_block)
+
+    def _block_range(self, block):
+        block_start = block * self.block_size
+        return block_start, min(block_start + self.block_size, self.data_length) - 1
+
+    def _mark_blocks(self, first_block, last_block):
+        self._map[self.HEADER_SIZE + first_block:self.HEADER_SIZE + last_block + 1] = \
+            b'\1' * (last_block - first_block + 1)
+        self._dirty = True
+
+    def _record_partial_block(self, block, start, end):
+        with self._partial_lock:
+            merged = [start, end]
+            intervals = []
+            for interval in self._partial_blocks.get(block, []):
+                if interval[0] <= merged[1] + 1 and merged[0] <= interval[1] + 1:
+                    merged = [min(merged[0], interval[0]), max(merged[1], interval[1])]
+                else:
+                    intervals.append(interval)
+            if (merged[0], merged[1]) == self._block_range(block):
+                self._partial_blocks.pop(block, None)
+                self._mark_blocks(block, block)
+            else:
+                self._partial_blocks[block] = intervals + [merged]
+
+    def find_holes(self):
+        """
+        用memchr扫描位图找到未完成的块
+        :return: data_length, 未完成的段列表
+        """
+        holes = []
+        begin = self.HEADER_SIZE
+        end = self.HEADER_SIZE + self.block_count()
+        while begin < end:
+            hole_start = self._map.find(b'\0', begin, end)
+            if hole_start < 0:
+                break
+            hole_end = self._map.find(b'\1', hole_start, end)
+            if hole_end < 0:
+                hole_end = end
+            holes.append([(hole_start - self.HEADER_SIZE) * self.block_size,
+                          min((hole_end - self.HEADER_SIZE) * self.block_size, self.data_length) - 1])
+            begin = hole_end
+        return self.data_length, holes
+
+    def segment_digests(self):
+        """位图只记录块状态 没有段的CRC32"""
+        return {}
+
+    def validators(self):
+        """
+        :return: (etag, last_modified) 没有记录时为None
+        """
+        return self.etag or None, self.last_modified or None
+
+    def sync(self):
+        """有更新时刷盘"""
+        if self._dirty and self._map is not None:
+            self._dirty = False
+            self._map.flush()
+
+    def close(self):
+        self._closed.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+            self._sync_thread = None
+        if self._map is not None:
+            self.sync()
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def convert_breakpoint_file(text_path, bitmap_path, block_size=1024 * 1024):
+    """
+    把文本断点文件转换为位图断点文件
+    :param text_path: 文本断点文件
+    :param bitmap_path: 位图断点文件 可以与text_path相同
+    :param block_size: 块大小
+    :return: BitmapJournal 已打开
+    """
+    data_length, segments = read_all_finished_segment_list(text_path)
+    etag, last_modified = BreakpointFile(text_path).validators()
+    temp_path = bitmap_path + '.converting'
+    journal = BitmapJournal(temp_path, block_size=block_size, sync_interval=0)
+    journal.record_data_length(data_length, etag, last_modified)
+    for start, end in segments or []:
+        journal.record_finished_segment(start, end)
+    journal.close()
+    os.replace(temp_path, bitmap_path)
+    return BitmapJournal.load(bitmap_path)
+
+
+def open_breakpoint_journal(path, journal_format='text', block_size=1024 * 1024):
+    """
+    打开已有的断点文件 用于续传
+    :param path: 断点文件路径
+    :param journal_format: text或bitmap 为bitmap时文本断点文件会被转换
+    :param block_size: 转换时的块大小
+    :return: BreakpointFile 或 BitmapJournal
+    """
+    if BitmapJournal.is_bitmap_journal(path):
+        return BitmapJournal.load(path)
+    if journal_format == 'bitmap':
+        return convert_breakpoint_file(path, path, block_size=block_size)
+    return BreakpointFile(path)
+
+
 class OverWriteException(Exception):
     """重复覆盖写"""
     pass
@@ -126,6 +913,277 @@ class FetchHeaderException(Exception):
     pass
 
 
+class EmptyResponseException(Exception):
+    """段请求成功但是没有返回任何数据"""
+    pass
+
+
+class RangeNotSupportedException(Exception):
+    """Range请求返回了完整响应 不能写入段的位置"""
+    pass
+
+
+class ResourceChangedException(Exception):
+    """If-Range与远端文件不匹配 远端文件已经改变"""
+    pass
+
+
+# 探测响应体小于该值时读完响应体 使探测连接可以回到连接池复用
+PROBE_DRAIN_LIMIT = 64 * 1024
+
+
+def release_response(response, drain_limit=PROBE_DRAIN_LIMIT):
+    """
+    释放响应 如果剩余响应体足够小则读完 让keep-alive连接回到连接池 否则直接关闭连接
+    :param response: requests.Response(stream=True)
+    :param drain_limit: 最大读取字节数
+    """
+    try:
+        content_length = get_content_length(response.headers)
+        if 0 <= content_length <= drain_limit:
+            for _ in response.iter_content(chunk_size=8192):
+                pass
+    except Exception:
+        pass
+    finally:
+        response.close()
+
+
+class _ConnectCountingPoolMixin(object):
+    """在连接池新建的连接上挂载回调 每次真正建立TCP(TLS)连接时通知"""
+    def __init__(self, *args, connect_listener=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connect_listener = connect_listener
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        connect = conn.connect
+        listener = self.connect_listener
+
+        def counting_connect():
+            connect()
+            if listener:
+                listener()
+        conn.connect = counting_connect
+        return conn
+
+
+class _CountingHTTPConnectionPool(_ConnectCountingPoolMixin, urllib3.HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_ConnectCountingPoolMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    统计请求数和新建连接(握手)数的HTTPAdapter
+    request_count: 发出的请求数
+    connect_count: 新建连接数 包括连接断开后的重连
+    """
+    def __init__(self, *args, **kwargs):
+        self.request_count = 0
+        self.connect_count = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _on_connect(self):
+        with self._count_lock:
+            self.connect_count += 1
+
+    def _install_counter(self, manager):
+        manager.pool_classes_by_scheme = {
+            'http': functools.partial(_CountingHTTPConnectionPool, connect_listener=self._on_connect),
+            'https': functools.partial(_CountingHTTPSConnectionPool, connect_listener=self._on_connect),
+        }
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._install_counter(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # socks代理有自己的连接池实现 不做统计
+        if not proxy.lower().startswith('socks'):
+            self._install_counter(manager)
+        return manager
+
+    def send(self, request, *args, **kwargs):
+        with self._count_lock:
+            self.request_count += 1
+        return super().send(request, *args, **kwargs)
+
+
+class SessionPool(object):
+    """
+    HTTP Session池 由协调器持有
+    每个工作线程借用一个Session 在多个段和重试之间复用keep-alive连接
+    size: 池中最多的Session数量 一般等于max_thread
+    """
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._idle_sessions = queue.LifoQueue()
+        self._sessions = []
+        self._final_stats = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_session():
+        session = requests.Session()
+        # 每个Session同一时刻只会有一个请求 每个host保留一个连接即可
+        adapter = CountingHTTPAdapter(pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def acquire(self):
+        """借用Session 池已满时阻塞等待归还"""
+        try:
+            return self._idle_sessions.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._sessions) < self.size:
+                session = self._new_session()
+                self._sessions.append(session)
+                return session
+        return self._idle_sessions.get()
+
+    def release(self, session):
+        """归还Session"""
+        self._idle_sessions.put(session)
+
+    @contextlib.contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    @contextlib.contextmanager
+    def dedicated_session(self):
+        """
+        不占用池中名额的Session 用完关闭 计入连接统计
+        用于对冲线程等临时的工作单元 工作线程一直占用池中的Session 借用会等到有工作线程退出
+        """
+        session = self._new_session()
+        with self._lock:
+            self._sessions.append(session)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def stats(self):
+        """
+        连接复用统计
+        :return: dict sessions: Session数 requests: 请求数 connections: 新建连接(握手)数 reused: 复用连接的请求数
+        """
+        with self._lock:
+            if self._final_stats is not None:
+                return dict(self._final_stats)
+            sessions = self._sessions[:]
+        request_count = 0
+        connection_count = 0
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                if isinstance(adapter, CountingHTTPAdapter):
+                    request_count += adapter.request_count
+                    connection_count += adapter.connect_count
+        return {
+            'sessions': len(sessions),
+            'requests': request_count,
+            'connections': connection_count,
+            'reused': max(0, request_count - connection_count),
+        }
+
+    def close(self):
+        """关闭所有Session 关闭后stats()返回关闭前的统计"""
+        stats = self.stats()
+        with self._lock:
+            if self._final_stats is not None:
+                return
+            self._final_stats = stats
+            sessions = self._sessions[:]
+        for session in sessions:
+            session.close()
+
+
+class BufferPool(object):
+    """
+    接收缓冲区池 预分配的bytearray在段下载之间循环使用 避免每个数据块都分配新的bytes
+    buffer_size: 每个缓冲区大小
+    """
+    def __init__(self, buffer_size=256 * 1024):
+        self.buffer_size = buffer_size
+        self._buffers = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self._buffers.get_nowait()
+        except queue.Empty:
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        self._buffers.put(buffer)
+
+    @contextlib.contextmanager
+    def buffer(self):
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
+
+
+def check_range_response(response):
+    """
+    Range请求必须返回206 带If-Range时返回200表示远端文件已经改变
+    :param response: requests.Response
+    """
+    request_headers = response.request.headers if response.request is not None else {}
+    check_range_status(response.url, response.status_code, request_headers)
+
+
+def check_range_status(url, status_code, request_headers, content_range=None, range_start=None):
+    """
+    check_range_response的通用部分 也用于aiohttp等其它客户端的响应
+    :param request_headers: 请求头 没有Range时不检查
+    :param content_range: 响应的Content-Range
+    :param range_start: 设置时Content-Range必须从range_start开始
+    """
+    if 'Range' not in request_headers:
+        return
+    if status_code != 206:
+        if 'If-Range' in request_headers:
+            raise ResourceChangedException('%s changed, If-Range %s does not match' % (url,
+                                                                                      request_headers['If-Range']))
+        raise RangeNotSupportedException('%s returns %s for Range request' % (url, status_code))
+    if range_start is not None:
+        parsed = parse_content_range(content_range)
+        if parsed is None or parsed[0] != range_start:
+            raise RangeNotSupportedException('%s returns Content-Range %s for range starting at %s'
+                                             % (url, content_range, range_start))
+
+
+def get_raw_reader(response):
+    """
+    获取可以直接readinto的底层响应流 绕过urllib3的读取层 避免中间拷贝
+    :param response: requests.Response(stream=True)
+    :return: 有readinto的响应流 响应体有Content-Encoding需要解码时返回None
+    """
+    content_encoding = response.headers.get('Content-Encoding', '').strip().lower()
+    if content_encoding not in ('', 'identity'):
+        return None
+    raw = response.raw
+    reader = getattr(raw, '_fp', None)
+    if reader is None or not hasattr(reader, 'readinto'):
+        reader = raw
+    return reader
+
+
 class SegmentDownloader(object):
     """
     段下载器
@@ -134,14 +1192,49 @@ class SegmentDownloader(object):
     range_start: Range 开始字节
     range_end: Range 结束字节 这里对方服务不一定能够返回到达range_end的数据 如果range_end <= 0表示全文件下载不分段
     range_rel_end: 服务器返回的数据真实end位置
+    session: 复用的requests.Session 为None时每次下载新建Session
+    storage: 共享的FileStorage 为None时自行打开path
+    write_buffer_size: 写入合并缓冲区大小 0表示不合并
+    buffer_pool: 接收缓冲区池 设置后使用readinto直接读入复用的缓冲区 否则使用iter_content
+    rate_limiter: 共享的RateLimiter 每接收一块数据取相应的令牌
+    metrics: Metrics 记录TTFB 段耗时 吞吐 写入延迟 并发出segment_start segment_finish事件
+    checkpoint_size: 每写入该长度的数据刷盘一次并调用checkpoint_callback(start, end, crc32) 0表示不做段内检查点
+    checkpoint_callback: 段内检查点回调 记录已经落盘的部分
+    if_range: Range请求带上的If-Range(强ETag或Last-Modified) 远端文件改变时抛出ResourceChangedException
     request_args: HTTP请求的其它控制参数
     """
-    def __init__(self, path: str, request: requests.Request, range_start: int, range_end: int, **request_args):
+    def __init__(self, path: str, request: requests.Request, range_start: int, range_end: int,
+                 session: requests.Session = None,
+                 storage: FileStorage = None,
+                 write_buffer_size: int = 0,
+                 buffer_pool: BufferPool = None,
+                 rate_limiter: RateLimiter = None,
+                 metrics: Metrics = None,
+                 checkpoint_size: int = 0,
+                 checkpoint_callback=None,
+                 if_range: str = None,
+                 **request_args):
         self.path = path
         self.raw_request = request
         self.range_start = range_start
         self.range_end = range_end
         self.range_real_end = -1
+        self.session = session
+        self.storage = storage
+        self.write_buffer_size = write_buffer_size
+        self.buffer_pool = buffer_pool
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.checkpoint_size = checkpoint_size if checkpoint_callback is not None else 0
+        self.checkpoint_callback = checkpoint_callback
+        # 已经通过take_checkpoint交出的数据的结束位置
+        self.checkpoint_end = range_start - 1
+        self.if_range = if_range
+        self.host = urllib.parse.urlsplit(request.url).netloc
+        self.start_time = None
+        self.ttfb = None
+        # 对冲请求 见HedgedRange
+        self.hedge = None
         self._segment_writer = None
         self.request_args = {}
         self.request_args.update(request_args)
@@ -154,35 +1247,456 @@ class SegmentDownloader(object):
             return 0
         return self.range_real_end - self.range_start + 1
 
-    def download(self):
+    def crc32(self):
+        """
+        :return: 已写入数据[range_start, range_real_end]的CRC32
+        """
+        return 0 if self._segment_writer is None else self._segment_writer.crc32
+
+    def take_checkpoint(self):
+        """
+        交出上一次检查点之后已经写入文件的部分
+        :return: (start, end, crc32) 没有新数据时返回None
+        """
+        writer = self._segment_writer
+        if writer is None:
+            return None
+        end = self.range_start + writer.persisted_length() - 1
+        if end <= self.checkpoint_end:
+            return None
+        start, self.checkpoint_end = self.checkpoint_end + 1, end
+        return start, end, writer.take_piece_crc32()
+
+    def pending_length(self):
+        """已经写入但还没有交出的数据长度"""
+        writer = self._segment_writer
+        if writer is None:
+            return 0
+        return max(0, writer.total_write_data_length() - (self.checkpoint_end - self.range_start + 1))
+
+    def _maybe_checkpoint(self):
+        if not self.checkpoint_size:
+            return
+        writer = self._segment_writer
+        if writer.total_write_data_length() - (self.checkpoint_end - self.range_start + 1) < self.checkpoint_size:
+            return
+        writer.flush()
+        self.storage.checkpoint()
+        piece = self.take_checkpoint()
+        if piece is not None:
+            self.checkpoint_callback(*piece)
+
+    def progress(self):
+        """
+        :return: (已写入长度, 剩余长度) 未开始或不限制长度时剩余长度为0
+        """
+        writer = self._segment_writer
+        if writer is None:
+            return 0, 0
+        return writer.total_write_data_length(), max(0, writer.left_capacity())
+
+    def split(self, min_size):
+        """
+        把剩余区间的后一半让给其它工作线程 本下载器写到前一半结束为止
+        :param min_size: 切分后每一半的最小长度
+        :return: 让出的区间(start, end) 不可切分时返回None
+        """
+        writer = self._segment_writer
+        if writer is None or self.range_end <= 0:
+            return None
+        task = writer.split(min_size)
+        if task is not None:
+            self.range_end = task[0] - 1
+        return task
+
+    def seal(self):
+        """
+        下载结束 之后不再切分
+        :return: 最终的Range结束字节 包括下载过程中被切走的部分
+        """
+        writer = self._segment_writer
+        if writer is None or self.range_end <= 0:
+            return self.range_end
+        return writer.seal()
+
+    def start_hedge(self, min_size):
+        """
+        :return: 对冲请求的区间(start, end) 还没有收到响应 不限制长度或者剩余太少时返回None
+        """
+        writer = self._segment_writer
+        if writer is None or self.range_end <= 0:
+            return None
+        return writer.start_hedge(min_size)
+
+    def cut(self, position):
+        """见SegmentWriter.cut"""
+        writer = self._segment_writer
+        return None if writer is None else writer.cut(position)
+
+    def _throttle(self, length):
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(self.host, length)
+
+    @contextlib.contextmanager
+    def _open_session(self):
+        if self.session is not None:
+            yield self.session
+            return
+        with requests.Session() as session:
+            yield session
+
+    def _prepare_range_request(self, range_value):
+        req = self.raw_request.prepare()
+        req.headers['Range'] = range_value
+        if self.if_range:
+            req.headers['If-Range'] = self.if_range
+        return req
+
+    def download(self, response=None):
+        """
+        :param response: 已经发出的请求的响应 例如探测请求 为None时发送请求
+        """
+        self.start_time = time.monotonic()
         try:
-            self._segment_writer = SegmentWriter(self.path,
-                                                 self.range_start,
-                                                 0 if self.range_end <= 0 else (self.range_end - self.range_start + 1)
-                                                 )
-            with requests.Session() as session:
-                req = self.raw_request.prepare()
+            if response is not None:
+                self.ttfb = response.elapsed.total_seconds()
+                with response:
+                    self.receive(response)
+                return
+            with self._open_session() as session:
                 if self.range_end > 0:
-                    req.headers['Range'] = 'bytes=%s-%s' % (self.range_start, self.range_end)
+                    req = self._prepare_range_request('bytes=%s-%s' % (self.range_start, self.range_end))
+                else:
+                    req = self.raw_request.prepare()
                 self.request_args['stream'] = True
                 with session.send(req, **self.request_args) as res:
-                    content_range = res.headers.get('Content-Range')
-                    std_log('start request for range %s' % content_range)
-                    for chunk in res.iter_content(chunk_size=8192):
-                        if chunk is None:
-                            break
-                        chunk_size = len(chunk)
-                        # 如果返回的数据比预设的数据要多 那么截断 不继续下载
-                        if self.range_end > 0 and chunk_size > self._segment_writer.left_capacity():
-                            self._segment_writer.write(chunk[:self._segment_writer.left_capacity()])
-                            break
-                        else:
-                            self._segment_writer.write(chunk)
-                self.range_real_end = self.range_start + self._segment_writer.total_write_data_length() - 1
+                    self.ttfb = time.monotonic() - self.start_time
+                    self.receive(res)
         finally:
-            if self._segment_writer:
+            self._report_finish()
+
+    def _report_finish(self):
+        debug_log('finish range %s-%s' % (self.range_start, self.range_real_end))
+        if self.metrics is None:
+            return
+        duration = time.monotonic() - self.start_time
+        length = self.total_downloaded_data_length()
+        self.metrics.inc('requests_total')
+        self.metrics.inc('bytes_total', length)
+        if self.ttfb is not None:
+            self.metrics.observe('ttfb_seconds', self.ttfb)
+        self.metrics.observe('segment_duration_seconds', duration)
+        if duration > 0 and length > 0:
+            self.metrics.observe('segment_throughput_bytes_per_second', length / duration,
+                                 buckets=Metrics.BYTES_PER_SECOND_BUCKETS)
+            self.metrics.set_gauge('worker_throughput_bytes_per_second', length / duration,
+                                   worker=threading.current_thread().name)
+        self.metrics.emit('segment_finish', start=self.range_start, end=self.range_real_end,
+                          requested_end=self.range_end, bytes=length, duration=duration, ttfb=self.ttfb)
+
+    def receive(self, res):
+        """
+        将响应体写入段 也可以用于已经发出的请求 例如探测请求的响应
+        :param res: requests.Response(stream=True)
+        """
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        # 错误响应(404 429 503等)不能当作数据写入文件
+        res.raise_for_status()
+        if self.range_end > 0:
+            check_range_response(res)
+        debug_log('start request for range %s' % res.headers.get('Content-Range'))
+        if self.metrics is not None:
+            self.metrics.emit('segment_start', start=self.range_start, end=self.range_end,
+                              status=res.status_code, ttfb=self.ttfb)
+        self._segment_writer = SegmentWriter(self.path,
+                                             self.range_start,
+                                             0 if self.range_end <= 0 else (self.range_end - self.range_start + 1),
+                                             storage=self.storage,
+                                             buffer_size=self.write_buffer_size,
+                                             metrics=self.metrics
+                                             )
+        try:
+            reader = get_raw_reader(res) if self.buffer_pool is not None else None
+            if reader is None:
+                self._receive_by_iter_content(res)
+            else:
+                self._receive_by_readinto(res, reader)
+        finally:
+            try:
+                self._segment_writer.close()
+            finally:
+                # 出错时也记录已经写入文件的位置 重试时从这里继续
+                self.range_real_end = self.range_start + self._segment_writer.persisted_length() - 1
+
+    def _receive_by_iter_content(self, res):
+        self._receive_chunks(res.iter_content(chunk_size=8192))
+
+    def _receive_chunks(self, chunks):
+        for chunk in chunks:
+            if chunk is None:
+                break
+            self._throttle(len(chunk))
+            # 如果返回的数据比预设的数据要多(或者段被切分) 那么截断 不继续下载
+            if self.range_end > 0:
+                self._segment_writer.write_capped(chunk)
+                self._maybe_checkpoint()
+                if self._segment_writer.left_capacity() <= 0:
+                    break
+            else:
+                self._segment_writer.write(chunk)
+
+    def _receive_by_readinto(self, res, reader):
+        with self.buffer_pool.buffer() as buffer:
+            view = memoryview(buffer)
+            while True:
+                read_size = len(view)
+                if self.range_end > 0:
+                    # 最多只读到段末尾 不需要截断
+                    read_size = min(read_size, self._segment_writer.left_capacity())
+                    if read_size <= 0:
+                        break
+                read_length = reader.readinto(view[:read_size])
+                if not read_length:
+                    break
+                self._throttle(read_length)
+                if self.range_end > 0:
+                    # 读取期间段可能被切分
+                    self._segment_writer.write_capped(view[:read_length])
+                    self._maybe_checkpoint()
+                else:
+                    self._segment_writer.write(view[:read_length])
+        # 直接读取底层流时urllib3不知道响应体已经读完 读完后主动归还连接
+        if reader is not res.raw and reader.isclosed():
+            res.raw.release_conn()
+
+
+class _StreamReader(object):
+    """在urllib3原始响应上提供按行读取和定长读取 throttle(length)在每次读取后调用"""
+    def __init__(self, raw, chunk_size=64 * 1024, throttle=None):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self._buffer = bytearray()
+
+    def _fill(self):
+        data = self.raw.read(self.chunk_size, decode_content=True)
+        if not data:
+            raise EOFError('response ended unexpectedly')
+        if self.throttle:
+            self.throttle(len(data))
+        self._buffer += data
+
+    def readline(self):
+        while True:
+            index = self._buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self._buffer[:index + 1])
+                del self._buffer[:index + 1]
+                return line
+            self._fill()
+
+    def read_chunks(self, length):
+        """按块读取length字节"""
+        while length > 0:
+            if not self._buffer:
+                self._fill()
+            chunk = bytes(self._buffer[:length])
+            del self._buffer[:len(chunk)]
+            length -= len(chunk)
+            yield chunk
+
+
+class MultiRangeDownloader(SegmentDownloader):
+    """
+    一次请求下载多个小段 Range: bytes=a-b,c-d,...
+    服务端返回multipart/byteranges时流式解析 每个part写到对应的文件偏移
+    服务端把多个区间合并成一个206响应时 只写入请求的区间
+    服务端返回200完整响应时不写入任何数据 multipart为False 由调用方逐段下载 带If-Range时抛出ResourceChangedException
+    ranges: [(start, end), ...]
+    """
+    def __init__(self, path: str, request: requests.Request, ranges, **kwargs):
+        super().__init__(path, request, ranges[0][0], ranges[-1][1], **kwargs)
+        self.ranges = list(ranges)
+        self.finished_ranges = []
+        # 与finished_ranges一一对应
+        self.finished_digests = []
+        self.multipart = None
+
+    def total_downloaded_data_length(self):
+        return sum(end - start + 1 for start, end in self.finished_ranges)
+
+    def unfinished_ranges(self):
+        return subtract_segments(self.ranges, self.finished_ranges)
+
+    def download(self):
+        self.start_time = time.monotonic()
+        try:
+            with self._open_session() as session:
+                req = self._prepare_range_request(
+                    'bytes=%s' % ','.join('%s-%s' % (start, end) for start, end in self.ranges))
+                self.request_args['stream'] = True
+                with session.send(req, **self.request_args) as res:
+                    self.ttfb = time.monotonic() - self.start_time
+                    res.raise_for_status()
+                    if res.status_code != 206 and self.if_range:
+                        check_range_response(res)
+                    if res.status_code != 206:
+                        self.multipart = False
+                        return
+                    self.multipart = True
+                    reader = _StreamReader(res.raw, throttle=self._throttle)
+                    boundary = get_multipart_boundary(res.headers)
+                    if boundary is None:
+                        content_range = parse_content_range(res.headers.get('Content-Range'))
+                        if content_range is None:
+                            raise FetchHeaderException('206 response without Content-Range')
+                        self._receive_part(reader, content_range[0], content_range[1])
+                    else:
+                        self._receive_multipart(reader, boundary.encode('latin-1'))
+        finally:
+            self._report_finish()
+
+    def _receive_multipart(self, reader, boundary):
+        delimiter = b'--' + boundary
+        while True:
+            line = reader.readline().strip()
+            if line == delimiter + b'--':
+                return
+            if line != delimiter:
+                # preamble 或者part之间的CRLF
+                continue
+            headers = {}
+            while True:
+                header_line = reader.readline().strip()
+                if not header_line:
+                    break
+                key, _, value = header_line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            content_range = parse_content_range(headers.get('content-range'))
+            if content_range is None:
+                raise FetchHeaderException('multipart part without Content-Range')
+            self._receive_part(reader, content_range[0], content_range[1])
+
+    def _receive_part(self, reader, part_start, part_end):
+        """只写入part与请求区间相交的部分 其余数据丢弃"""
+        position = part_start
+        targets = [(max(start, part_start), min(end, part_end)) for start, end in self.ranges
+                   if start <= part_end and end >= part_start]
+        for target_start, target_end in targets:
+            for _ in reader.read_chunks(target_start - position):
+                pass
+            writer = SegmentWriter(self.path, target_start, target_end - target_start + 1,
+                                   storage=self.storage, buffer_size=self.write_buffer_size, metrics=self.metrics)
+            try:
+                for chunk in reader.read_chunks(target_end - target_start + 1):
+                    writer.write(chunk)
+            finally:
+                writer.close()
+            self.finished_ranges.append((target_start, target_end))
+            self.finished_digests.append(writer.crc32)
+            position = target_end + 1
+        for _ in reader.read_chunks(part_end + 1 - position):
+            pass
+
+
+class HedgedRange(object):
+    """
+    在途段与对冲请求之间的竞争 两者请求同一剩余区间[start, end] 先到达的一方写入 不会重复写同一字节
+    对冲请求收到原下载器还没有写到的数据时 原下载器停在当前写入位置(cut_at) 之后由对冲请求写入
+    原下载器先写完时取消对冲请求 原下载器提前结束时把cut_at之后的部分交给对冲请求
+    downloader: 原来的SegmentDownloader
+    cancelled: 设置后对冲请求停止接收
+    """
+    def __init__(self, downloader, start, end):
+        self.downloader = downloader
+        self.start = start
+        self.end = end
+        self.cut_at = None
+        self.closed = False
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def take_over(self, position):
+        """
+        对冲请求已经收到position之前的数据时调用
+        :return: 对冲请求开始写入的位置 原下载器仍然领先时返回None
+        """
+        with self._lock:
+            if self.cut_at is None and not self.cancelled.is_set():
+                self.cut_at = self.downloader.cut(position)
+            if self.cut_at is not None and self.cut_at < position:
+                return self.cut_at
+            return None
+
+    def release(self):
+        """
+        原下载器结束时调用 写入器已经关闭
+        :return: 原下载器负责的区间结束位置
+        """
+        with self._lock:
+            if self.cut_at is None:
+                written_end = self.downloader.range_real_end
+                if self.closed or written_end >= self.end:
+                    self.cancelled.set()
+                    return self.end
+                self.cut_at = written_end + 1
+            return self.cut_at - 1
+
+    def close(self):
+        """
+        对冲请求结束时调用
+        :return: 对冲请求负责的区间开始位置 原下载器负责全部区间时返回None
+        """
+        with self._lock:
+            self.closed = True
+            return self.cut_at
+
+
+class HedgeDownloader(SegmentDownloader):
+    """
+    对冲请求 用新的连接请求HedgedRange的剩余区间
+    接管之前收到的数据只计入限速 不写入文件 接管之后从cut_at开始写入
+    """
+    def __init__(self, path: str, request: requests.Request, hedge: HedgedRange, **kwargs):
+        kwargs.update(session=None, buffer_pool=None)
+        super().__init__(path, request, hedge.start, hedge.end, **kwargs)
+        self.hedge = hedge
+
+    def receive(self, res):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        res.raise_for_status()
+        check_range_response(res)
+        chunks = res.iter_content(chunk_size=8192)
+        position = self.range_start
+        for chunk in chunks:
+            if self.hedge.cancelled.is_set():
+                return
+            if not chunk:
+                continue
+            cut_at = self.hedge.take_over(position + len(chunk))
+            if cut_at is not None:
+                break
+            self._throttle(len(chunk))
+            position += len(chunk)
+        else:
+            return
+        debug_log('hedged request takes over range %s-%s' % (cut_at, self.range_end))
+        self.range_start = cut_at
+        self.checkpoint_end = cut_at - 1
+        self._segment_writer = SegmentWriter(self.path, cut_at, self.range_end - cut_at + 1,
+                                             storage=self.storage,
+                                             buffer_size=self.write_buffer_size,
+                                             metrics=self.metrics
+                                             )
+        try:
+            self._receive_chunks(itertools.chain([chunk[cut_at - position:]], chunks))
+        finally:
+            try:
                 self._segment_writer.close()
-            std_log('finish range %s-%s' % (self.range_start, self.range_real_end))
+            finally:
+                self.range_real_end = self.range_start + self._segment_writer.persisted_length() - 1
 
 
 class SegmentWriter(object):
@@ -191,24 +1705,143 @@ class SegmentWriter(object):
     path: 文件目录
     seek_offset: 文件写入的初始offset
     length: 需要写入的数据长度 如果小于等于0 则标识从seek_offset开始追加往后写并不控制大小
+    storage: 共享的FileStorage 为None时自行打开path 并在close时关闭
+    buffer_size: 写入合并缓冲区大小 小块数据先合并到缓冲区 满了再一次写入 0表示不合并
+    metrics: Metrics 设置后记录每次写盘的延迟
+    crc32: 已写入文件的数据的CRC32
     """
-    def __init__(self, path, seek_offset, length):
-        self.writer = open(path, 'r+b')
-        self.writer.seek(seek_offset)
+    def __init__(self, path, seek_offset, length, storage=None, buffer_size=0, metrics=None):
+        self._own_storage = storage is None
+        self.storage = FileStorage(path, fsync_policy=FileStorage.FSYNC_NONE) if storage is None else storage
         self.seek_offset = seek_offset
         self.offset = seek_offset
         self.length = length
         self.limit = 0 if self.length <= 0 else (self.offset + length - 1)
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.crc32 = 0
+        # 上一次take_piece_crc32之后写入文件的数据的CRC32
+        self._piece_crc32 = 0
+        self._buffer = bytearray()
+        # 保护limit 写入和split可能在不同线程
+        self._limit_lock = threading.Lock()
+        # 已经有对冲请求 不再切分
+        self._hedged = False
+        # 下载已经结束 不再切分
+        self._sealed = False
 
     def write(self, data):
         if data is None:
             return
-        if self.length > 0 and self.offset + len(data) - 1 > self.limit:
-            raise OverWriteException('write to much data, cur offset %s, limit %s, prepare to write data length %s' %
-                               (self.offset, self.limit, len(data)))
-        self.writer.write(data)
-        self.writer.flush()
-        self.offset = self.writer.tell()
+        with self._limit_lock:
+            if self.length > 0 and self.offset + len(data) - 1 > self.limit:
+                raise OverWriteException('write to much data, cur offset %s, limit %s, prepare to write data length %s'
+                                         % (self.offset, self.limit, len(data)))
+            self._write(data)
+
+    def write_capped(self, data):
+        """
+        写入数据 超出limit的部分丢弃
+        :return: 实际写入的长度
+        """
+        with self._limit_lock:
+            if self.limit != 0 and len(data) > self.left_capacity():
+                data = data[:max(0, self.left_capacity())]
+            self._write(data)
+            return len(data)
+
+    def split(self, min_size):
+        """
+        把剩余可写区间的后一半让出 自身limit缩小到前一半
+        :param min_size: 切分后每一半的最小长度
+        :return: 让出的区间(start, end) 不可切分时返回None
+        """
+        with self._limit_lock:
+            if self.limit == 0 or self._hedged or self._sealed:
+                return None
+            remaining = self.left_capacity()
+            if remaining < 2 * min_size:
+                return None
+            old_limit = self.limit
+            self.limit = self.offset + remaining // 2 - 1
+            self.length = self.limit - self.seek_offset + 1
+            return self.limit + 1, old_limit
+
+    def seal(self):
+        """
+        下载结束 之后不再切分
+        :return: 最终的limit 与已经完成的split一致
+        """
+        with self._limit_lock:
+            self._sealed = True
+            return self.limit
+
+    def start_hedge(self, min_size):
+        """
+        为剩余区间发出对冲请求 之后不再切分
+        :param min_size: 剩余长度小于该值时不对冲
+        :return: 剩余区间(start, end) 不能对冲时返回None
+        """
+        with self._limit_lock:
+            # offset大于1时cut之后的limit不会变成0(不限制)
+            if self.limit == 0 or self._hedged or self.offset <= 1 or self.left_capacity() < min_size:
+                return None
+            self._hedged = True
+            return self.offset, self.limit
+
+    def cut(self, position):
+        """
+        对冲请求已经收到position之前的数据 本写入器还没有写到position时停在当前位置 之后的数据由对冲请求写入
+        :return: 停止的位置 已经写到position或者已经写完时返回None
+        """
+        with self._limit_lock:
+            if self.left_capacity() <= 0 or self.offset >= position:
+                return None
+            self.limit = self.offset - 1
+            self.length = self.limit - self.seek_offset + 1
+            return self.offset
+
+    def _write(self, data):
+        data_length = len(data)
+        if self._buffer and len(self._buffer) + data_length > self.buffer_size:
+            self.flush()
+        if data_length >= self.buffer_size:
+            # 大块数据直接写入 不经过缓冲区
+            self._pwrite(data, self.offset)
+        else:
+            self._buffer += data
+        self.offset += data_length
+        if self._buffer and len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """将缓冲区数据写入文件"""
+        if not self._buffer:
+            return
+        self._pwrite(self._buffer, self.offset - len(self._buffer))
+        del self._buffer[:]
+
+    def _pwrite(self, data, offset):
+        if self.metrics is None:
+            self.storage.pwrite(data, offset)
+        else:
+            begin = time.perf_counter()
+            self.storage.pwrite(data, offset)
+            self.metrics.observe('write_latency_seconds', time.perf_counter() - begin)
+        # 按偏移顺序写入 写入成功后才计入CRC 与persisted_length一致
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self._piece_crc32 = zlib.crc32(data, self._piece_crc32)
+
+    def persisted_length(self):
+        """已经写入文件的数据长度 不包括缓冲区中的数据"""
+        return self.offset - len(self._buffer) - self.seek_offset
+
+    def take_piece_crc32(self):
+        """
+        :return: 上一次调用之后写入文件的数据的CRC32
+        """
+        crc, self._piece_crc32 = self._piece_crc32, 0
+        return crc
 
     def total_write_data_length(self):
         """已经写入的总数据长度"""
@@ -219,7 +1852,317 @@ class SegmentWriter(object):
         return 0 if self.limit == 0 else (self.limit - self.offset + 1)
 
     def close(self):
-        self.writer.close()
+        try:
+            self.flush()
+        finally:
+            if self._own_storage:
+                self.storage.close()
+
+
+class AdaptiveTuner(object):
+    """
+    根据实测吞吐自适应调整并发连接数和段大小
+    并发数按AIMD调整: 每个周期加一个连接 直到新增连接不再带来吞吐提升 出现错误或者429/503时减半
+    段大小按单连接吞吐和时延计算 让每个请求持续足够多个RTT 使TCP窗口能够增长到稳定值
+    min_thread: 最小并发数
+    max_thread: 最大并发数
+    initial_thread: 初始并发数
+    min_gain: 新增连接带来的吞吐提升低于该比例时认为不再有效
+    min_segment_size: 最小段大小
+    max_segment_size: 最大段大小
+    rtt_rounds: 每个请求至少持续的RTT数
+    min_request_duration: 每个请求至少持续的秒数
+    reprobe_rounds: 并发数稳定多少个周期后重新尝试增加
+    """
+    THROTTLE_STATUS = (429, 503)
+
+    def __init__(self, min_thread=1, max_thread=32, initial_thread=2, min_gain=0.05,
+                 min_segment_size=256 * 1024, max_segment_size=64 * 1024 * 1024,
+                 rtt_rounds=64, min_request_duration=1.0, reprobe_rounds=10):
+        self.min_thread = max(1, min_thread)
+        self.max_thread = max(self.min_thread, max_thread)
+        self.target_thread = min(max(initial_thread, self.min_thread), self.max_thread)
+        self.min_gain = min_gain
+        self.min_segment_size = min_segment_size
+        self.max_segment_size = max_segment_size
+        self.rtt_rounds = rtt_rounds
+        self.min_request_duration = min_request_duration
+        self.reprobe_rounds = reprobe_rounds
+        self.history = []
+        self._ceiling = self.max_thread
+        self._stable_rounds = 0
+        self._rate_before_increase = None
+        self._error_count = 0
+        self._throttle_count = 0
+        self._min_rtt = None
+        self._lock = threading.Lock()
+
+    def record_error(self, error):
+        """记录一次段下载错误 429/503视为服务端限流"""
+        response = getattr(error, 'response', None)
+        with self._lock:
+            if response is not None and response.status_code in self.THROTTLE_STATUS:
+                self._throttle_count += 1
+            else:
+                self._error_count += 1
+
+    def record_ttfb(self, seconds):
+        """记录首字节时间 取最小值近似RTT"""
+        if seconds is None or seconds <= 0:
+            return
+        with self._lock:
+            if self._min_rtt is None or seconds < self._min_rtt:
+                self._min_rtt = seconds
+
+    def segment_size(self, rate, active_thread):
+        """
+        :param rate: 总吞吐 bytes/s
+        :param active_thread: 当前并发数
+        :return: 建议段大小
+        """
+        with self._lock:
+            rtt = self._min_rtt or 0
+        per_connection_rate = rate / max(1, active_thread)
+        duration = max(self.min_request_duration, self.rtt_rounds * rtt)
+        return int(min(self.max_segment_size, max(self.min_segment_size, per_connection_rate * duration)))
+
+    def update(self, rate, active_thread):
+        """
+        每个周期调用一次
+        :param rate: 本周期总吞吐 bytes/s
+        :param active_thread: 当前并发数
+        :return: 新的目标并发数
+        """
+        with self._lock:
+            error_count, self._error_count = self._error_count, 0
+            throttle_count, self._throttle_count = self._throttle_count, 0
+        target = self.target_thread
+        if throttle_count or error_count:
+            # 乘性减
+            target = max(self.min_thread, target // 2)
+            self._ceiling = target
+            self._rate_before_increase = None
+            self._stable_rounds = 0
+        elif self._rate_before_increase is not None and rate < self._rate_before_increase * (1 + self.min_gain):
+            # 新增的连接没有带来提升 回退并停止增长
+            target = max(self.min_thread, target - 1)
+            self._ceiling = target
+            self._rate_before_increase = None
+            self._stable_rounds = 0
+        elif target < self._ceiling and active_thread >= target:
+            # 加性增
+            self._rate_before_increase = rate
+            target += 1
+        else:
+            self._rate_before_increase = None
+            self._stable_rounds += 1
+            if self._stable_rounds >= self.reprobe_rounds:
+                # 网络状况可能变化 重新探测
+                self._ceiling = self.max_thread
+                self._stable_rounds = 0
+        self.target_thread = min(target, self.max_thread)
+        self.history.append({
+            'time': round(time.time(), 3),
+            'threads': active_thread,
+            'rate': int(rate),
+            'errors': error_count,
+            'throttles': throttle_count,
+            'target_threads': self.target_thread,
+        })
+        return self.target_thread
+
+    def summary(self, segment_size):
+        """调整结果 可以保存下来作为下次的-T -s参数"""
+        best = max(self.history, key=lambda item: item['rate']) if self.history else None
+        return {
+            'threads': best['threads'] if best else self.target_thread,
+            'segment_size': segment_size,
+            'rtt': self._min_rtt,
+            'curve': self.history,
+        }
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After 秒数或者HTTP日期
+    :return: 等待秒数 无法解析时返回None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_time is None:
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+def get_error_response(error):
+    """
+    :return: 异常携带的HTTP响应 没有时返回None
+    """
+    return getattr(error, 'response', None)
+
+
+class RetryPolicy(object):
+    """
+    段下载失败后的重试策略
+    致命错误(例如404 403 416)不重试 其它错误按指数退避加随机抖动(full jitter)等待后重试
+    响应带Retry-After时(429 503等)至少等待Retry-After
+    base_delay: 第一次重试的最大等待时间(秒)
+    max_delay: 退避等待上限(秒)
+    max_retry_after: Retry-After上限(秒)
+    fatal_statuses: 不重试的HTTP状态码
+    """
+    FATAL_STATUSES = frozenset((400, 401, 403, 404, 405, 410, 411, 413, 414, 416, 451))
+    FATAL_EXCEPTIONS = (OverWriteException, RangeNotSupportedException, ResourceChangedException,
+                        requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema,
+                        requests.exceptions.MissingSchema, requests.exceptions.InvalidHeader)
+
+    def __init__(self, base_delay=0.5, max_delay=30.0, max_retry_after=300.0, fatal_statuses=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.fatal_statuses = self.FATAL_STATUSES if fatal_statuses is None else frozenset(fatal_statuses)
+
+    def is_fatal(self, error):
+        if isinstance(error, self.FATAL_EXCEPTIONS):
+            return True
+        response = get_error_response(error)
+        return response is not None and response.status_code in self.fatal_statuses
+
+    def delay(self, attempt, error=None):
+        """
+        :param attempt: 连续失败次数 从1开始
+        :param error: 本次失败的异常
+        :return: 重试前等待的秒数
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        response = get_error_response(error)
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+def normalize_etag(etag):
+    """去掉弱校验前缀W/ 不同CDN对同一内容可能返回强弱不同的ETag"""
+    if not etag:
+        return None
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+class MirrorSource(object):
+    """
+    一个下载源
+    request: requests请求
+    rate: 吞吐的EWMA(bytes/s) 未测量时为0
+    """
+    def __init__(self, request):
+        self.request = request
+        self.rate = 0.0
+        self.inflight = 0
+        self.successes = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.downloaded_bytes = 0
+        self.dropped = False
+
+    def error_rate(self):
+        return self.errors / (self.successes + self.errors + 1)
+
+    def stats(self):
+        return {
+            'url': self.request.url,
+            'rate': self.rate,
+            'downloaded_bytes': self.downloaded_bytes,
+            'successes': self.successes,
+            'errors': self.errors,
+            'dropped': self.dropped,
+        }
+
+
+class SourceSelector(object):
+    """
+    多个等价下载源之间分配段
+    每次选择(在途段数+1)/有效吞吐最小的源 有效吞吐为实测吞吐乘以(1-错误率) 段按源的速度比例分配
+    未测量的源按当前最快的源估算 保证每个源都会被尝试
+    连续失败max_consecutive_errors次的源被丢弃 最后一个源不会被丢弃
+    requests: requests.Request列表
+    alpha: 吞吐EWMA平滑系数
+    """
+    def __init__(self, requests_list, max_consecutive_errors=3, alpha=0.3):
+        self.sources = [MirrorSource(request) for request in requests_list]
+        self.max_consecutive_errors = max_consecutive_errors
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def alive_sources(self):
+        with self._lock:
+            return [source for source in self.sources if not source.dropped]
+
+    def drop(self, source, reason):
+        """
+        丢弃源
+        :return: 是否丢弃 最后一个源不会被丢弃
+        """
+        with self._lock:
+            return self._drop(source, reason)
+
+    def _drop(self, source, reason):
+        if source.dropped or sum(1 for item in self.sources if not item.dropped) <= 1:
+            return False
+        source.dropped = True
+        std_log('drop source %s, %s' % (source.request.url, reason))
+        return True
+
+    def acquire(self, source=None):
+        """
+        选择一个源 在途段数加一
+        :param source: 指定使用的源 例如探测请求的源
+        """
+        with self._lock:
+            if source is not None:
+                source.inflight += 1
+                return source
+            alive = [source for source in self.sources if not source.dropped]
+            default_rate = max([source.rate for source in alive] + [1.0])
+
+            def cost(source):
+                rate = source.rate or default_rate
+                return (source.inflight + 1) / (rate * (1 - source.error_rate()))
+
+            source = min(alive, key=cost)
+            source.inflight += 1
+            return source
+
+    def record_success(self, source, length, seconds):
+        with self._lock:
+            source.inflight -= 1
+            source.successes += 1
+            source.consecutive_errors = 0
+            source.downloaded_bytes += length
+            if length > 0 and seconds > 0:
+                rate = length / seconds
+                source.rate = rate if source.rate == 0 else self.alpha * rate + (1 - self.alpha) * source.rate
+
+    def record_error(self, source):
+        with self._lock:
+            source.inflight -= 1
+            source.errors += 1
+            source.consecutive_errors += 1
+            if source.consecutive_errors >= self.max_consecutive_errors:
+                self._drop(source, '%s consecutive errors' % source.consecutive_errors)
+
+    def stats(self):
+        with self._lock:
+            return [source.stats() for source in self.sources]
 
 
 class DownloaderCoordinator(object):
@@ -228,23 +2171,95 @@ class DownloaderCoordinator(object):
     发送请求判定是否支持分段下载
     制定下载计划
     byte缺失段查漏补缺
-    path: 文件存储路径
-    request: requests请求
+    path: 文件存储路径 设置sink时可以为None
+    request: requests请求 也可以是多个等价源(镜像)的请求列表 见SourceSelector
     request_ctl_args: 请求其它参数 比如 timeout proxies 等
     max_thread: 最大线程数
-    force_segment: 是否强制分段下载
+    force_segment: 兼容参数 不论取值 探测请求返回206即说明支持Range 不论是否有Accept-Ranges都按长度发现和分段计划下载
+                   探测返回200完整响应(包括chunked)时单连接下载
     segment_size: 每段大小
     max_error_retry: 最段大重试下载次数
     finished_segment_file: 用来存储已经完成的段 data_length \n segment[start, end] \n segment \n ...
+    write_buffer_size: 每个工作线程的写入合并缓冲区大小
+    fsync_policy: 持久化策略 见FileStorage
+    zero_copy_receive: 是否用readinto把数据直接读入复用的接收缓冲区
+    receive_buffer_size: 接收缓冲区大小
+    work_stealing: 工作线程空闲时是否切分预计最晚完成的在途段 把后一半接过来下载
+    min_steal_size: 切分后每一半的最小长度
+    auto_tune: 是否根据实测吞吐自动调整并发数(不超过max_thread)和段大小 见AdaptiveTuner
+    tune_interval: 自动调整周期(秒)
+    tune_log_file: 自动调整结束后把选定的参数和吞吐曲线以JSON写入该文件
+    breakpoint_journal: 断点记录 BreakpointFile或BitmapJournal 设置后不再使用finished_segment_file
+    multi_range: 断点续传时是否把相邻的小空洞合并为一个multi-range请求 服务端不支持时退回逐段请求
+    multi_range_max_hole: 不超过该长度的空洞才参与合并
+    max_ranges_per_request: 每个multi-range请求最多的区间数
+    verify_resume: 续传时抽查多少个已完成段的CRC32 不匹配的段重新下载 0不抽查 小于0全部检查
+    verify_digest: 下载结束后校验文件 并行检查所有段的CRC32 有期望摘要时再校验整个文件
+    expected_digest: 期望的文件摘要 algorithm:hexdigest 为空时使用响应头Digest/Content-MD5
+    rate_limiter: 带宽限速 见RateLimiter 可以在多个下载之间共享 下载过程中可以调整速率
+    metrics: Metrics 记录请求和写盘指标 重试按异常类型计数 可以注册事件回调 为None且设置metrics_file时自动创建
+    metrics_file: 定期把指标快照写入该文件
+    metrics_format: 快照格式 json或prometheus
+    metrics_interval: 快照间隔(秒)
+    progress_interval: 进度输出间隔(秒) 输出EWMA速度和预计剩余时间 0不输出
+    max_source_errors: 多源下载时 一个源连续失败多少次后不再使用
+    retry_policy: 重试策略 见RetryPolicy 遇到致命错误(例如404)时停止整个下载 future抛出该错误
+    checkpoint_size: 段内检查点间隔 大段每写入该长度就刷盘并记录到断点文件 0表示只在段结束时记录
+    max_restarts: 远端文件改变(If-Range不匹配)时最多从头重新下载的次数
+    hedging: 是否对冲慢速段 在途段吞吐持续低于中位数时用新的连接请求其剩余区间 先到达的一方写入 见HedgedRange
+    hedge_ratio: 吞吐低于所有在途段和最近完成段中位数的该比例时视为慢速
+    hedge_delay: 持续慢速多少秒后发出对冲请求
+    hedge_interval: 检查吞吐的周期(秒)
+    max_hedges: 同时进行的对冲请求上限
+    hedge_min_size: 剩余区间小于该长度时不对冲
+    sink: 写入目标 见DownloadSink 默认为FileSink(path) start()返回的Future的结果为sink.finalize()的返回值
+        有失败的段时调用sink.abort() 结果为False
+    探测请求只请求前segment_size字节 响应体直接作为第一段 ETag和Last-Modified记录在断点文件中
+    之后的段请求带If-Range 远端文件改变时停止所有段 从头重新下载
     """
 
-    def __init__(self, path: str, request: requests.Request, request_ctl_args: dict, max_thread: int = 5,
+    def __init__(self, path: str, request, request_ctl_args: dict, max_thread: int = 5,
                  force_segment: bool = True,
                  segment_size: int = 5 * 1024 * 1024,
                  max_error_retry:int = 10,
-                 finished_segment_file=None):
+                 finished_segment_file=None,
+                 write_buffer_size: int = 256 * 1024,
+                 fsync_policy: str = FileStorage.FSYNC_CLOSE,
+                 zero_copy_receive: bool = False,
+                 receive_buffer_size: int = 256 * 1024,
+                 work_stealing: bool = True,
+                 min_steal_size: int = 1024 * 1024,
+                 auto_tune: bool = False,
+                 tune_interval: float = 1.0,
+                 tune_log_file: str = None,
+                 breakpoint_journal=None,
+                 multi_range: bool = True,
+                 multi_range_max_hole: int = 256 * 1024,
+                 max_ranges_per_request: int = 32,
+                 verify_resume: int = 8,
+                 verify_digest: bool = False,
+                 expected_digest: str = None,
+                 rate_limiter: RateLimiter = None,
+                 metrics: Metrics = None,
+                 metrics_file: str = None,
+                 metrics_format: str = 'json',
+                 metrics_interval: float = 5.0,
+                 progress_interval: float = 1.0,
+                 max_source_errors: int = 3,
+                 retry_policy: RetryPolicy = None,
+                 checkpoint_size: int = 4 * 1024 * 1024,
+                 max_restarts: int = 1,
+                 hedging: bool = False,
+                 hedge_ratio: float = 0.2,
+                 hedge_delay: float = 2.0,
+                 hedge_interval: float = 0.5,
+                 max_hedges: int = 2,
+                 hedge_min_size: int = 256 * 1024,
+                 sink: DownloadSink = None):
         self.path = path
-        self.request = request
+        sources = list(request) if isinstance(request, (list, tuple)) else [request]
+        self.request = sources[0]
+        self._sources = SourceSelector(sources, max_consecutive_errors=max_source_errors)
         self.request_ctl_args = request_ctl_args
         if self.request_ctl_args is None:
             self.request_ctl_args = {}
@@ -253,12 +2268,67 @@ class DownloaderCoordinator(object):
         self.force_segment = force_segment
         self.max_error_retry = max_error_retry
         self.finished_segment_file = finished_segment_file
+        self.write_buffer_size = write_buffer_size
+        self.fsync_policy = fsync_policy
+        self._buffer_pool = BufferPool(receive_buffer_size) if zero_copy_receive else None
+        self.work_stealing = work_stealing
+        self.min_steal_size = min_steal_size
+        self._inflight_downloaders = {}
+        self._stolen_count = 0
+        self._tuner = AdaptiveTuner(max_thread=max_thread) if auto_tune else None
+        self.tune_interval = tune_interval
+        self.tune_log_file = tune_log_file
+        self._breakpoint = breakpoint_journal if breakpoint_journal is not None \
+            else BreakpointFile(finished_segment_file)
+        self.multi_range = multi_range
+        self.multi_range_max_hole = multi_range_max_hole
+        self.max_ranges_per_request = max_ranges_per_request
+        # None表示还没有发送过multi-range请求
+        self._multi_range_supported = None
+        self.verify_resume = verify_resume
+        self.verify_digest = verify_digest
+        self._configured_digest = parse_expected_digest(expected_digest) if expected_digest else None
+        self._expected_digest = self._configured_digest
+        # (start, end) -> crc32
+        self._segment_digests = {}
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics if metrics is not None or not metrics_file else Metrics()
+        self._exporter = MetricsExporter(self.metrics, metrics_file, metrics_interval, metrics_format) \
+            if metrics_file else None
+        self.progress_interval = progress_interval
+        self._progress = None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.checkpoint_size = checkpoint_size
+        self.max_restarts = max_restarts
+        self._restart_count = 0
+        self.hedging = hedging
+        self.hedge_ratio = hedge_ratio
+        self.hedge_delay = hedge_delay
+        self.hedge_interval = hedge_interval
+        self.max_hedges = max_hedges
+        self.hedge_min_size = hedge_min_size
+        self._hedge_count = 0
+        self._hedge_wins = 0
+        self._active_hedges = 0
+        # 最近完成的段的吞吐 计算中位数时与在途段一起比较
+        self._segment_rates = collections.deque(maxlen=32)
+        self._if_range = None
+        self._validators = (None, None)
+        self._abort_error = None
+        self._aborted = threading.Event()
+        self._sink = sink if sink is not None else FileSink(path, fsync_policy=fsync_policy)
+        # 打开后的写入目标 工作线程共享
+        self._storage = None
         self._thread_count = 1
+        self._active_thread_count = 0
         self._data_length = 1
         self._finished_length = 0
         self._finished_thread_count = 0
         self._future = None
         self._failed_segment_list = []
+        self._session_pool = SessionPool(max_thread)
+        self._done = threading.Event()
+        self._task_lock = threading.Lock()
         self._lock = threading.Lock()
 
     def _increment_and_get(self, length):
@@ -269,79 +2339,577 @@ class DownloaderCoordinator(object):
     def _record_failed_segment(self, start, end):
         with self._lock:
             self._failed_segment_list.append((start, end))
+        if self.metrics is not None:
+            self.metrics.inc('failed_segments_total')
+            self.metrics.emit('segment_failed', start=start, end=end)
 
-    def _record_finished_segment(self, start, end):
-        with self._lock:
-            if self.finished_segment_file:
-                with open(self.finished_segment_file, 'a+') as fd:
-                    fd.write('%s,%s\n' % (start, end))
+    def _record_checkpoint(self, start, end, crc32):
+        """段的一部分已经落盘"""
+        self._record_finished_segment(start, end, crc32)
+        self._increment_and_get(end - start + 1)
 
-    def _record_data_length(self, data_length):
+    def _abort(self, error):
+        """致命错误 停止所有工作线程"""
         with self._lock:
-            if self.finished_segment_file:
-                with open(self.finished_segment_file, 'w') as fd:
-                    fd.write('%s\n' % data_length)
+            if self._abort_error is None:
+                self._abort_error = error
+        self._aborted.set()
+
+    def _record_retry(self, start, end, error):
+        if self._tuner:
+            self._tuner.record_error(error)
+        if self.metrics is not None:
+            self.metrics.inc('retries_total', error=type(error).__name__)
+            self.metrics.emit('retry', start=start, end=end, error=repr(error))
 
-    def _record_finish_thread_count(self):
+    def _record_finished_segment(self, start, end, crc32=None):
+        self._breakpoint.record_finished_segment(start, end, crc32)
+        if crc32 is not None:
+            with self._lock:
+                self._segment_digests[(start, end)] = crc32
+
+    def _record_data_length(self, data_length, etag=None, last_modified=None):
+        self._validators = (etag or None, last_modified or None)
+        self._breakpoint.record_data_length(data_length, etag, last_modified)
+
+    def _record_finish_thread_count(self, retired=False):
         with self._lock:
             self._finished_thread_count += 1
-            if self._thread_count == self._finished_thread_count and self._future:
-                self._future.set_result(True)
+            if not retired:
+                self._active_thread_count -= 1
+            if self._thread_count != self._finished_thread_count:
+                return
+            restart = isinstance(self._abort_error, ResourceChangedException) and \
+                self._restart_count < self.max_restarts
+            if not restart:
+                self._done.set()
+        if restart:
+            self._restart()
+        else:
+            self._finish()
+
+    def _restart(self):
+        """远端文件已经改变 丢弃已经下载的数据 从头重新下载"""
+        self._restart_count += 1
+        std_log('%s, restart download %s/%s' % (self._abort_error, self._restart_count, self.max_restarts))
+        self._storage = None
+        self._sink.abort()
+        with self._lock:
+            self._abort_error = None
+            self._finished_length = 0
+            self._finished_thread_count = 0
+            self._failed_segment_list = []
+            self._segment_digests = {}
+            self._inflight_downloaders = {}
+        self._aborted.clear()
+        self._multi_range_supported = None
+        self._expected_digest = self._configured_digest
+        if self.metrics is not None:
+            self.metrics.inc('restarts_total')
+        try:
+            self._start(restart=True)
+        except Exception as error:
+            with self._lock:
+                self._abort_error = error
+            self._done.set()
+            self._finish()
+
+    def _finish(self):
+        self._close_resources()
+        std_log('connection stats %s' % self._session_pool.stats())
+        if self._tuner:
+            self._log_tune_summary()
+        if self._hedge_count:
+            std_log('hedge stats %s' % self.get_hedge_stats())
+        error = self._abort_error
+        if error is None and self.verify_digest and not self._failed_segment_list:
+            try:
+                self._verify_file()
+            except Exception as verify_error:
+                error = verify_error
+        result = False
+        try:
+            if error is None and not self._failed_segment_list:
+                result = self._sink.finalize()
+            else:
+                self._sink.abort()
+        except Exception as sink_error:
+            error = error or sink_error
+        if self._future:
+            if error is None:
+                self._future.set_result(result)
+            else:
+                self._future.set_exception(error)
+
+    def _verify_file(self):
+        """并行校验所有段的CRC32 有期望摘要时再校验整个文件 失败时抛出IntegrityException"""
+        bad_segments = self._sink.verify_segment_digests(self._segment_digests)
+        if bad_segments:
+            raise IntegrityException(self.path, 'crc32 mismatch segments %s' % bad_segments, bad_segments)
+        if self._expected_digest:
+            algorithm, expected = self._expected_digest
+            actual = self._sink.digest(algorithm)
+            if actual != expected:
+                raise IntegrityException(self.path, '%s expected %s actual %s' % (algorithm, expected, actual))
+        std_log('integrity check passed, %s segments' % len(self._segment_digests))
+
+    def _check_finished_segments(self, holes):
+        """
+        抽查断点记录中已完成段的CRC32
+        :param holes: 未完成的段列表
+        :return: 加入校验失败段后的未完成段列表
+        """
+        digests = {segment: crc for segment, crc in self._breakpoint.segment_digests().items()
+                   if not any(segment[0] <= end and start <= segment[1] for start, end in holes)}
+        bad_segments = self._sink.verify_segment_digests(sample_segment_digests(digests, self.verify_resume)) \
+            if self.verify_resume else []
+        for segment in bad_segments:
+            digests.pop(segment)
+        self._segment_digests.update(digests)
+        if not bad_segments:
+            return holes
+        std_log('crc32 mismatch segments %s, download again' % bad_segments)
+        return merge_segments(list(holes) + bad_segments)
+
+    def _log_tune_summary(self):
+        summary = self.get_tune_summary()
+        std_log('auto tune result threads %s segment size %s' % (summary['threads'], summary['segment_size']))
+        if self.tune_log_file:
+            with open(self.tune_log_file, 'w') as fd:
+                json.dump(summary, fd)
+
+    def get_tune_summary(self):
+        """
+        自动调整结果
+        :return: dict threads segment_size rtt curve 未开启auto_tune时返回None
+        """
+        if self._tuner is None:
+            return None
+        return self._tuner.summary(self.segment_size)
+
+    def get_metrics(self):
+        """获取Metrics 未开启时返回None"""
+        return self.metrics
+
+    def get_validators(self):
+        """
+        :return: 远端文件的(etag, last_modified) 没有时为None
+        """
+        return self._validators
+
+    def _close_resources(self):
+        if self._progress is not None:
+            self._progress.stop()
+        if self._exporter is not None:
+            self._exporter.stop()
+        self._session_pool.close()
+        self._breakpoint.close()
 
     def get_all_failed_segment(self):
         """获取到所有失败的段区间列表"""
         with self._lock:
             return self._failed_segment_list[:]
 
-    def _start(self, from_breakpoint=False, data_length=None, breakpoint_segment_list=None):
+    def get_stolen_count(self):
+        """空闲工作线程从在途段切分接手的次数"""
+        with self._lock:
+            return self._stolen_count
+
+    def get_hedge_stats(self):
+        """
+        :return: dict hedges(发出的对冲请求数) wins(对冲请求先到达并接管写入的次数)
+        """
+        with self._lock:
+            return {'hedges': self._hedge_count, 'wins': self._hedge_wins}
+
+    def _set_inflight(self, downloader):
+        with self._lock:
+            if downloader is None:
+                self._inflight_downloaders.pop(threading.get_ident(), None)
+            else:
+                self._inflight_downloaders[threading.get_ident()] = downloader
+
+    def _steal_task(self):
+        """
+        切分预计最晚完成的在途段 取其剩余区间的后一半
+        :return: (start, end) 没有可切分的段时返回None
+        """
+        with self._lock:
+            downloaders = list(self._inflight_downloaders.values())
+        now = time.monotonic()
+
+        def remaining_time(downloader):
+            written, remaining = downloader.progress()
+            if remaining <= 0:
+                return 0
+            elapsed = now - (downloader.start_time or now)
+            if written <= 0 or elapsed <= 0:
+                return float('inf')
+            return remaining * elapsed / written
+
+        for downloader in sorted(downloaders, key=remaining_time, reverse=True):
+            task = downloader.split(self.min_steal_size)
+            if task is not None:
+                with self._lock:
+                    self._stolen_count += 1
+                if self.metrics is not None:
+                    self.metrics.inc('steals_total')
+                debug_log('steal range %s-%s' % task)
+                return task
+        return None
+
+    def _next_task(self, task_queue):
+        if self._aborted.is_set():
+            return None
+        with self._task_lock:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                task = None
+            if isinstance(task, MultiRangeTask):
+                return task
+            if task is not None and task[1] > 0 and task[1] - task[0] + 1 > self.segment_size:
+                # 按当前段大小切下第一段 剩余部分放回队列
+                task_queue.put((task[0] + self.segment_size, task[1]))
+                task = (task[0], task[0] + self.segment_size - 1)
+        if task is None and self.work_stealing:
+            task = self._steal_task()
+        return task
+
+    def _downloaded_bytes(self):
+        with self._lock:
+            downloaders = list(self._inflight_downloaders.values())
+            finished_length = self._finished_length
+        return finished_length + sum(downloader.pending_length() for downloader in downloaders)
+
+    def _should_retire(self):
+        """自动调整降低并发数时 多出来的工作线程在段之间退出"""
+        if self._tuner is None:
+            return False
+        with self._lock:
+            if self._active_thread_count > self._tuner.target_thread:
+                self._active_thread_count -= 1
+                return True
+        return False
+
+    def _spawn_worker(self, task_queue):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._thread_count += 1
+            self._active_thread_count += 1
+            work_index = self._thread_count - 1
+        threading.Thread(name='work-%s' % work_index, target=self._work_wrapper, args=(task_queue,)).start()
+        return True
+
+    def _tune_loop(self, task_queue):
+        last_bytes = self._downloaded_bytes()
+        last_time = time.monotonic()
+        while not self._done.wait(self.tune_interval):
+            now = time.monotonic()
+            downloaded = self._downloaded_bytes()
+            rate = (downloaded - last_bytes) / max(now - last_time, 1e-6)
+            last_bytes, last_time = downloaded, now
+            with self._lock:
+                active = self._active_thread_count
+            target = self._tuner.update(rate, active)
+            self.segment_size = self._tuner.segment_size(rate, active)
+            std_log('auto tune rate %d B/s threads %s -> %s segment size %s' % (rate, active, target,
+                                                                                self.segment_size))
+            if task_queue.empty() and not self.work_stealing:
+                continue
+            for _ in range(target - active):
+                if not self._spawn_worker(task_queue):
+                    break
+
+    def _hedge_loop(self):
+        """定期计算在途段的吞吐 持续低于中位数hedge_ratio倍超过hedge_delay秒的段发出对冲请求"""
+        last_progress = {}
+        slow_since = {}
+        while not self._done.wait(self.hedge_interval):
+            now = time.monotonic()
+            with self._lock:
+                downloaders = list(self._inflight_downloaders.values())
+                samples = list(self._segment_rates)
+            rates = {}
+            progress = {}
+            for downloader in downloaders:
+                written, remaining = downloader.progress()
+                if remaining <= 0:
+                    continue
+                progress[downloader] = (written, now)
+                if downloader in last_progress:
+                    last_written, last_time = last_progress[downloader]
+                    rates[downloader] = (written - last_written) / max(now - last_time, 1e-6)
+            last_progress = progress
+            samples += rates.values()
+            if len(samples) < 2:
+                continue
+            threshold = statistics.median(samples) * self.hedge_ratio
+            slow_since = {downloader: slow_since.get(downloader, now) for downloader, rate in rates.items()
+                          if rate < threshold and downloader.hedge is None}
+            for downloader, since in slow_since.items():
+                if now - since >= self.hedge_delay:
+                    self._start_hedge(downloader)
+
+    def _start_hedge(self, downloader):
+        """为在途段的剩余区间发出对冲请求 对冲线程计入工作单元数"""
+        with self._lock:
+            if self._done.is_set() or self._aborted.is_set() or self._active_hedges >= self.max_hedges:
+                return False
+            if downloader.hedge is not None or downloader not in self._inflight_downloaders.values():
+                return False
+            region = downloader.start_hedge(self.hedge_min_size)
+            if region is None:
+                return False
+            hedge = HedgedRange(downloader, *region)
+            downloader.hedge = hedge
+            self._thread_count += 1
+            self._active_hedges += 1
+            self._hedge_count += 1
+            hedge_index = self._hedge_count
+        std_log('hedge slow range %s-%s' % region)
+        if self.metrics is not None:
+            self.metrics.inc('hedges_total')
+        threading.Thread(name='hedge-%s' % hedge_index, target=self._hedge_wrapper, args=(hedge,)).start()
+        return True
+
+    def _hedge_wrapper(self, hedge):
+        try:
+            self._run_hedge(hedge)
+        finally:
+            with self._lock:
+                self._active_hedges -= 1
+            self._record_finish_thread_count(retired=True)
+
+    def _run_hedge(self, hedge):
+        """
+        发送对冲请求 接管之后没有写完的部分与普通段一样重试
+        """
+        source = self._sources.acquire()
+        downloader = HedgeDownloader(self.path, source.request, hedge,
+                                     storage=self._storage,
+                                     write_buffer_size=self.write_buffer_size,
+                                     rate_limiter=self.rate_limiter,
+                                     metrics=self.metrics,
+                                     checkpoint_size=self.checkpoint_size,
+                                     checkpoint_callback=self._record_checkpoint,
+                                     if_range=self._if_range,
+                                     **self.request_ctl_args)
+        try:
+            downloader.download()
+        except Exception as error:
+            debug_log('hedged request for range %s-%s occurs error, %r' % (hedge.start, hedge.end, error))
+            self._sources.record_error(source)
+        cut_at = hedge.close()
+        if cut_at is None:
+            return
+        piece = downloader.take_checkpoint()
+        if piece is not None:
+            self._storage.checkpoint()
+            self._record_checkpoint(*piece)
+        if downloader.range_real_end >= cut_at:
+            with self._lock:
+                self._hedge_wins += 1
+            if self.metrics is not None:
+                self.metrics.inc('hedge_wins_total')
+        start = max(cut_at, downloader.range_real_end + 1)
+        if start <= hedge.end:
+            # 立即在对冲线程中补充下载 不等待工作线程归还Session
+            with self._session_pool.dedicated_session() as session:
+                self._download_segment((start, hedge.end), session)
+
+    def get_connection_stats(self):
+        """获取连接复用统计 见SessionPool.stats()"""
+        return self._session_pool.stats()
+
+    def get_source_stats(self):
+        """
+        各个下载源的统计
+        :return: [dict url rate downloaded_bytes successes errors dropped]
+        """
+        return self._sources.stats()
+
+    def _probe(self, request, probe_size=0):
+        """
+        探测请求 probe_size大于0时只请求bytes=0-(probe_size-1) 不支持Range的服务端返回200完整响应
+        :return: requests.Response(stream=True) 响应体没有读取 由调用方接收或者释放
+        """
+        with self._session_pool.session() as session:
+            prepared = request.prepare()
+            if probe_size > 0:
+                prepared.headers['Range'] = 'bytes=0-%s' % (probe_size - 1)
+            try:
+                response = session.send(prepared, **self.request_ctl_args)
+            except Exception as error:
+                raise FetchHeaderException(error)
+        # 416表示空文件
+        if response.status_code >= 400 and response.status_code != 416:
+            release_response(response)
+            response.raise_for_status()
+        return response
+
+    def _probe_sources(self, data_length=None, probe_size=0):
+        """
+        探测所有源 长度或者ETag与基准不一致的源和探测失败的源被丢弃
+        基准为第一个探测成功的源 续传时长度必须等于data_length
+        :return: (基准源, 基准源的响应) 其它源的响应已经释放
+        """
+        sources = self._sources.sources
+        if len(sources) == 1:
+            return sources[0], self._probe(sources[0].request, probe_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = [executor.submit(self._probe, source.request, probe_size) for source in sources]
+        reference = None
+        for source, future in zip(sources, futures):
+            if future.exception() is not None:
+                continue
+            if data_length is None or get_probe_data_length(future.result()) == data_length:
+                reference = source, future.result()
+                break
+        if reference is None:
+            for future in futures:
+                if future.exception() is None:
+                    release_response(future.result())
+            raise FetchHeaderException('no source is available, %s' % [future.exception() for future in futures])
+        reference_response = reference[1]
+        reference_length = get_probe_data_length(reference_response)
+        etag = normalize_etag(reference_response.headers.get('ETag'))
+        for source, future in zip(sources, futures):
+            if future.exception() is not None:
+                self._sources.drop(source, 'probe failed, %s' % future.exception())
+                continue
+            response = future.result()
+            if response is reference_response:
+                continue
+            release_response(response)
+            headers = response.headers
+            if get_probe_data_length(response) != reference_length:
+                self._sources.drop(source, 'content length %s differs from %s' % (
+                    get_probe_data_length(response), reference_length))
+            elif etag and normalize_etag(headers.get('ETag')) and normalize_etag(headers.get('ETag')) != etag:
+                self._sources.drop(source, 'etag %s differs from %s' % (headers.get('ETag'), etag))
+        return reference
+
+    def _plan_probe_response(self, source, response):
+        """
+        根据探测响应记录长度和校验值
+        :return: (第一段, 剩余区间列表) 第一段为(task, source, response) 使用探测响应下载 没有时为None
+        """
+        headers = response.headers
+        self._data_length = get_probe_data_length(response)
+        if self._expected_digest is None:
+            digest_headers = requests.structures.CaseInsensitiveDict(headers)
+            if response.status_code != 200:
+                # 206响应的Content-MD5只是响应体这一部分的摘要
+                digest_headers.pop('Content-MD5', None)
+            self._expected_digest = get_digest_from_headers(digest_headers)
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        # 不同镜像的Last-Modified可能不一致 多个源时只用ETag
+        self._if_range = get_if_range(etag, last_modified if len(self._sources.sources) == 1 else None)
+        content_range = parse_content_range(headers.get('Content-Range')) if response.status_code == 206 else None
+        if content_range is not None and self._data_length < 0:
+            self._data_length = self._discover_data_length(source, content_range[1])
+        self._record_data_length(self._data_length, etag, last_modified)
+        # 返回206说明支持Range 即使没有Accept-Ranges 返回200说明不支持 不能分段
+        if content_range is not None and self._data_length > 0:
+            # 探测响应就是第一段
+            first_end = min(content_range[1], self._data_length - 1)
+            regions = [(first_end + 1, self._data_length - 1)] if first_end + 1 < self._data_length else []
+            return ((0, first_end), source, response), regions
+        if response.status_code == 200:
+            # 探测响应就是完整的文件
+            return ((0, 0), source, response), []
+        release_response(response)
+        return None, [(0, 0)]
+
+    def _discover_data_length(self, source, first_end):
+        """
+        探测响应是206但总长度未知时确定总长度 见discover_data_length
+        :param first_end: 探测响应的最后一个字节位置
+        :return: 数据总长度 无法确定时返回-1 回退为不分段的完整请求
+        """
+        if first_end < self.segment_size - 1:
+            # 请求的范围没有返回满 文件在这里结束
+            return first_end + 1
+        with self._session_pool.session() as session:
+            try:
+                data_length = discover_data_length(session, source.request, self.request_ctl_args, first_end,
+                                                   self._if_range)
+            except Exception as error:
+                std_log('discover data length failed, %r' % error)
+                data_length = -1
+        std_log('content range total is unknown, discovered data length %s' % data_length)
+        return data_length
+
+    def _start(self, from_breakpoint=False, data_length=None, breakpoint_segment_list=None, restart=False):
         self.request_ctl_args['stream'] = True
         task_queue = queue.Queue()
-        try_to_segment = True
+        first = None
         if not from_breakpoint:
-            # 第一步 请求 并 判定是否支持分段
-            prepared_request = self.request.prepare()
-            session = requests.Session()
+            # 第一步 请求第一段 判定是否支持分段 多个源时校验长度和ETag
+            source, response = self._probe_sources(probe_size=self.segment_size)
             try:
-                response = session.send(prepared_request, **self.request_ctl_args)
-                response.close()
-            except Exception as error:
-                raise FetchHeaderException(error)
-            self._data_length = get_content_length(response.headers)
-            self._record_data_length(self._data_length)
-            try_to_segment = is_support_multi_range(response.headers)
-            # 创建空文件
-            create_empty_fix_size_binary_file(self.path, 0 if self._data_length < 0 else self._data_length)
+                first, regions = self._plan_probe_response(source, response)
+                # 长度确定后打开写入目标 文件只创建一次
+                self._sink.open(self._data_length, overwrite=restart)
+            except Exception:
+                release_response(response)
+                raise
         else:
             self._data_length = data_length
-        if self.force_segment:
-            try_to_segment = True
+            etag, last_modified = self._breakpoint.validators()
+            self._validators = (etag, last_modified)
+            if len(self._sources.sources) > 1:
+                release_response(self._probe_sources(data_length, probe_size=1)[1])
+                last_modified = None
+            self._if_range = get_if_range(etag, last_modified)
+            self._sink.open(self._data_length, resume=True)
+        self._storage = self._sink
         if from_breakpoint:
+            breakpoint_segment_list = self._check_finished_segments(breakpoint_segment_list)
             # 修正_finished_length
-            self._finished_length = self._data_length
+            self._finished_length = self._data_length - sum(end - start + 1 for start, end in breakpoint_segment_list)
+            regions = [tuple(segment) for segment in breakpoint_segment_list]
+            batches = []
+            if self.multi_range:
+                # 相邻的小空洞合并为multi-range请求
+                batches, regions = group_small_segments(regions, self.multi_range_max_hole,
+                                                        self.max_ranges_per_request, self.segment_size)
             # 切分大段
-            for segment in breakpoint_segment_list:
-                offset = segment[0]
-                self._finished_length -= (segment[1] - segment[0] + 1)
-                while offset <= segment[1]:
-                    task = (offset, min(offset + self.segment_size - 1, segment[1]))
-                    offset += self.segment_size
-                    task_queue.put(task)
+            tasks = split_segments(regions, self.segment_size) + batches
         else:
-            # 从0开始分段
-            if try_to_segment and self._data_length > self.segment_size:
-                offset = 0
-                while offset < self._data_length:
-                    task = (offset, min(offset + self.segment_size - 1, self._data_length - 1))
-                    offset += self.segment_size
-                    task_queue.put(task)
-            else:
-                task_queue.put((0, 0))
-        self._thread_count = min(task_queue.qsize(), self.max_thread)
-        for work_index in range(self._thread_count):
-            work_thread = threading.Thread(name='work-%s' % work_index,
-                                           target=self._work_wrapper,
-                                           args=(task_queue,))
-            work_thread.start()
+            # 第一段之后的部分分段
+            tasks = regions if regions == [(0, 0)] else split_segments(regions, self.segment_size)
+            batches = []
+        first_count = 0 if first is None else 1
+        thread_count = self._worker_count(len(tasks), first_count)
+        if self._tuner:
+            # 自动调整时按区间入队 取任务时再按当前段大小切分
+            thread_count = min(len(tasks) + first_count, self._tuner.target_thread)
+            tasks = regions + batches
+        for task in tasks:
+            task_queue.put(task)
+        with self._lock:
+            self._thread_count = thread_count
+            self._active_thread_count = thread_count
+        if thread_count == 0:
+            # 续传时已经没有未完成的段
+            self._done.set()
+            self._finish()
+            return
+        if self._exporter is not None and not restart:
+            self._exporter.start()
+        if self._progress is not None:
+            self._progress.total = self._data_length
+        elif self.progress_interval and self.progress_interval > 0:
+            self._progress = ProgressReporter(self._data_length, self._downloaded_bytes, self.progress_interval,
+                                              log=std_log, metrics=self.metrics).start()
+        self._launch_workers(tasks, task_queue, thread_count, first)
+        if self._tuner and not restart:
+            threading.Thread(name='auto-tune', target=self._tune_loop, args=(task_queue,), daemon=True).start()
+        if self.hedging and not restart:
+            threading.Thread(name='hedge', target=self._hedge_loop, daemon=True).start()
 
     def start(self, from_breakpoint=False, data_length=None, breakpoint_segment_list=None):
         """
@@ -359,71 +2927,298 @@ class DownloaderCoordinator(object):
                         breakpoint_segment_list=breakpoint_segment_list
                         )
         except Exception as error:
+            self._close_resources()
+            self._sink.abort()
             self._future.set_exception(error)
         finally:
             return self._future
 
-    def _work_wrapper(self, task_queue):
+    def _worker_count(self, task_count, first_count):
+        """
+        :param task_count: 队列中的任务数
+        :param first_count: 使用探测响应下载的第一段数量 0或1
+        :return: 工作单元数 每个工作单元结束时调用一次_record_finish_thread_count
+        """
+        return min(task_count + first_count, self.max_thread)
+
+    def _launch_workers(self, tasks, task_queue, thread_count, first):
+        """
+        启动工作线程 第一个线程先下载探测响应
+        :param tasks: 已经放入task_queue的任务
+        """
+        for work_index in range(thread_count):
+            work_thread = threading.Thread(name='work-%s' % work_index,
+                                           target=self._work_wrapper,
+                                           args=(task_queue, first if work_index == 0 else None))
+            work_thread.start()
+
+    def _work_wrapper(self, task_queue, first=None):
+        retired = False
         try:
-            self._work(task_queue)
+            retired = self._work(task_queue, first)
         finally:
-            self._record_finish_thread_count()
+            self._record_finish_thread_count(retired)
+
+    def _work(self, task_queue, first=None):
+        with self._session_pool.session() as session:
+            return self._work_with_session(task_queue, session, first)
+
+    def _download_multi_range(self, task, task_queue, session):
+        """
+        一次请求下载一组小段
+        服务端不支持multi-range或者请求失败时 把没有完成的段逐个放回队列 按普通段下载和重试
+        """
+        if self._multi_range_supported is False:
+            for segment in task.ranges:
+                task_queue.put(segment)
+            return
+        source = self._sources.acquire()
+        downloader = MultiRangeDownloader(self.path, source.request, task.ranges,
+                                          session=session,
+                                          storage=self._storage,
+                                          write_buffer_size=self.write_buffer_size,
+                                          rate_limiter=self.rate_limiter,
+                                          metrics=self.metrics,
+                                          if_range=self._if_range,
+                                          **self.request_ctl_args)
+        try:
+            downloader.download()
+            self._sources.record_success(source, downloader.total_downloaded_data_length(),
+                                         time.monotonic() - downloader.start_time)
+        except Exception as error:
+            std_log('multi range download occurs error, %s' % traceback.format_exc())
+            self._sources.record_error(source)
+            self._record_retry(task.ranges[0][0], task.ranges[-1][1], error)
+        if downloader.multipart is False:
+            std_log('server does not support multi range request, fall back to per hole requests')
+            self._multi_range_supported = False
+        elif downloader.multipart:
+            self._multi_range_supported = True
+        if downloader.finished_ranges:
+            self._storage.checkpoint()
+            for (start, end), crc32 in zip(downloader.finished_ranges, downloader.finished_digests):
+                self._record_finished_segment(start, end, crc32)
+            self._increment_and_get(downloader.total_downloaded_data_length())
+        for segment in downloader.unfinished_ranges():
+            task_queue.put(segment)
+
+    def _work_with_session(self, task_queue, session, first=None):
+        """
+        :param first: 使用探测响应下载的第一段 (task, source, response)
+        :return: 是否因为并发数降低而提前退出
+        """
+        if first is not None:
+            self._download_segment(first[0], session, first[1], first[2])
+        while True:
+            if self._should_retire():
+                return True
+            # [start, end]
+            task = self._next_task(task_queue)
+            if task is None:
+                break
+            if isinstance(task, MultiRangeTask):
+                self._download_multi_range(task, task_queue, session)
+                continue
+            self._download_segment(task, session)
+        return False
 
-    def _work(self, task_queue):
+    def _download_segment(self, task, session, probe_source=None, probe_response=None):
+        """
+        下载一个段 出错时从已经写入的位置继续 按重试策略退避
+        :param probe_source: 探测响应的源
+        :param probe_response: 探测响应 第一次下载时直接接收 不再发送请求
+        """
+        retry = 0
         while True:
+            if retry > self.max_error_retry:
+                std_log('segment download failed times exceed max retry time %s' % self.max_error_retry)
+                self._record_failed_segment(task[0], task[1])
+                return
+            if self._aborted.is_set():
+                if probe_response is not None:
+                    release_response(probe_response)
+                return
+            whole_file = task[0] == 0 and task[1] == 0
+            source = self._sources.acquire(probe_source)
+            downloader = SegmentDownloader(self.path, source.request, task[0], task[1],
+                                           session=session,
+                                           storage=self._storage,
+                                           write_buffer_size=self.write_buffer_size,
+                                           buffer_pool=self._buffer_pool,
+                                           rate_limiter=self.rate_limiter,
+                                           metrics=self.metrics,
+                                           checkpoint_size=0 if whole_file else self.checkpoint_size,
+                                           checkpoint_callback=self._record_checkpoint,
+                                           if_range=self._if_range,
+                                           **self.request_ctl_args)
+            self._set_inflight(downloader)
+            error = None
             try:
-                # [start, end]
-                task = task_queue.get(timeout=1)
-            except queue.Empty:
-                break
-            retry = 0
-            while True:
-                if retry > self.max_error_retry:
-                    std_log('segment download failed times exceed max retry time %s' % self.max_error_retry)
-                    self._record_failed_segment(task[0], task[1])
-                    break
-                downloader = SegmentDownloader(self.path, self.request, task[0], task[1], **self.request_ctl_args)
-                try:
-                    downloader.download()
-                except Exception as error:
-                    std_log('download worker occurs error and retry, %s' % traceback.format_exc())
-                    retry += 1
-                    continue
-                retry = 0
+                downloader.download(probe_response)
+            except Exception as download_error:
+                error = download_error
+            finally:
+                probe_source = probe_response = None
+                self._set_inflight(None)
+                # 段可能已经被其它线程切走一部分 在写入器锁内取结束位置 之后不会再被切分
+                if not whole_file:
+                    task = (task[0], downloader.seal())
+                # 剩余部分可能已经交给对冲请求
+                if downloader.hedge is not None:
+                    task = (task[0], downloader.hedge.release())
+            progressed = False
+            if not whole_file:
+                piece = downloader.take_checkpoint()
+                if piece is not None:
+                    self._storage.checkpoint()
+                    self._record_checkpoint(*piece)
+                # 包括接收过程中已经记录的检查点
+                progressed = downloader.range_real_end >= task[0]
+                if downloader.range_real_end > task[1]:
+                    raise RuntimeError('range real end is exceed expected value')
+                if task[1] < task[0]:
+                    # 对冲请求接管了全部剩余区间
+                    return
+            if error is None:
+                duration = time.monotonic() - downloader.start_time
+                self._sources.record_success(source, downloader.total_downloaded_data_length(), duration)
+                if downloader.total_downloaded_data_length() > 0 and duration > 0:
+                    self._segment_rates.append(downloader.total_downloaded_data_length() / duration)
+                if self._tuner:
+                    self._tuner.record_ttfb(downloader.ttfb)
                 # 从头下载到尾部
-                if task[0] == 0 and task[1] == 0:
-                    break
-                finished_length = self._increment_and_get(downloader.total_downloaded_data_length())
-                std_log('=====finish percent %s=====' % (finished_length / self._data_length))
+                if whole_file:
+                    return
                 if downloader.range_real_end == task[1]:
                     # 正常区间全部下载完毕
-                    self._record_finished_segment(task[0], task[1])
-                    break
-                elif downloader.range_real_end < task[1]:
-                    # 区间下载出现错误 继续补充下载
-                    self._record_finished_segment(task[0], downloader.range_real_end)
+                    return
+                # 服务端返回的区间不完整 继续补充下载
+                task = (downloader.range_real_end + 1, task[1])
+                if progressed:
+                    retry = 0
+                    continue
+                error = EmptyResponseException('range %s-%s returns no data' % task)
+            else:
+                std_log('download worker occurs error and retry, %s' %
+                        ''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                self._sources.record_error(source)
+                if progressed:
+                    # 保留已经写入的数据 从最后写入的位置继续
+                    retry = 0
+                    if downloader.range_real_end == task[1]:
+                        return
                     task = (downloader.range_real_end + 1, task[1])
-                else:
-                    raise RuntimeError('range real end is exceed expected value')
+            self._record_retry(task[0], task[1], error)
+            if self.retry_policy.is_fatal(error):
+                if self._sources.drop(source, 'fatal error %r' % error):
+                    continue
+                std_log('fatal error %r, stop downloading' % error)
+                self._record_failed_segment(task[0], task[1])
+                self._abort(error)
+                return
+            retry += 1
+            self._aborted.wait(self.retry_policy.delay(retry, error))
+
+
+def download_to_memory(request, request_ctl_args=None, zero_copy=False, max_size=0, **coordinator_kwargs):
+    """
+    下载到内存 不创建文件 见MemorySink
+    长度不超过segment_size时探测请求就是唯一的请求 不分段
+    :param coordinator_kwargs: DownloaderCoordinator的其它参数 默认不输出进度
+    :return: bytes 或者zero_copy时为memoryview
+    """
+    from .download_manager import SegmentFailedException
+    coordinator_kwargs.setdefault('progress_interval', 0)
+    coordinator = DownloaderCoordinator(None, request, request_ctl_args, sink=MemorySink(zero_copy, max_size),
+                                        **coordinator_kwargs)
+    data = coordinator.start().result()
+    failed_segment_list = coordinator.get_all_failed_segment()
+    if failed_segment_list:
+        raise SegmentFailedException(request.url, failed_segment_list)
+    return data
 
 
 def parse_args():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('url', type=str, help='http url')
-    parser.add_argument('file', type=str, help='save file path')
+    parser.add_argument('url', type=str, nargs='?', help='http url')
+    parser.add_argument('file', type=str, nargs='?', help='save file path, - writes to stdout in byte order')
+    parser.add_argument('-M', '--manifest', type=str,
+                        help='jsonl manifest of files to download, -T is the global connection number')
+    parser.add_argument('-hc', '--host_connections', type=int, default=4,
+                        help='max connections per host in manifest mode')
     parser.add_argument('-b', '--breakpoint', default=False, action='store_true', help='from breakpoint')
     parser.add_argument('-bf', '--breakpoint_file', type=str, help='break point file')
+    parser.add_argument('-j', '--journal', type=str, default='text', choices=('text', 'bitmap'),
+                        help='break point file format, text break point file is converted when resume as bitmap')
+    parser.add_argument('-bs', '--block_size', type=int, default=1024*1024, help='bitmap break point block size')
     parser.add_argument('-d', '--data', type=str, help='post data')
-    parser.add_argument('-ds', '--disable_segment', default=False, action='store_true')
+    parser.add_argument('-ds', '--disable_segment', default=False, action='store_true',
+                        help='async engine: do not segment without Accept-Ranges, thread and process engines '
+                             'segment whenever the probe returns 206')
     parser.add_argument('-H', '--header', type=str, action='append', help='http header')
     parser.add_argument('-m', '--method', type=str, help='http method')
-    parser.add_argument('-mr', '--max_error_retry', type=str, default=10, help='max error retry')
+    parser.add_argument('-mr', '--max_error_retry', type=int, default=10, help='max error retry')
+    parser.add_argument('--mirror', type=str, action='append',
+                        help='url of an equivalent source, can be repeated, segments are spread over all sources')
     parser.add_argument('-p', '--proxy', type=str, help='http proxy')
     parser.add_argument('-t', '--timeout', type=int, default=60, help='timeout')
     parser.add_argument('-T', '--thread', type=int, default=5, help='download thread number')
     parser.add_argument('-s', '--size', type=int, default=5*1024*1024, help='segment size')
-    return parser.parse_args()
+    parser.add_argument('-wb', '--write_buffer', type=int, default=256*1024, help='write buffer size per thread')
+    parser.add_argument('--fsync', type=str, default=FileStorage.FSYNC_CLOSE, choices=FileStorage.FSYNC_POLICIES,
+                        help='fsync policy')
+    parser.add_argument('-zc', '--zero_copy', default=False, action='store_true',
+                        help='read response into reusable buffers')
+    parser.add_argument('-a', '--auto', default=False, action='store_true',
+                        help='auto tune thread number (up to -T) and segment size by measured throughput')
+    parser.add_argument('--tune_log', type=str, help='save auto tune result as json')
+    parser.add_argument('--no_steal', default=False, action='store_true',
+                        help='disable splitting in-flight segments for idle threads')
+    parser.add_argument('--hedge', default=False, action='store_true',
+                        help='request the rest of a straggling segment again on a new connection')
+    parser.add_argument('--hedge_delay', type=float, default=2.0,
+                        help='seconds a segment stays far below median throughput before hedging')
+    parser.add_argument('--no_multi_range', default=False, action='store_true',
+                        help='disable merging small break point holes into multi-range requests')
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='verify segment crc32 and file digest after download')
+    parser.add_argument('--digest', type=str,
+                        help='expected file digest algorithm:hex, e.g. sha256:9f86..., implies --verify')
+    parser.add_argument('--resume_check', type=int, default=8,
+                        help='number of finished segments to check by crc32 when resume, -1 for all')
+    parser.add_argument('-r', '--rate', type=int, default=0, help='max download bytes per second, 0 is unlimited')
+    parser.add_argument('--host_rate', type=int, default=0,
+                        help='max download bytes per second per host, 0 is unlimited')
+    parser.add_argument('--metrics', type=str, help='write metrics snapshot to this file periodically')
+    parser.add_argument('--metrics_format', type=str, default='json', choices=MetricsExporter.FORMATS,
+                        help='metrics snapshot format')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='log every segment')
+    parser.add_argument('-e', '--engine', type=str, default='thread', choices=('thread', 'async', 'process'),
+                        help='download engine, async requires aiohttp, process spreads segments over processes')
+    parser.add_argument('-P', '--processes', type=int, default=0,
+                        help='worker process number of process engine, 0 is cpu count, -T is split among them')
+    parser.add_argument('--stream_buffer', type=int, default=64*1024*1024,
+                        help='max bytes buffered for reordering when file is -')
+    parser.add_argument('--cache', type=str, help='content addressed cache directory shared by processes')
+    parser.add_argument('--cache_size', type=int, default=0, help='max cache bytes, 0 is unlimited')
+    parser.add_argument('--cache_age', type=int, default=0, help='max seconds a cached file is valid, 0 is unlimited')
+    parser.add_argument('--delta_from', type=str, help='old local copy, only download blocks it does not have')
+    parser.add_argument('--delta_index', type=str, help='block checksum index path or url of the new file')
+    args = parser.parse_args()
+    if not args.manifest and (not args.url or not args.file):
+        parser.error('url and file are required without manifest')
+    if args.file == '-' and (args.breakpoint or args.breakpoint_file):
+        parser.error('breakpoint is not supported when file is -')
+    if args.cache and (args.breakpoint or args.breakpoint_file or args.mirror or args.engine == 'async' or
+                       args.file == '-'):
+        parser.error('cache does not support breakpoint, mirror, async engine or stdout')
+    if bool(args.delta_from) != bool(args.delta_index):
+        parser.error('--delta_from and --delta_index must be used together')
+    if args.delta_from and (args.breakpoint or args.mirror or args.engine == 'async' or args.file == '-' or
+                            args.cache):
+        parser.error('delta update does not support -b, mirror, async engine, stdout or cache')
+    return args
 
 
 def prepare_parameters():
@@ -451,22 +3246,124 @@ def prepare_parameters():
     return request, ctl_args, args
 
 
+def download_manifest(args, ctl_args, rate_limiter=None):
+    from . import download_manager
+    with download_manager.DownloadManager(max_workers=args.thread,
+                                          per_host_connections=args.host_connections,
+                                          request_ctl_args=ctl_args,
+                                          segment_size=args.size,
+                                          max_error_retry=args.max_error_retry,
+                                          write_buffer_size=args.write_buffer,
+                                          fsync_policy=args.fsync,
+                                          rate_limiter=rate_limiter) as manager:
+        submitted = manager.submit_manifest(args.manifest)
+        futures = [future for _, future in submitted]
+        while concurrent.futures.wait(futures, timeout=5).not_done:
+            std_log('=====progress %s=====' % manager.progress())
+    for entry, future in submitted:
+        if future.exception() is not None:
+            std_log('download %s failed, %s' % (entry['path'], future.exception()))
+    std_log('=====progress %s=====' % manager.progress())
+
+
+def download_stream(args, request, ctl_args, rate_limiter=None):
+    from . import stream_downloader
+    log_to_stderr()
+    downloader = stream_downloader.OrderedStreamDownloader(request, ctl_args,
+                                                           max_thread=args.thread,
+                                                           segment_size=args.size,
+                                                           max_buffer_size=args.stream_buffer,
+                                                           max_error_retry=args.max_error_retry,
+                                                           rate_limiter=rate_limiter)
+    total = downloader.copy_to(sys.stdout.buffer)
+    std_log('write %s bytes to stdout' % total)
+
+
 def download_file():
     request, ctl_args, args = prepare_parameters()
-    downloader = DownloaderCoordinator(args.file, request, ctl_args,
-                                       max_thread=args.thread,
-                                       force_segment=not args.disable_segment,
-                                       max_error_retry=args.max_error_retry,
-                                       finished_segment_file=args.breakpoint_file)
+    if args.verbose:
+        be_verbose()
+    rate_limiter = RateLimiter(args.rate, args.host_rate) if args.rate > 0 or args.host_rate > 0 else None
+    if args.manifest:
+        download_manifest(args, ctl_args, rate_limiter)
+        return
+    if args.file == '-':
+        download_stream(args, request, ctl_args, rate_limiter)
+        return
+    journal = None
     if args.breakpoint:
         std_log('will start from breakpoint file')
-        data_length, segments = read_all_finished_segment_list(args.breakpoint_file)
-        segment_holes = find_holes(data_length, segments)
+        journal = open_breakpoint_journal(args.breakpoint_file, args.journal, args.block_size)
+        data_length, segment_holes = journal.find_holes()
         if not segment_holes:
             std_log('all file segment is already downloaded')
+    elif args.breakpoint_file and args.journal == 'bitmap':
+        journal = BitmapJournal(args.breakpoint_file, block_size=args.block_size)
+    if args.engine == 'async':
+        import asyncio
+        from . import async_downloader
+        downloader = async_downloader.AsyncDownloaderCoordinator(args.file, request, ctl_args,
+                                                                 max_concurrency=args.thread,
+                                                                 force_segment=not args.disable_segment,
+                                                                 segment_size=args.size,
+                                                                 max_error_retry=args.max_error_retry,
+                                                                 finished_segment_file=args.breakpoint_file,
+                                                                 write_buffer_size=args.write_buffer,
+                                                                 fsync_policy=args.fsync,
+                                                                 breakpoint_journal=journal,
+                                                                 rate_limiter=rate_limiter)
+    else:
+        coordinator_class, engine_args = DownloaderCoordinator, {}
+        if args.engine == 'process':
+            from . import process_downloader
+            coordinator_class = process_downloader.ProcessDownloaderCoordinator
+            engine_args['processes'] = args.processes or None
+        coordinator_args = dict(max_thread=args.thread,
+                                force_segment=not args.disable_segment,
+                                segment_size=args.size,
+                                max_error_retry=args.max_error_retry,
+                                write_buffer_size=args.write_buffer,
+                                fsync_policy=args.fsync,
+                                zero_copy_receive=args.zero_copy,
+                                work_stealing=not args.no_steal,
+                                auto_tune=args.auto,
+                                tune_log_file=args.tune_log,
+                                hedging=args.hedge,
+                                hedge_delay=args.hedge_delay,
+                                multi_range=not args.no_multi_range,
+                                verify_resume=args.resume_check,
+                                rate_limiter=rate_limiter,
+                                metrics_file=args.metrics,
+                                metrics_format=args.metrics_format,
+                                **engine_args)
+        if args.cache:
+            from . import download_cache
+            cache = download_cache.DownloadCache(args.cache, max_size=args.cache_size, max_age=args.cache_age)
+            result = cache.fetch(args.file, request, ctl_args, expected_digest=args.digest,
+                                 coordinator_class=coordinator_class, **coordinator_args)
+            std_log('cache %s, stats %s' % (result, cache.stats()))
+            return
+        if args.delta_from:
+            from . import delta_update
+            result = delta_update.delta_update(args.file, request, ctl_args, args.delta_from, args.delta_index,
+                                               finished_segment_file=args.breakpoint_file,
+                                               coordinator_class=coordinator_class, **coordinator_args)
+            std_log('delta update %s' % result)
             return
+        sources = [request] + [requests.Request(method=request.method, url=mirror, headers=request.headers,
+                                                data=request.data) for mirror in args.mirror or []]
+        downloader = coordinator_class(args.file, sources if len(sources) > 1 else request, ctl_args,
+                                       finished_segment_file=args.breakpoint_file,
+                                       breakpoint_journal=journal,
+                                       verify_digest=args.verify or bool(args.digest),
+                                       expected_digest=args.digest,
+                                       **coordinator_args)
+    if args.breakpoint:
         future = downloader.start(True, data_length, segment_holes)
     else:
         std_log('start to download')
         future = downloader.start(False)
-    future.result()
+    if args.engine == 'async':
+        asyncio.run(future)
+    else:
+        future.result()
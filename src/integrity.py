@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+完整性校验
+每段下载时在接收循环中计算CRC32 与断点记录一起保存 续传时抽查已完成的段
+下载结束后可以按期望的SHA-256或者响应头Digest/Content-MD5校验整个文件
+"""
+import base64
+import binascii
+import concurrent.futures
+import hashlib
+import os
+import queue
+import random
+import threading
+import zlib
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class IntegrityException(Exception):
+    """校验失败"""
+    def __init__(self, path, message, bad_segment_list=None):
+        super().__init__('%s integrity check failed, %s' % (path, message))
+        self.path = path
+        self.bad_segment_list = bad_segment_list or []
+
+
+def parse_expected_digest(value):
+    """
+    :param value: algorithm:hexdigest 例如 sha256:9f86d0... 没有algorithm时按sha256处理
+    :return: (algorithm, hexdigest)
+    """
+    algorithm, _, hexdigest = value.rpartition(':')
+    algorithm = (algorithm or 'sha256').lower().replace('-', '')
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError('unsupported digest algorithm %s' % algorithm)
+    return algorithm, hexdigest.strip().lower()
+
+
+def get_digest_from_headers(headers):
+    """
+    从响应头中取完整响应体的摘要 优先SHA-256
+    支持 Repr-Digest: sha-256=:base64: Digest: SHA-256=base64 Content-MD5: base64
+    :param headers: response headers
+    :return: (algorithm, hexdigest) 没有时返回None
+    """
+    candidates = {}
+    for header in ('Repr-Digest', 'Digest'):
+        for item in (headers.get(header) or '').split(','):
+            name, _, value = item.strip().partition('=')
+            if name and value:
+                candidates.setdefault(name.lower().replace('-', ''), value.strip(':'))
+    if headers.get('Content-MD5'):
+        candidates.setdefault('md5', headers['Content-MD5'].strip())
+    for algorithm in ('sha256', 'sha512', 'md5'):
+        if algorithm in candidates:
+            try:
+                return algorithm, base64.b64decode(candidates[algorithm]).hex()
+            except (binascii.Error, ValueError):
+                continue
+    return None
+
+
+def pread(fd, length, offset, seek_lock=None):
+    """
+    在offset处读取最多length字节 不支持pread的平台用seek_lock保护seek + read
+    """
+    if seek_lock is None:
+        return os.pread(fd, length, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+
+def _read_range(fd, start, end, block_size=READ_BLOCK_SIZE, seek_lock=None):
+    offset = start
+    while offset <= end:
+        data = pread(fd, min(block_size, end - offset + 1), offset, seek_lock)
+        if not data:
+            return
+        yield data
+        offset += len(data)
+
+
+def range_crc32(fd, start, end, seek_lock=None):
+    """
+    :param seek_lock: 多个线程共享fd时 不支持pread的平台需要传入同一个锁
+    :return: 文件[start, end]的CRC32
+    """
+    crc = 0
+    for data in _read_range(fd, start, end, seek_lock=seek_lock):
+        crc = zlib.crc32(data, crc)
+    return crc
+
+
+def verify_segment_digests(path, segment_digests, max_workers=None):
+    """
+    多线程并行校验段CRC32 zlib计算大块数据时释放GIL 可以利用多核
+    :param path: 文件路径
+    :param segment_digests: {(start, end): crc32}
+    :param max_workers: 并行数 默认CPU核数
+    :return: 不匹配的段列表 按start排序
+    """
+    if not segment_digests:
+        return []
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    seek_lock = None if hasattr(os, 'pread') else threading.Lock()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                                   thread_name_prefix='crc-verify') as executor:
+            futures = {segment: executor.submit(range_crc32, fd, segment[0], segment[1], seek_lock)
+                       for segment in segment_digests}
+            return sorted(segment for segment, future in futures.items()
+                          if future.result() != segment_digests[segment])
+    finally:
+        os.close(fd)
+
+
+def sample_segment_digests(segment_digests, sample_count):
+    """
+    :param segment_digests: {(start, end): crc32}
+    :param sample_count: 抽查数量 小于0表示全部
+    :return: 抽查的{(start, end): crc32}
+    """
+    if sample_count < 0 or sample_count >= len(segment_digests):
+        return dict(segment_digests)
+    return {segment: segment_digests[segment] for segment in random.sample(list(segment_digests), sample_count)}
+
+
+def file_digest(path, algorithm='sha256', block_size=READ_BLOCK_SIZE):
+    """
+    计算整个文件的摘要
+    SHA-256等摘要只能顺序计算 这里用后台线程预读下一块 读盘和计算哈希流水线执行
+    :return: hexdigest
+    """
+    hasher = hashlib.new(algorithm)
+    blocks = queue.Queue(maxsize=4)
+
+    def read_blocks():
+        try:
+            with open(path, 'rb', buffering=0) as fd:
+                while True:
+                    data = fd.read(block_size)
+                    blocks.put(data)
+                    if not data:
+                        return
+        except Exception as error:
+            blocks.put(error)
+
+    reader = threading.Thread(name='digest-reader', target=read_blocks, daemon=True)
+    reader.start()
+    while True:
+        data = blocks.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            break
+        hasher.update(data)
+    reader.join()
+    return hasher.hexdigest()
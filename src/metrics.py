@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+性能指标和事件
+Metrics: 计数器 仪表 直方图 事件回调 导出JSON或Prometheus文本
+MetricsExporter: 后台定期把快照写入文件
+ProgressReporter: 定期采样已下载字节数 输出EWMA速度和预计剩余时间
+"""
+import bisect
+import json
+import os
+import threading
+import time
+import traceback
+
+
+class Histogram(object):
+    """
+    固定桶直方图
+    buckets: 桶上界 升序
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def cumulative_counts(self):
+        """
+        :return: [(le, 累计数量), ...] 最后一个le为+Inf
+        """
+        result = []
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': [['+Inf' if le == float('inf') else le, count] for le, count in self.cumulative_counts()],
+        }
+
+
+def _format_key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels))
+
+
+class Metrics(object):
+    """
+    线程安全的指标集合 可以在多个下载之间共享
+    指标名和标签组成一个序列 例如 inc('retries_total', error='ConnectionError')
+    add_listener(callback)注册事件回调 callback(event, fields)在发出事件的线程中同步调用
+    """
+    SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    BYTES_PER_SECOND_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(11))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._listeners = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=None, **labels):
+        """
+        :param buckets: 第一次观察该序列时使用的桶 默认SECONDS_BUCKETS
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(buckets or self.SECONDS_BUCKETS)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def get_counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def add_listener(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def emit(self, event, **fields):
+        """向所有回调发送事件 回调异常不影响下载"""
+        if not self._listeners:
+            return
+        with self._lock:
+            listeners = self._listeners[:]
+        for listener in listeners:
+            try:
+                listener(event, fields)
+            except Exception:
+                traceback.print_exc()
+
+    def snapshot(self):
+        """
+        :return: JSON可序列化的dict counters gauges histograms
+        """
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': {_format_key(*key): value for key, value in self._counters.items()},
+                'gauges': {_format_key(*key): value for key, value in self._gauges.items()},
+                'histograms': {_format_key(*key): histogram.snapshot()
+                               for key, histogram in self._histograms.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='filedownloader_'):
+        """
+        :return: Prometheus文本格式
+        """
+        lines = []
+        with self._lock:
+            for metric_type, series in (('counter', self._counters), ('gauge', self._gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append('# TYPE %s%s %s' % (prefix, name, metric_type))
+                    lines.append('%s %s' % (_format_key(prefix + name, labels), value))
+            typed = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s%s histogram' % (prefix, name))
+                for le, count in histogram.cumulative_counts():
+                    bucket_labels = labels + (('le', '+Inf' if le == float('inf') else le),)
+                    lines.append('%s %s' % (_format_key(prefix + name + '_bucket', bucket_labels), count))
+                lines.append('%s %s' % (_format_key(prefix + name + '_sum', labels), histogram.sum))
+                lines.append('%s %s' % (_format_key(prefix + name + '_count', labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """
+    后台定期把指标快照写入文件 先写临时文件再替换 读取方不会读到半个文件
+    metrics: Metrics
+    path: 输出文件
+    interval: 写入间隔(秒)
+    export_format: json或prometheus
+    """
+    FORMATS = ('json', 'prometheus')
+
+    def __init__(self, metrics, path, interval=5.0, export_format='json'):
+        if export_format not in self.FORMATS:
+            raise ValueError('export format must be one of %s' % (self.FORMATS,))
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.export_format = export_format
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(name='metrics-exporter', target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        content = self.metrics.to_json() if self.export_format == 'json' else self.metrics.to_prometheus()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            fd.write(content)
+        os.replace(temp_path, self.path)
+
+    def stop(self):
+        """停止并写入最后一次快照"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+
+class ProgressReporter(object):
+    """
+    进度汇总 后台线程定期采样 不在每次收到数据时加锁或者输出
+    total: 总字节数 未知时小于等于0
+    sample: 返回已下载字节数的函数
+    interval: 采样间隔(秒)
+    alpha: EWMA平滑系数 越大越关注最近的速度
+    log: 输出函数 为None时不输出
+    metrics: 设置后更新progress相关仪表并发出progress事件
+    """
+    def __init__(self, total, sample, interval=1.0, alpha=0.3, log=None, metrics=None):
+        self.total = total
+        self.sample = sample
+        self.interval = interval
+        self.alpha = alpha
+        self.log = log
+        self.metrics = metrics
+        self.speed = 0.0
+        self.downloaded = 0
+        self._last_bytes = None
+        self._last_time = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._last_bytes = self.sample()
+        self._last_time = time.monotonic()
+        self._thread = threading.Thread(name='progress', target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def eta(self):
+        """
+        :return: 预计剩余秒数 未知时返回None
+        """
+        if self.total <= 0 or self.speed <= 0:
+            return None
+        return max(0, self.total - self.downloaded) / self.speed
+
+    def report(self):
+        now = time.monotonic()
+        self.downloaded = self.sample()
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            rate = (self.downloaded - self._last_bytes) / elapsed
+            self.speed = rate if self.speed == 0 else self.alpha * rate + (1 - self.alpha) * self.speed
+        self._last_bytes, self._last_time = self.downloaded, now
+        eta = self.eta()
+        if self.log:
+            percent = '%.1f%%' % (self.downloaded * 100 / self.total) if self.total > 0 else '%s bytes' % \
+                self.downloaded
+            self.log('=====progress %s speed %.1f KB/s eta %s=====' % (percent, self.speed / 1024,
+                                                                      '-' if eta is None else '%.0fs' % eta))
+        if self.metrics is not None:
+            self.metrics.set_gauge('downloaded_bytes', self.downloaded)
+            self.metrics.set_gauge('speed_bytes_per_second', self.speed)
+            self.metrics.emit('progress', downloaded=self.downloaded, total=self.total, speed=self.speed, eta=eta)
+
+    def stop(self):
+        """停止并输出最后一次进度"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.report()
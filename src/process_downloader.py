@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+多进程下载引擎
+万兆以上带宽时 单进程中iter_content 切片和SegmentWriter.write受GIL限制 一个核先被占满
+父进程探测 制定下载计划 记录断点和进度 段分给多个子进程 每个子进程有自己的连接和工作线程 直接pwrite到预分配的文件
+子进程通过事件队列把段的检查点 失败 重试和在途字节数发回父进程
+"""
+import builtins
+import multiprocessing
+import os
+import queue
+import threading
+
+import requests
+
+from . import file_downloader
+from .file_downloader import DownloaderCoordinator, FileStorage, get_error_response
+from .rate_limiter import RateLimiter
+
+
+class ProcessWorkerException(Exception):
+    """子进程异常退出 或者子进程中的异常无法在父进程中还原"""
+    pass
+
+
+def describe_error(error):
+    """
+    :return: (异常类名, 消息, HTTP状态码) 可以跨进程传递
+    """
+    response = get_error_response(error)
+    return type(error).__name__, str(error), None if response is None else response.status_code
+
+
+def rebuild_error(name, message, status_code=None):
+    """
+    在父进程中还原describe_error描述的异常 HTTP错误还原为带状态码的HTTPError
+    """
+    if status_code is not None:
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.HTTPError(message, response=response)
+    for namespace in (file_downloader, requests.exceptions, builtins):
+        error_class = getattr(namespace, name, None)
+        if isinstance(error_class, type) and issubclass(error_class, Exception):
+            try:
+                return error_class(message)
+            except Exception:
+                break
+    return ProcessWorkerException('%s: %s' % (name, message))
+
+
+class _ProcessTaskQueue(object):
+    """
+    进程间任务队列 提供DownloaderCoordinator使用的get_nowait/put接口
+    父进程放完所有任务后为每个工作线程放一个None 读到None说明任务已经取完
+    put的任务只在本进程内调度
+    """
+    def __init__(self, task_queue):
+        self._queue = task_queue
+        self._local = queue.Queue()
+        self._exhausted = False
+
+    def get_nowait(self):
+        try:
+            return self._local.get_nowait()
+        except queue.Empty:
+            pass
+        if self._exhausted:
+            raise queue.Empty
+        task = self._queue.get()
+        if task is None:
+            self._exhausted = True
+            raise queue.Empty
+        return task
+
+    def put(self, task):
+        self._local.put(task)
+
+
+class _ProcessWorker(DownloaderCoordinator):
+    """
+    子进程中的下载器 复用DownloaderCoordinator的段下载 重试和线程内切分
+    检查点 失败段 重试和致命错误通过events发给父进程 aborted为进程间共享的停止标志
+    """
+    def __init__(self, index, path, sources, request_ctl_args, events, aborted, if_range=None, rate=0,
+                 per_host_rate=0, report_interval=1.0, **kwargs):
+        super().__init__(path, sources, request_ctl_args, multi_range=False, progress_interval=0, **kwargs)
+        self.index = index
+        self.report_interval = report_interval
+        self._events = events
+        self._aborted = aborted
+        self._if_range = if_range
+        self.rate_limiter = RateLimiter(rate, per_host_rate) if rate > 0 or per_host_rate > 0 else None
+
+    def _send(self, kind, *args):
+        self._events.put((self.index, kind) + args)
+
+    def _record_checkpoint(self, start, end, crc32):
+        self._send('checkpoint', start, end, crc32)
+
+    def _record_failed_segment(self, start, end):
+        self._send('failed', start, end)
+
+    def _record_retry(self, start, end, error):
+        self._send('retry', start, end, *describe_error(error))
+
+    def _abort(self, error):
+        self._send('abort', *describe_error(error))
+        self._aborted.set()
+
+    def run(self, task_queue):
+        tasks = _ProcessTaskQueue(task_queue)
+        self._storage = FileStorage(self.path, fsync_policy=self.fsync_policy)
+        try:
+            threads = [threading.Thread(name='work-%s-%s' % (self.index, work_index), target=self._work,
+                                        args=(tasks,)) for work_index in range(self.max_thread)]
+            for work_thread in threads:
+                work_thread.start()
+            for work_thread in threads:
+                while work_thread.is_alive():
+                    work_thread.join(self.report_interval)
+                    self._send('pending', self._downloaded_bytes())
+        finally:
+            self._storage.close()
+            self._session_pool.close()
+            self._send('exit', self._session_pool.stats())
+
+
+def _worker_main(index, path, sources, request_ctl_args, options, task_queue, events, aborted):
+    options = dict(options)
+    if options.pop('quiet', False):
+        file_downloader.be_quiet()
+    if options.pop('verbose', False):
+        file_downloader.be_verbose()
+    _ProcessWorker(index, path, sources, request_ctl_args, events, aborted, **options).run(task_queue)
+
+
+class ProcessDownloaderCoordinator(DownloaderCoordinator):
+    """
+    多进程分段下载协调器 start()与DownloaderCoordinator一样返回Future
+    探测响应(第一段)在父进程中接收 其余段分给子进程
+    processes: 子进程数 默认CPU核数
+    threads_per_process: 每个子进程的工作线程数 默认由max_thread平均分配
+    start_method: multiprocessing启动方式 默认spawn 父进程中已经有线程时fork不安全
+    其它参数与DownloaderCoordinator相同
+    不支持auto_tune multi-range合并和对冲 工作线程只在同一个进程内切分在途段 子进程直接写入文件 sink必须是文件
+    rate_limiter按子进程数平分 子进程启动后调整速率只影响父进程
+    """
+    def __init__(self, path: str, request, request_ctl_args: dict, processes: int = None,
+                 threads_per_process: int = None, start_method: str = 'spawn', **kwargs):
+        kwargs['auto_tune'] = False
+        kwargs['multi_range'] = False
+        kwargs['hedging'] = False
+        super().__init__(path, request, request_ctl_args, **kwargs)
+        if self._sink.path is None:
+            raise ValueError('process engine requires a file sink')
+        self.processes = processes or os.cpu_count() or 1
+        self.threads_per_process = threads_per_process or max(1, -(-self.max_thread // self.processes))
+        self._context = multiprocessing.get_context(start_method)
+        self._aborted = self._context.Event()
+        # 子进程index -> 在途未记录的字节数
+        self._child_pending = {}
+        self._child_connection_stats = []
+
+    def _worker_count(self, task_count, first_count):
+        return first_count + min(self.processes, task_count)
+
+    def _worker_options(self, process_count):
+        rate, per_host_rate = 0, 0
+        if self.rate_limiter is not None:
+            rate = self.rate_limiter.rate / process_count
+            per_host_rate = self.rate_limiter.per_host_rate / process_count
+        return {
+            'max_thread': self.threads_per_process,
+            'segment_size': self.segment_size,
+            'max_error_retry': self.max_error_retry,
+            'write_buffer_size': self.write_buffer_size,
+            'fsync_policy': self.fsync_policy,
+            'zero_copy_receive': self._buffer_pool is not None,
+            'receive_buffer_size': self._buffer_pool.buffer_size if self._buffer_pool is not None else 256 * 1024,
+            'work_stealing': self.work_stealing,
+            'min_steal_size': self.min_steal_size,
+            'max_source_errors': self._sources.max_consecutive_errors,
+            'retry_policy': self.retry_policy,
+            'checkpoint_size': self.checkpoint_size,
+            'if_range': self._if_range,
+            'rate': rate,
+            'per_host_rate': per_host_rate,
+            'report_interval': self.progress_interval or 1.0,
+            'quiet': file_downloader.QUIET,
+            'verbose': file_downloader.VERBOSE,
+        }
+
+    def _launch_workers(self, tasks, task_queue, thread_count, first):
+        if first is not None:
+            threading.Thread(name='work-0', target=self._work_wrapper, args=(queue.Queue(), first)).start()
+        process_count = thread_count - (0 if first is None else 1)
+        if process_count <= 0:
+            return
+        process_tasks = self._context.Queue()
+        for task in tasks:
+            process_tasks.put(task)
+        for _ in range(process_count * self.threads_per_process):
+            process_tasks.put(None)
+        events = self._context.Queue()
+        options = self._worker_options(process_count)
+        sources = [source.request for source in self._sources.alive_sources()]
+        processes = []
+        for index in range(process_count):
+            process = self._context.Process(name='download-process-%s' % index, target=_worker_main,
+                                            args=(index, self.path, sources, self.request_ctl_args, options,
+                                                  process_tasks, events, self._aborted),
+                                            daemon=True)
+            process.start()
+            processes.append(process)
+        threading.Thread(name='process-events', target=self._collect_events,
+                         args=(processes, events, process_tasks), daemon=True).start()
+
+    def _collect_events(self, processes, events, process_tasks):
+        """
+        接收子进程事件 所有子进程退出后各计一次工作单元结束
+        :param process_tasks: 任务队列 子进程退出前父进程必须持有引用 否则spawn的子进程无法打开队列的信号量
+        """
+        running = set(range(len(processes)))
+        while running:
+            try:
+                message = events.get(timeout=1)
+            except queue.Empty:
+                for index in list(running):
+                    exitcode = processes[index].exitcode
+                    if exitcode is not None and exitcode != 0:
+                        running.discard(index)
+                        self._abort(ProcessWorkerException('worker process %s exited with code %s' %
+                                                           (index, exitcode)))
+                continue
+            self._handle_event(message, running)
+        for process in processes:
+            process.join()
+        process_tasks.close()
+        for _ in processes:
+            self._record_finish_thread_count()
+
+    def _handle_event(self, message, running):
+        index, kind, args = message[0], message[1], message[2:]
+        if kind == 'checkpoint':
+            self._record_checkpoint(*args)
+        elif kind == 'failed':
+            self._record_failed_segment(*args)
+        elif kind == 'retry':
+            self._record_retry(args[0], args[1], rebuild_error(*args[2:]))
+        elif kind == 'abort':
+            self._abort(rebuild_error(*args))
+        elif kind == 'pending':
+            with self._lock:
+                self._child_pending[index] = args[0]
+        elif kind == 'exit':
+            with self._lock:
+                self._child_pending.pop(index, None)
+                self._child_connection_stats.append(args[0])
+            running.discard(index)
+
+    def _downloaded_bytes(self):
+        with self._lock:
+            pending = sum(self._child_pending.values())
+        return super()._downloaded_bytes() + pending
+
+    def _restart(self):
+        with self._lock:
+            self._child_pending = {}
+        super()._restart()
+
+    def get_connection_stats(self):
+        """父进程和所有子进程的连接复用统计之和"""
+        stats = super().get_connection_stats()
+        with self._lock:
+            child_stats = self._child_connection_stats[:]
+        for child in child_stats:
+            for key in stats:
+                stats[key] += child.get(key, 0)
+        return stats
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+带宽限速
+令牌桶 所有工作线程共享 也可以在多个DownloaderCoordinator/DownloadManager之间共享
+同时支持全局限速和按host限速 下载过程中可以调整
+"""
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    令牌桶 允许欠账: 取令牌时先扣减 令牌不足时返回需要等待的时间
+    多个线程按扣减顺序依次等待 速率平滑 不会出现整体停顿再整体放行
+    rate: 每秒字节数 小于等于0表示不限速
+    burst: 桶容量 默认100ms的数据量(最少64KB)
+    """
+    MIN_BURST = 64 * 1024
+
+    def __init__(self, rate=0, burst=None):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self._tokens = 0
+        self._last_time = time.monotonic()
+        self.set_rate(rate, burst)
+        self._tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        """调整速率 已有的欠账按新速率偿还"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate or 0
+            self.burst = burst if burst else max(self.MIN_BURST, int(self.rate / 10))
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+
+    def reserve(self, length):
+        """
+        扣减length个令牌
+        :return: 需要等待的秒数 0表示不需要等待
+        """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= length
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+class RateLimiter(object):
+    """
+    全局和按host的带宽限速
+    rate: 全局每秒字节数 小于等于0表示不限速
+    per_host_rate: 每个host每秒字节数 小于等于0表示不限速
+    """
+    def __init__(self, rate=0, per_host_rate=0):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(rate)
+        self.per_host_rate = per_host_rate or 0
+        # host -> TokenBucket
+        self._hosts = {}
+        # 单独设置了速率的host
+        self._host_rates = {}
+
+    @property
+    def rate(self):
+        return self._global.rate
+
+    def set_rate(self, rate):
+        """调整全局速率"""
+        self._global.set_rate(rate)
+
+    def set_per_host_rate(self, rate):
+        """调整每个host的默认速率 单独设置过速率的host不受影响"""
+        with self._lock:
+            self.per_host_rate = rate or 0
+            for host, bucket in self._hosts.items():
+                if host not in self._host_rates:
+                    bucket.set_rate(self.per_host_rate)
+
+    def set_host_rate(self, host, rate):
+        """单独设置某个host的速率"""
+        with self._lock:
+            self._host_rates[host] = rate or 0
+            self._host_bucket(host).set_rate(rate)
+
+    def _host_bucket(self, host):
+        bucket = self._hosts.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self._host_rates.get(host, self.per_host_rate))
+            self._hosts[host] = bucket
+        return bucket
+
+    def reserve(self, host, length):
+        """
+        :return: 需要等待的秒数
+        """
+        wait = self._global.reserve(length)
+        if self.per_host_rate > 0 or self._host_rates:
+            with self._lock:
+                bucket = self._host_bucket(host)
+            wait = max(wait, bucket.reserve(length))
+        return wait
+
+    def consume(self, host, length):
+        """取length个令牌 不足时阻塞等待"""
+        wait = self.reserve(host, length)
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+有序流式下载
+多个工作线程并行下载段 数据不落盘 按字节顺序交给消费者(stdout 文件对象 迭代器) 下载和处理(解压 tar)同时进行
+重排缓冲区有上限 工作线程只领取读取位置之后窗口内的段 越靠近读取位置的段越先下载
+"""
+import collections
+import io
+import threading
+import traceback
+import urllib.parse
+
+from .file_downloader import (EmptyResponseException, RetryPolicy, SessionPool, check_range_response,
+                              discover_data_length, get_if_range, get_probe_data_length, parse_content_range,
+                              release_response, split_segments, std_log)
+from .rate_limiter import RateLimiter
+
+# 与SegmentDownloader相同 连接中途断开时最多丢弃一块已经收到的数据
+RECEIVE_CHUNK_SIZE = 8192
+
+
+class _SegmentBuffer(object):
+    """
+    一个段已经收到但还没有被读取的数据
+    end: 小于0表示长度未知 读到响应结束为止
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.chunks = collections.deque()
+        self.received = 0
+        self.done = False
+
+    def length(self):
+        return -1 if self.end < 0 else self.end - self.start + 1
+
+
+class OrderedStreamDownloader(object):
+    """
+    并行下载 按顺序输出
+    探测请求只请求第一段 响应体作为第一段 服务端不支持Range时按单个连接顺序输出
+    request: requests请求
+    request_ctl_args: 请求其它参数 比如 timeout proxies 等
+    max_thread: 最大线程数
+    segment_size: 每段大小 越小首字节越快 请求越多
+    max_buffer_size: 重排缓冲区上限 工作线程最多领取读取位置之后max_buffer_size/segment_size个段
+    max_error_retry: 每段连续失败的最大重试次数
+    retry_policy: 重试策略 见RetryPolicy 已经输出的数据不能撤回 远端文件改变(If-Range不匹配)时直接失败
+    rate_limiter: 带宽限速 见RateLimiter
+    """
+    def __init__(self, request, request_ctl_args: dict = None, max_thread: int = 5,
+                 segment_size: int = 1024 * 1024,
+                 max_buffer_size: int = 64 * 1024 * 1024,
+                 max_error_retry: int = 10,
+                 retry_policy: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None):
+        self.request = request
+        self.request_ctl_args = dict(request_ctl_args or {})
+        self.request_ctl_args['stream'] = True
+        self.max_thread = max_thread
+        self.segment_size = segment_size
+        self.window = max(1, max_buffer_size // segment_size)
+        self.max_error_retry = max_error_retry
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.host = urllib.parse.urlsplit(request.url).netloc
+        self.data_length = -1
+        self._ranged = False
+        self._if_range = None
+        self._segments = []
+        self._buffers = {}
+        # 下一个被读取的段
+        self._head = 0
+        # 下一个被领取的段
+        self._next_index = 0
+        self._probe_response = None
+        self._error = None
+        self._closed = False
+        self._started = False
+        self._stopped = threading.Event()
+        self._cond = threading.Condition()
+        self._session_pool = SessionPool(max_thread)
+
+    def _is_stopped(self):
+        return self._closed or self._error is not None
+
+    def _probe(self):
+        with self._session_pool.session() as session:
+            prepared = self.request.prepare()
+            prepared.headers['Range'] = 'bytes=0-%s' % (self.segment_size - 1)
+            response = session.send(prepared, **self.request_ctl_args)
+        if response.status_code >= 400 and response.status_code != 416:
+            release_response(response)
+            response.raise_for_status()
+        return response
+
+    def _discover_data_length(self, first_end):
+        """总长度未知时确定总长度 见discover_data_length 无法确定时返回-1"""
+        if first_end < self.segment_size - 1:
+            return first_end + 1
+        with self._session_pool.session() as session:
+            try:
+                return discover_data_length(session, self.request, self.request_ctl_args, first_end, self._if_range)
+            except Exception as error:
+                std_log('discover data length failed, %r' % error)
+                return -1
+
+    def _start(self):
+        if self._started:
+            raise RuntimeError('stream can only be read once')
+        self._started = True
+        response = self._probe()
+        self.data_length = get_probe_data_length(response)
+        self._if_range = get_if_range(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        content_range = parse_content_range(response.headers.get('Content-Range'))
+        if response.status_code == 206 and self.data_length < 0 and content_range is not None:
+            self.data_length = self._discover_data_length(content_range[1])
+        if response.status_code == 206 and self.data_length >= 0:
+            self._ranged = True
+            self._segments = split_segments([(0, self.data_length - 1)], self.segment_size) \
+                if self.data_length > 0 else []
+            self._probe_response = response
+        elif response.status_code == 200 and self.data_length != 0:
+            # 不支持Range 探测响应就是完整数据 只能单连接顺序输出
+            self._segments = [(0, self.data_length - 1 if self.data_length > 0 else -1)]
+            self._probe_response = response
+        elif self.data_length == 0:
+            release_response(response)
+        else:
+            # 总长度未知 不带Range重新请求完整数据
+            release_response(response)
+            self._segments = [(0, -1)]
+        if self._probe_response is not None and not self._segments:
+            release_response(self._probe_response)
+            self._probe_response = None
+        for work_index in range(min(self.max_thread, len(self._segments))):
+            threading.Thread(name='stream-%s' % work_index, target=self._work, daemon=True).start()
+
+    def _next_segment(self):
+        """
+        领取窗口内下一个段
+        :return: 段序号 没有可领取的段或者已经停止时返回None
+        """
+        with self._cond:
+            while not self._is_stopped():
+                if self._next_index >= len(self._segments):
+                    return None
+                if self._next_index < self._head + self.window:
+                    index = self._next_index
+                    self._next_index += 1
+                    self._buffers[index] = _SegmentBuffer(*self._segments[index])
+                    return index
+                self._cond.wait()
+            return None
+
+    def _work(self):
+        with self._session_pool.session() as session:
+            while True:
+                index = self._next_segment()
+                if index is None:
+                    return
+                self._download_segment(index, session)
+
+    def _send(self, session, buffer):
+        prepared = self.request.prepare()
+        if self._ranged:
+            prepared.headers['Range'] = 'bytes=%s-%s' % (buffer.start + buffer.received, buffer.end)
+            if self._if_range:
+                prepared.headers['If-Range'] = self._if_range
+        return session.send(prepared, **self.request_ctl_args)
+
+    def _receive(self, response, buffer):
+        """
+        :return: 段是否已经完整
+        """
+        response.raise_for_status()
+        if self._ranged:
+            check_range_response(response)
+        length = buffer.length()
+        for chunk in response.iter_content(chunk_size=RECEIVE_CHUNK_SIZE):
+            if not chunk:
+                continue
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume(self.host, len(chunk))
+            with self._cond:
+                if self._is_stopped():
+                    return False
+                if length >= 0:
+                    chunk = chunk[:length - buffer.received]
+                buffer.chunks.append(chunk)
+                buffer.received += len(chunk)
+                self._cond.notify_all()
+            if 0 <= length <= buffer.received:
+                return True
+        return length < 0
+
+    def _download_segment(self, index, session):
+        """下载一个段 出错时从已经收到的位置继续"""
+        buffer = self._buffers[index]
+        response = None
+        if index == 0:
+            response, self._probe_response = self._probe_response, None
+        retry = 0
+        while True:
+            if self._is_stopped():
+                if response is not None:
+                    release_response(response)
+                return
+            received = buffer.received
+            error = None
+            complete = False
+            try:
+                if response is None:
+                    response = self._send(session, buffer)
+                with response:
+                    complete = self._receive(response, buffer)
+            except Exception as receive_error:
+                error = receive_error
+            finally:
+                response = None
+            if complete:
+                with self._cond:
+                    buffer.done = True
+                    self._cond.notify_all()
+                return
+            if self._is_stopped():
+                return
+            if error is None:
+                if buffer.received > received:
+                    # 服务端返回的区间不完整 继续补充下载
+                    retry = 0
+                    continue
+                error = EmptyResponseException('range %s-%s returns no data' % (buffer.start + buffer.received,
+                                                                                buffer.end))
+            std_log('stream segment %s-%s occurs error, %s' % (buffer.start, buffer.end,
+                                                                ''.join(traceback.format_exception(
+                                                                    type(error), error, error.__traceback__))))
+            if buffer.received > received:
+                retry = 0
+            retry += 1
+            # 不支持Range时已经输出的数据无法续传
+            if self.retry_policy.is_fatal(error) or retry > self.max_error_retry or \
+                    (not self._ranged and buffer.received > 0):
+                self._fail(error)
+                return
+            self._stopped.wait(self.retry_policy.delay(retry, error))
+
+    def _fail(self, error):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+        self._stopped.set()
+
+    def iter_content(self):
+        """
+        按字节顺序迭代数据 开始迭代时才发出请求 只能迭代一次
+        迭代提前结束时停止下载 任意段失败时抛出该段的异常
+        """
+        self._start()
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        if self._error is not None:
+                            raise self._error
+                        if self._head >= len(self._segments):
+                            return
+                        buffer = self._buffers.get(self._head)
+                        if buffer is not None and buffer.chunks:
+                            chunk = buffer.chunks.popleft()
+                            break
+                        if buffer is not None and buffer.done:
+                            del self._buffers[self._head]
+                            self._head += 1
+                            self._cond.notify_all()
+                            continue
+                        self._cond.wait()
+                yield chunk
+        finally:
+            self.close()
+
+    def copy_to(self, fileobj):
+        """
+        按顺序写入文件对象 例如sys.stdout.buffer
+        :return: 写入的字节数
+        """
+        total = 0
+        for chunk in self.iter_content():
+            fileobj.write(chunk)
+            total += len(chunk)
+        fileobj.flush()
+        return total
+
+    def open(self, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        """
+        :return: 只读的文件对象 可以交给tarfile.open(fileobj=..., mode='r|*')等流式读取的库
+        """
+        return io.BufferedReader(_ChunkIO(self.iter_content()), buffer_size=buffer_size)
+
+    def close(self):
+        """停止下载 释放连接"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._stopped.set()
+        if self._probe_response is not None:
+            release_response(self._probe_response)
+            self._probe_response = None
+        self._session_pool.close()
+
+
+class _ChunkIO(io.RawIOBase):
+    """把数据块迭代器包装为只读的RawIOBase"""
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = chunks
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        length = min(len(buffer), len(self._pending))
+        buffer[:length] = self._pending[:length]
+        self._pending = self._pending[length:]
+        return length
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+        super().close()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+测试 asyncio下载引擎
+"""
+import asyncio
+import os
+import unittest
+import unittest.mock
+
+import requests
+
+import src.async_downloader as async_downloader
+import src.file_downloader as file_downloader
+from test.range_http_server import RangeHTTPServer
+
+
+@unittest.skipIf(async_downloader.aiohttp is None, 'aiohttp is not installed')
+class TestAsyncDownloaderCoordinator(unittest.TestCase):
+
+    def test_download_and_resume(self):
+        """
+        测试 下载完整文件 再根据断点文件的空洞续传
+        """
+        path = 'async_coordinator.test.tmp'
+        breakpoint_path = 'async_coordinator.breakpoint.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                          max_concurrency=4,
+                                                                          segment_size=10 * 1024,
+                                                                          finished_segment_file=breakpoint_path)
+                self.assertTrue(asyncio.run(coordinator.start()))
+                self.assertEqual(coordinator.get_all_failed_segment(), [], 'no failed segment')
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                data_length, segments = file_downloader.read_all_finished_segment_list(breakpoint_path)
+                self.assertEqual(segments, [[0, len(payload) - 1]], 'all segments recorded')
+                # 模拟中断 清掉一段数据再续传
+                with open(path, 'r+b') as fd:
+                    fd.seek(30 * 1024)
+                    fd.write(b'\0' * 20 * 1024)
+                holes = file_downloader.find_holes(data_length, [[0, 30 * 1024 - 1], [50 * 1024, data_length - 1]])
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                          segment_size=8 * 1024)
+                asyncio.run(coordinator.start(True, data_length, holes))
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content after resume')
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def test_server_without_range(self):
+        """
+        测试 服务端不支持Range时强制分段的下载停止并抛出RangeNotSupportedException 不分段时单连接下载完整文件
+        """
+        path = 'async_coordinator.no_range.test.tmp'
+        payload = os.urandom(300 * 1024)
+        try:
+            with RangeHTTPServer(payload, accept_ranges=False) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                          max_concurrency=4,
+                                                                          segment_size=64 * 1024)
+                with self.assertRaises(file_downloader.RangeNotSupportedException):
+                    asyncio.run(coordinator.start())
+                self.assertNotEqual(coordinator.get_all_failed_segment(), [], 'failed segment recorded')
+                os.remove(path)
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                          max_concurrency=4,
+                                                                          force_segment=False,
+                                                                          segment_size=64 * 1024)
+                self.assertTrue(asyncio.run(coordinator.start()))
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_error_status(self):
+        """
+        测试 Range请求返回空的错误响应时按重试策略重试 致命错误停止下载 不记录空的段
+        """
+        path = 'async_coordinator.error.test.tmp'
+        breakpoint_path = 'async_coordinator.error.breakpoint.test.tmp'
+        payload = os.urandom(64 * 1024)
+        try:
+            for status, expected_error in ((404, requests.HTTPError), (503, None)):
+                with RangeHTTPServer(payload, fail_ranges=True, fail_status=status) as server:
+                    request = requests.Request(method='GET', url=server.url)
+                    coordinator = async_downloader.AsyncDownloaderCoordinator(
+                        path, request, {'timeout': 10},
+                        segment_size=16 * 1024,
+                        max_error_retry=2,
+                        finished_segment_file=breakpoint_path,
+                        retry_policy=file_downloader.RetryPolicy(base_delay=0.01))
+                    if expected_error is None:
+                        self.assertTrue(asyncio.run(asyncio.wait_for(coordinator.start(), 30)))
+                        self.assertEqual(len(coordinator.get_all_failed_segment()), 4, 'all segments failed')
+                        # 探测请求和每段3次请求
+                        self.assertEqual(server.request_count, 1 + 4 * 3, 'retry times')
+                    else:
+                        with self.assertRaises(expected_error):
+                            asyncio.run(asyncio.wait_for(coordinator.start(), 30))
+                        self.assertLessEqual(server.request_count, 1 + 4, 'no retry after fatal error')
+                    self.assertEqual(file_downloader.read_all_finished_segment_list(breakpoint_path)[1], [],
+                                     'no empty segment recorded')
+                os.remove(path)
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def test_default_method_and_probe_error(self):
+        """
+        测试 请求没有method时按GET下载 探测请求返回错误状态时抛出FetchHeaderException
+        """
+        path = 'async_coordinator.probe.test.tmp'
+        payload = os.urandom(32 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, requests.Request(url=server.url),
+                                                                          {'timeout': 10},
+                                                                          segment_size=8 * 1024)
+                self.assertTrue(asyncio.run(coordinator.start()))
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+            os.remove(path)
+            with RangeHTTPServer(payload, fail_all=True, fail_status=404) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10})
+                with self.assertRaises(file_downloader.FetchHeaderException):
+                    asyncio.run(coordinator.start())
+            self.assertFalse(os.path.exists(path), 'no file created')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_progress(self):
+        """
+        测试 进度由ProgressReporter定期输出 结束时为100%
+        """
+        path = 'async_coordinator.progress.test.tmp'
+        payload = os.urandom(64 * 1024)
+        messages = []
+        try:
+            with RangeHTTPServer(payload, slow_range_starts=(0,)) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = async_downloader.AsyncDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                          segment_size=16 * 1024,
+                                                                          progress_interval=0.05)
+                with unittest.mock.patch.object(async_downloader, 'std_log', messages.append):
+                    self.assertTrue(asyncio.run(coordinator.start()))
+            progress = [message for message in messages if message.startswith('=====progress')]
+            self.assertGreater(len(progress), 1, 'periodic progress')
+            self.assertTrue(progress[-1].startswith('=====progress 100.0%'), 'finished')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+块校验增量更新测试
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+import src.delta_update as delta_update
+import src.file_downloader as file_downloader
+from test.range_http_server import RangeHTTPServer
+
+BLOCK_SIZE = 1024
+
+
+def make_new_version(old):
+    """在中间插入数据 并修改靠后的一块 后面的块不再对齐"""
+    new = bytearray(old[:20 * 1024] + os.urandom(100) + old[20 * 1024:])
+    new[50 * 1024:50 * 1024 + 10] = os.urandom(10)
+    return bytes(new)
+
+
+class TestDeltaUpdate(unittest.TestCase):
+
+    def setUp(self):
+        file_downloader.be_quiet()
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as fd:
+            fd.write(data)
+        return path
+
+    def test_index_round_trip(self):
+        """
+        测试 索引序列化后可以还原 最后一块较短
+        """
+        path = self._write('data.bin', os.urandom(10 * BLOCK_SIZE + 17))
+        index = delta_update.BlockIndex.generate(path, BLOCK_SIZE)
+        self.assertEqual(len(index.weak), 11)
+        index_path = os.path.join(self.work_dir, 'data.zidx')
+        index.save(index_path)
+        loaded = delta_update.BlockIndex.load(index_path)
+        self.assertEqual((loaded.length, loaded.block_size, loaded.sha256), (index.length, BLOCK_SIZE, index.sha256))
+        self.assertEqual((loaded.weak, loaded.strong), (index.weak, index.strong))
+        self.assertEqual(loaded.block_range(10), (10 * BLOCK_SIZE, 10 * BLOCK_SIZE + 16))
+
+    def test_find_shifted_blocks(self):
+        """
+        测试 插入数据后移位的块通过滚动校验找到
+        """
+        old = os.urandom(64 * 1024)
+        new = make_new_version(old)
+        index = delta_update.BlockIndex.generate(self._write('new.bin', new), BLOCK_SIZE)
+        matches = delta_update.find_local_blocks(index, self._write('old.bin', old))
+        for block, local_offset in matches.items():
+            start, end = index.block_range(block)
+            self.assertEqual(old[local_offset:local_offset + end - start + 1], new[start:end + 1])
+        self.assertGreaterEqual(len(matches), len(index.weak) - 3, 'insert and change touch at most 3 blocks')
+        self.assertIn(30, matches, 'block after insert is found at shifted offset')
+
+    def test_merge_gap(self):
+        """
+        测试 两个空洞之间短于merge_gap的复制区间放弃
+        """
+        index = delta_update.BlockIndex(10 * BLOCK_SIZE, BLOCK_SIZE, '', [0] * 10, [b''] * 10)
+        matches = {0: 0, 1: BLOCK_SIZE, 4: 4 * BLOCK_SIZE, 7: 7 * BLOCK_SIZE, 8: 100, 9: 100 + BLOCK_SIZE}
+        copies = delta_update.plan_local_copies(index, matches)
+        self.assertEqual(copies, [(0, 2047, 0), (4096, 5119, 4096), (7168, 8191, 7168), (8192, 10239, 100)])
+        copies = delta_update.plan_local_copies(index, matches, merge_gap=2 * BLOCK_SIZE)
+        self.assertEqual(copies, [(0, 2047, 0), (7168, 8191, 7168), (8192, 10239, 100)])
+
+    def test_delta_update(self):
+        """
+        测试 只下载旧文件中没有的区间 小空洞合并请求 结果按SHA-256校验 断点文件记录完整
+        """
+        old = os.urandom(64 * 1024)
+        new = make_new_version(old)
+        index = delta_update.BlockIndex.generate(self._write('new.src', new), BLOCK_SIZE)
+        local_path = self._write('old.bin', old)
+        path = os.path.join(self.work_dir, 'new.bin')
+        breakpoint_path = os.path.join(self.work_dir, 'new.bf')
+        with RangeHTTPServer(new) as server:
+            request = requests.Request(method='GET', url=server.url)
+            result = delta_update.delta_update(path, request, {'timeout': 10}, local_path, index,
+                                               finished_segment_file=breakpoint_path, merge_gap=0,
+                                               progress_interval=0)
+            self.assertLessEqual(result['downloaded_bytes'], 3 * BLOCK_SIZE)
+            self.assertEqual(result['reused_bytes'] + result['downloaded_bytes'], len(new))
+            self.assertEqual(server.request_count, 1, 'small holes are merged into a multi-range request')
+            self.assertIn(',', server.ranges[0])
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), new)
+        self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).find_holes(), (len(new), []))
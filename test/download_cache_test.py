@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+下载缓存测试
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import requests
+
+import src.download_cache as download_cache
+import src.file_downloader as file_downloader
+from test.range_http_server import RangeHTTPServer
+
+
+class TestDownloadCache(unittest.TestCase):
+
+    def setUp(self):
+        file_downloader.be_quiet()
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _fetch(self, cache, server, name, **kwargs):
+        path = os.path.join(self.work_dir, name)
+        request = requests.Request(method='GET', url=server.url)
+        result = cache.fetch(path, request, {'timeout': 10}, segment_size=16 * 1024, progress_interval=0, **kwargs)
+        with open(path, 'rb') as fd:
+            return result, fd.read()
+
+    def test_revalidate(self):
+        """
+        测试 第二次下载发送If-None-Match 304时从缓存复制 远端文件改变后重新下载
+        """
+        payload = os.urandom(64 * 1024)
+        with RangeHTTPServer(payload, etag='"v1"') as server:
+            cache = download_cache.DownloadCache(self.cache_dir)
+            self.assertEqual(self._fetch(cache, server, 'a.bin'), ('miss', payload))
+            request_count = server.request_count
+            self.assertEqual(self._fetch(cache, server, 'b.bin'), ('revalidated', payload))
+            self.assertEqual(server.request_count, request_count + 1, 'one conditional request')
+            server.payload = os.urandom(64 * 1024)
+            server.etag = '"v2"'
+            self.assertEqual(self._fetch(cache, server, 'c.bin'), ('miss', server.payload))
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 1))
+            self.assertEqual(stats['evictions'], 1, 'old object is no longer referenced')
+
+    def test_known_digest(self):
+        """
+        测试 已知sha256时不发请求直接命中 可以用硬链接放置
+        """
+        payload = os.urandom(64 * 1024)
+        digest = 'sha256:' + hashlib.sha256(payload).hexdigest()
+        with RangeHTTPServer(payload) as server:
+            cache = download_cache.DownloadCache(self.cache_dir, link_modes=('hardlink', 'copy'))
+            self.assertEqual(self._fetch(cache, server, 'a.bin', expected_digest=digest), ('miss', payload))
+            request_count = server.request_count
+            self.assertEqual(self._fetch(cache, server, 'b.bin', expected_digest=digest), ('hit', payload))
+            self.assertEqual(server.request_count, request_count)
+            object_path = os.path.join(self.cache_dir, 'objects', hashlib.sha256(payload).hexdigest())
+            self.assertEqual(os.stat(os.path.join(self.work_dir, 'b.bin')).st_ino, os.stat(object_path).st_ino)
+
+    def test_lru_eviction(self):
+        """
+        测试 超过容量时淘汰最久没有使用的对象
+        """
+        payloads = [os.urandom(32 * 1024) for _ in range(3)]
+        with RangeHTTPServer(payloads[0], etag='"a"') as server_a, \
+                RangeHTTPServer(payloads[1], etag='"b"') as server_b, \
+                RangeHTTPServer(payloads[2], etag='"c"') as server_c:
+            cache = download_cache.DownloadCache(self.cache_dir, max_size=64 * 1024)
+            self._fetch(cache, server_a, 'a.bin')
+            self._fetch(cache, server_b, 'b.bin')
+            self.assertEqual(self._fetch(cache, server_a, 'a.bin')[0], 'revalidated')
+            self._fetch(cache, server_c, 'c.bin')
+            self.assertEqual(self._fetch(cache, server_a, 'a.bin')[0], 'revalidated')
+            self.assertEqual(self._fetch(cache, server_b, 'b.bin')[0], 'miss', 'b is least recently used')
+            stats = cache.stats()
+            self.assertLessEqual(stats['size'], 64 * 1024)
+            self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'objects'))), 2)
+
+    def test_max_age(self):
+        """
+        测试 超过存放时间后重新下载
+        """
+        payload = os.urandom(16 * 1024)
+        with RangeHTTPServer(payload, etag='"v1"') as server:
+            cache = download_cache.DownloadCache(self.cache_dir, max_age=0.05)
+            self._fetch(cache, server, 'a.bin')
+            time.sleep(0.1)
+            self.assertEqual(self._fetch(cache, server, 'b.bin'), ('miss', payload))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+测试 批量下载管理器
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import requests
+
+import src.download_manager as download_manager
+import src.file_downloader as file_downloader
+from test.range_http_server import RangeHTTPServer
+
+
+class TestDownloadManager(unittest.TestCase):
+
+    def test_manifest_download(self):
+        """
+        测试 清单中的大小文件共享工作线程池下载
+        """
+        manifest_path = 'manager.manifest.test.tmp'
+        small_payload = os.urandom(2 * 1024)
+        large_payload = os.urandom(100 * 1024)
+        paths = ['manager.small.test.tmp', 'manager.large.test.tmp']
+        try:
+            with RangeHTTPServer(small_payload) as small_server, RangeHTTPServer(large_payload) as large_server:
+                with open(manifest_path, 'w') as fd:
+                    fd.write(json.dumps({'url': small_server.url, 'path': paths[0]}) + '\n')
+                    fd.write(json.dumps({'url': large_server.url, 'path': paths[1],
+                                         'headers': {'X-Test': '1'}}) + '\n')
+                with download_manager.DownloadManager(max_workers=4, per_host_connections=2,
+                                                      request_ctl_args={'timeout': 10},
+                                                      segment_size=10 * 1024) as manager:
+                    submitted = manager.submit_manifest(manifest_path)
+                    for _, future in submitted:
+                        self.assertTrue(future.result(timeout=30), 'file downloaded')
+                    progress = manager.progress()
+                self.assertEqual(small_server.request_count, 1, 'small file without segmentation')
+                self.assertEqual(large_server.request_count, 11, 'probe and segments')
+                self.assertEqual(progress['finished_files'], 2, 'finished files')
+                self.assertEqual(progress['downloaded_bytes'], len(small_payload) + len(large_payload),
+                                 'downloaded bytes')
+            for path, payload in zip(paths, (small_payload, large_payload)):
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+        finally:
+            for path in paths + [manifest_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_failed_file(self):
+        """
+        测试 单个文件失败不影响其它文件
+        """
+        path = 'manager.failed.test.tmp'
+        with download_manager.DownloadManager(max_workers=2, request_ctl_args={'timeout': 1}) as manager:
+            future = manager.submit(path, requests.Request(method='GET', url='http://127.0.0.1:1/file'))
+            self.assertIsNotNone(future.exception(timeout=30), 'probe failed')
+        self.assertFalse(os.path.exists(path), 'no file created')
+
+    def test_breakpoint_missing(self):
+        """
+        测试 断点文件不存在或为空时从头下载
+        """
+        path = 'manager.resume.test.tmp'
+        segment_file = path + '.bp'
+        payload = os.urandom(30 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                with download_manager.DownloadManager(max_workers=2, request_ctl_args={'timeout': 10},
+                                                      segment_size=10 * 1024) as manager:
+                    request = requests.Request(method='GET', url=server.url)
+                    future = manager.submit(path, request, segment_file, from_breakpoint=True)
+                    self.assertTrue(future.result(timeout=30), 'missing break point file')
+                    open(segment_file, 'w').close()
+                    future = manager.submit(path, request, segment_file, from_breakpoint=True)
+                    self.assertTrue(future.result(timeout=30), 'empty break point file')
+                    self.assertEqual(manager.progress()['finished_files'], 2, 'finished files')
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), payload, 'file content')
+        finally:
+            for name in (path, segment_file):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def test_exit_without_shutdown(self):
+        """
+        测试 未调用shutdown时解释器可以正常退出
+        """
+        path = 'manager.exit.test.tmp'
+        script = '\n'.join([
+            'import os, requests',
+            'import src.download_manager as download_manager',
+            'from test.range_http_server import RangeHTTPServer',
+            'server = RangeHTTPServer(os.urandom(20 * 1024)).__enter__()',
+            'manager = download_manager.DownloadManager(max_workers=2, segment_size=10 * 1024)',
+            'future = manager.submit(%r, requests.Request(method="GET", url=server.url))' % path,
+            'assert future.result(timeout=30)',
+        ])
+        try:
+            completed = subprocess.run([sys.executable, '-c', script], timeout=60,
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            self.assertEqual(completed.returncode, 0, 'interpreter exited')
+        finally:
+            for name in (path, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path)):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def test_retry_without_range(self):
+        """
+        测试 不支持Range的服务端中途断开时 重新下载完整文件 不发送Range请求
+        """
+        path = 'manager.no_range.test.tmp'
+        payload = os.urandom(64 * 1024)
+        try:
+            for size in (len(payload), 16 * 1024):
+                with RangeHTTPServer(payload, accept_ranges=False, truncate_once_starts=[0]) as server:
+                    with download_manager.DownloadManager(max_workers=2, request_ctl_args={'timeout': 10},
+                                                          small_file_size=size,
+                                                          retry_policy=file_downloader.RetryPolicy(
+                                                              base_delay=0.01)) as manager:
+                        future = manager.submit(path, requests.Request(method='GET', url=server.url))
+                        self.assertTrue(future.result(timeout=30), 'file downloaded')
+                        self.assertEqual(manager.progress()['downloaded_bytes'], len(payload), 'downloaded bytes')
+                    self.assertEqual(server.ranges, [None, None], 'whole file requested again')
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                os.remove(path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
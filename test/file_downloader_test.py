@@ -2,10 +2,15 @@
 """
 测试
 """
+import hashlib
 import os
+import time
 import unittest
 
+import requests
+
 import src.file_downloader as file_downloader
+from test.range_http_server import RangeHTTPServer
 
 
 class TestGlobalFunction(unittest.TestCase):
@@ -33,6 +38,69 @@ class TestGlobalFunction(unittest.TestCase):
         finally:
             os.remove(path)
 
+    def test_read_segments_with_crc32(self):
+        """
+        测试 start,end,crc32格式的段记录与start,end格式混合读取
+        """
+        path = 'segment_list.crc32.test.temp'
+        try:
+            with open(path, 'w') as fd:
+                fd.write('%s\n' % 48)
+                fd.write('%s,%s,%08x\n' % (0, 23, 0xdeadbeef))
+                fd.write('%s,%s\n' % (24, 32))
+                fd.write('%s,%s,%08x\n' % (45, 47, 0))
+                fd.write('%s,%s,%08x\n' % (0, 23, 0x1234))
+            data_length, segment_list = file_downloader.read_all_finished_segment_list(path)
+            self.assertEqual(data_length, 48, 'data length must match')
+            self.assertEqual(segment_list, [[0, 32], [45, 47]], 'merged segments')
+            self.assertEqual(file_downloader.read_segment_digests(path), {(0, 23): 0x1234, (45, 47): 0},
+                             'last crc32 of each segment')
+        finally:
+            os.remove(path)
+
+    def test_dedicated_session(self):
+        """
+        测试 池中Session都被占用时 对冲线程的专用Session不需要等待 并计入连接统计
+        """
+        pool = file_downloader.SessionPool(1)
+        with pool.session() as worker_session:
+            with pool.dedicated_session() as session:
+                self.assertIsNot(session, worker_session, 'not taken from the pool')
+            self.assertEqual(pool.stats()['sessions'], 2, 'counted in stats')
+        pool.close()
+
+    def test_group_small_segments(self):
+        segments = [(0, 9), (20, 29), (40, 1039), (2000, 2009), (3000, 3009), (4000, 4009)]
+        batches, others = file_downloader.group_small_segments(segments, 100, 2, 1000)
+        self.assertEqual([batch.ranges for batch in batches],
+                         [[(0, 9), (20, 29)], [(2000, 2009), (3000, 3009)]])
+        self.assertEqual(others, [(40, 1039), (4000, 4009)])
+        self.assertEqual(file_downloader.subtract_segments([(0, 99)], [(10, 19), (50, 99)]), [(0, 9), (20, 49)])
+
+    def test_source_selector(self):
+        fast, slow = requests.Request(url='http://fast/file'), requests.Request(url='http://slow/file')
+        selector = file_downloader.SourceSelector([fast, slow])
+        first, second = selector.acquire(), selector.acquire()
+        self.assertEqual((first.request, second.request), (fast, slow), 'unmeasured source is tried')
+        selector.record_success(first, 10 * 1024, 1)
+        selector.record_success(second, 1024, 1)
+        chosen = [selector.acquire().request for _ in range(11)]
+        self.assertEqual((chosen.count(fast), chosen.count(slow)), (10, 1))
+
+    def test_retry_policy(self):
+        def http_error(status, headers=None):
+            response = requests.Response()
+            response.status_code = status
+            response.headers.update(headers or {})
+            return requests.HTTPError(response=response)
+        policy = file_downloader.RetryPolicy(base_delay=1, max_delay=4)
+        self.assertTrue(policy.is_fatal(http_error(404)))
+        self.assertFalse(policy.is_fatal(http_error(503)))
+        self.assertFalse(policy.is_fatal(requests.ConnectionError()))
+        self.assertLessEqual(policy.delay(10, requests.ConnectionError()), 4)
+        self.assertGreaterEqual(policy.delay(1, http_error(429, {'Retry-After': '7'})), 7)
+        self.assertAlmostEqual(file_downloader.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
     def test_find_holes(self):
         fix_data_length = 48
         single_segments = [
@@ -51,6 +119,69 @@ class TestGlobalFunction(unittest.TestCase):
         self.assertTrue(hole_segments[1][0] == 41 and hole_segments[1][1] == 47, 'last hole')
 
 
+class TestBitmapJournal(unittest.TestCase):
+
+    def test_record_and_find_holes(self):
+        """
+        测试 位图断点文件记录完成段 重新打开后计算空洞
+        """
+        path = 'bitmap_journal.test.tmp'
+        try:
+            journal = file_downloader.BitmapJournal(path, block_size=10, sync_interval=0.01)
+            journal.record_data_length(95, etag='"abc"')
+            journal.record_finished_segment(0, 24)
+            # 相邻段补齐同一个块
+            journal.record_finished_segment(25, 29)
+            # 段边缘不完整的块不标记
+            journal.record_finished_segment(35, 64)
+            journal.record_finished_segment(80, 94)
+            journal.close()
+            journal = file_downloader.BitmapJournal.load(path)
+            self.assertEqual(journal.etag, '"abc"', 'etag')
+            self.assertEqual(journal.find_holes(), (95, [[30, 39], [60, 79]]), 'holes')
+            journal.close()
+        finally:
+            os.remove(path)
+
+    def test_convert_text_breakpoint_file(self):
+        """
+        测试 文本断点文件转换为位图断点文件
+        """
+        path = 'bitmap_journal.convert.test.tmp'
+        try:
+            with open(path, 'w') as fd:
+                fd.write('48\n0,24\n24,32\n45,47\n')
+            self.assertFalse(file_downloader.BitmapJournal.is_bitmap_journal(path), 'text format')
+            journal = file_downloader.open_breakpoint_journal(path, 'bitmap', block_size=8)
+            self.assertTrue(file_downloader.BitmapJournal.is_bitmap_journal(path), 'converted in place')
+            self.assertEqual(journal.find_holes(), (48, [[32, 47]]), 'holes')
+            journal.close()
+        finally:
+            os.remove(path)
+
+
+    def test_breakpoint_validators(self):
+        """
+        测试 断点文件记录ETag和Last-Modified 转换为位图断点文件后保留
+        """
+        path = 'breakpoint.validators.test.tmp'
+        last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        try:
+            breakpoint = file_downloader.BreakpointFile(path)
+            breakpoint.record_data_length(48, '"v1"', last_modified)
+            breakpoint.record_finished_segment(0, 31)
+            self.assertEqual(breakpoint.validators(), ('"v1"', last_modified))
+            self.assertEqual(breakpoint.find_holes(), (48, [[32, 47]]))
+            journal = file_downloader.open_breakpoint_journal(path, 'bitmap', block_size=8)
+            self.assertEqual(journal.validators(), ('"v1"', last_modified), 'converted')
+            journal.close()
+            self.assertEqual(file_downloader.BitmapJournal.load(path).validators(), ('"v1"', last_modified))
+            self.assertEqual(file_downloader.get_if_range('W/"v1"', last_modified), last_modified, 'weak etag')
+            self.assertIsNone(file_downloader.get_if_range(None, None))
+        finally:
+            os.remove(path)
+
+
 class TestSegmentWriter(unittest.TestCase):
 
     def test_write_data(self):
@@ -64,4 +195,633 @@ class TestSegmentWriter(unittest.TestCase):
             self.assertTrue(writer.left_capacity() == 20 - len(data), 'left capacity')
             writer.close()
         finally:
-            os.remove(path)
\ No newline at end of file
+            os.remove(path)
+
+    def test_buffered_write_with_shared_storage(self):
+        """
+        测试 共享FileStorage的合并写入
+        """
+        path = 'segmentwriter.storage.test.tmp'
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, 64, overwrite_if_already_exists=True)
+            self.assertEqual(os.path.getsize(path), 64, 'preallocated size')
+            storage = file_downloader.FileStorage(path)
+            first = file_downloader.SegmentWriter(path, 0, 32, storage=storage, buffer_size=16)
+            second = file_downloader.SegmentWriter(path, 32, 32, storage=storage, buffer_size=16)
+            for _ in range(8):
+                first.write(b'ab')
+                second.write(b'cd')
+            first.write(b'x' * 16)
+            second.write(b'y' * 16)
+            self.assertEqual(first.left_capacity(), 0, 'left capacity')
+            self.assertRaises(file_downloader.OverWriteException, first.write, b'z')
+            first.close()
+            second.close()
+            storage.close()
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), b'ab' * 8 + b'x' * 16 + b'cd' * 8 + b'y' * 16, 'file content')
+        finally:
+            os.remove(path)
+
+    def test_storage_without_pread_and_pwrite(self):
+        """
+        测试 不支持pread/pwrite的平台用锁保护seek + read/write
+        """
+        path = 'segmentwriter.seek.test.tmp'
+        os_pread, os_pwrite = os.pread, os.pwrite
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, 64, overwrite_if_already_exists=True)
+            del os.pread, os.pwrite
+            storage = file_downloader.FileStorage(path)
+            storage.pwrite(b'b' * 32, 32)
+            storage.pwrite(b'a' * 32, 0)
+            self.assertEqual(storage.pread(16, 32), b'a' * 16 + b'b' * 16, 'read across writes')
+            storage.close()
+        finally:
+            os.pread, os.pwrite = os_pread, os_pwrite
+            os.remove(path)
+
+    def test_hedge_cut(self):
+        """
+        测试 对冲后不再切分 对冲请求领先时停在当前写入位置
+        """
+        path = 'segmentwriter.hedge.test.tmp'
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, 64, overwrite_if_already_exists=True)
+            writer = file_downloader.SegmentWriter(path, 16, 48)
+            writer.write(b'a' * 8)
+            self.assertEqual(writer.start_hedge(8), (24, 63), 'remaining range')
+            self.assertIsNone(writer.start_hedge(8), 'only one hedge')
+            self.assertIsNone(writer.split(8), 'hedged writer is not split')
+            self.assertIsNone(writer.cut(24), 'writer is not behind')
+            self.assertEqual(writer.cut(40), 24, 'stop at current offset')
+            self.assertEqual(writer.left_capacity(), 0, 'left capacity')
+            self.assertEqual(writer.write_capped(b'b' * 8), 0, 'bytes after cut are dropped')
+            writer.close()
+            self.assertEqual(writer.persisted_length(), 8, 'persisted length')
+        finally:
+            os.remove(path)
+
+    def test_split_and_seal(self):
+        """
+        测试 切分让出后一半 结束后不再切分
+        """
+        path = 'segmentwriter.split.test.tmp'
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, 64, overwrite_if_already_exists=True)
+            writer = file_downloader.SegmentWriter(path, 0, 64)
+            writer.write(b'a' * 16)
+            self.assertEqual(writer.split(8), (40, 63), 'second half of remaining range')
+            self.assertIsNone(writer.split(16), 'remaining range too small')
+            self.assertEqual(writer.seal(), 39, 'limit after split')
+            self.assertIsNone(writer.split(4), 'sealed writer is not split')
+            writer.close()
+        finally:
+            os.remove(path)
+
+
+class TestAdaptiveTuner(unittest.TestCase):
+
+    def test_additive_increase_and_back_off(self):
+        """
+        测试 吞吐提升时加连接 不再提升时回退 限流时减半
+        """
+        tuner = file_downloader.AdaptiveTuner(max_thread=8, initial_thread=2)
+        self.assertEqual(tuner.update(100, 2), 3, 'increase while gaining')
+        self.assertEqual(tuner.update(150, 3), 4, 'increase while gaining')
+        self.assertEqual(tuner.update(151, 4), 3, 'back off when no gain')
+        self.assertEqual(tuner.update(150, 3), 3, 'hold at ceiling')
+        error = requests.HTTPError(response=requests.Response())
+        error.response.status_code = 503
+        tuner.record_error(error)
+        self.assertEqual(tuner.update(150, 3), 1, 'halve on throttle')
+        self.assertEqual(len(tuner.history), 5, 'throughput curve')
+
+    def test_segment_size(self):
+        """
+        测试 段大小覆盖足够多个RTT
+        """
+        tuner = file_downloader.AdaptiveTuner(min_segment_size=1024, max_segment_size=1024 * 1024,
+                                              rtt_rounds=10, min_request_duration=0.1)
+        tuner.record_ttfb(0.05)
+        self.assertEqual(tuner.segment_size(4000, 2), 1024, 'min segment size')
+        self.assertEqual(tuner.segment_size(400000, 2), 100000, 'rtt rounds')
+        self.assertEqual(tuner.segment_size(10 ** 9, 1), 1024 * 1024, 'max segment size')
+
+
+class TestDownloaderCoordinator(unittest.TestCase):
+
+    def test_reuse_connection(self):
+        """
+        测试 多个段复用keep-alive连接
+        """
+        path = 'coordinator.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=2,
+                                                                    segment_size=10 * 1024)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                stats = coordinator.get_connection_stats()
+                self.assertEqual(stats['requests'], 10, 'probe response is the first segment')
+                self.assertEqual(server.ranges[0], 'bytes=0-%s' % (10 * 1024 - 1), 'ranged probe')
+                self.assertEqual(stats['connections'], server.connection_count, 'handshake count')
+                self.assertLessEqual(stats['connections'], 3, 'one connection per worker plus probe')
+                self.assertEqual(stats['reused'], stats['requests'] - stats['connections'], 'reused count')
+        finally:
+            os.remove(path)
+
+    def test_zero_copy_receive(self):
+        """
+        测试 readinto接收模式 数据正确且连接可复用
+        """
+        path = 'coordinator.zerocopy.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=2,
+                                                                    segment_size=10 * 1024,
+                                                                    zero_copy_receive=True,
+                                                                    receive_buffer_size=4096)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertLessEqual(coordinator.get_connection_stats()['connections'], 3, 'connection reused')
+        finally:
+            os.remove(path)
+
+    def test_work_stealing(self):
+        """
+        测试 空闲线程切分慢速段的剩余区间
+        """
+        path = 'coordinator.steal.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            with RangeHTTPServer(payload, slow_range_starts=(0,)) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=2,
+                                                                    segment_size=50 * 1024,
+                                                                    min_steal_size=4 * 1024)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertGreater(coordinator.get_stolen_count(), 0, 'slow segment split')
+                self.assertEqual(coordinator.get_all_failed_segment(), [], 'no failed segment')
+        finally:
+            os.remove(path)
+
+    def test_faulty_server(self):
+        """
+        测试 服务端随机重置连接和返回较短区间时 重试补齐后文件正确
+        """
+        path = 'coordinator.faulty.test.tmp'
+        payload = os.urandom(200 * 1024)
+        try:
+            with RangeHTTPServer(payload, reset_rate=0.2, short_rate=0.2, seed=1) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=4,
+                                                                    segment_size=32 * 1024,
+                                                                    max_error_retry=100)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertEqual(coordinator.get_all_failed_segment(), [], 'no failed segment')
+        finally:
+            os.remove(path)
+
+    def test_hedge_slow_segment(self):
+        """
+        测试 慢速段的剩余区间由对冲请求接管 不需要等慢速连接返回全部数据
+        """
+        path = 'coordinator.hedge.test.tmp'
+        payload = os.urandom(1024 * 1024)
+        try:
+            with RangeHTTPServer(payload, slow_range_starts=(0,)) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=4,
+                                                                    segment_size=256 * 1024,
+                                                                    work_stealing=False,
+                                                                    hedging=True,
+                                                                    hedge_delay=0.2,
+                                                                    hedge_interval=0.1,
+                                                                    hedge_min_size=16 * 1024,
+                                                                    verify_digest=True)
+                begin = time.monotonic()
+                coordinator.start().result()
+                self.assertLess(time.monotonic() - begin, 2, 'slow segment takes 2.5s without hedging')
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertEqual(coordinator.get_hedge_stats(), {'hedges': 1, 'wins': 1})
+                self.assertEqual(coordinator.get_all_failed_segment(), [], 'no failed segment')
+        finally:
+            os.remove(path)
+
+    def test_memory_sink(self):
+        """
+        测试 小对象下载到内存 只有探测请求 不创建文件 大对象分段写入内存缓冲区并校验
+        """
+        small = os.urandom(10 * 1024)
+        large = os.urandom(200 * 1024)
+        with RangeHTTPServer(small) as small_server, RangeHTTPServer(large) as large_server:
+            request = requests.Request(method='GET', url=small_server.url)
+            self.assertEqual(file_downloader.download_to_memory(request, {'timeout': 10}), small)
+            self.assertEqual(small_server.request_count, 1, 'probe is the only request')
+            request = requests.Request(method='GET', url=large_server.url)
+            data = file_downloader.download_to_memory(request, {'timeout': 10}, zero_copy=True,
+                                                      segment_size=32 * 1024, verify_digest=True,
+                                                      expected_digest='sha256:' + hashlib.sha256(large).hexdigest())
+            self.assertIsInstance(data, memoryview)
+            self.assertEqual(data, large)
+            self.assertRaises(ValueError, file_downloader.download_to_memory, request, {'timeout': 10},
+                              max_size=100 * 1024)
+
+    def test_custom_sink(self):
+        """
+        测试 自定义写入目标 成功时finalize的返回值作为结果 失败时调用abort
+        """
+        class ChunkSink(file_downloader.DownloadSink):
+            def __init__(self):
+                self.chunks = {}
+                self.aborted = False
+
+            def open(self, data_length, resume=False, overwrite=False):
+                self.data_length = data_length
+
+            def pwrite(self, data, offset):
+                self.chunks[offset] = bytes(data)
+
+            def finalize(self):
+                return b''.join(self.chunks[offset] for offset in sorted(self.chunks))
+
+            def abort(self):
+                self.aborted = True
+
+        payload = os.urandom(100 * 1024)
+        with RangeHTTPServer(payload) as server:
+            request = requests.Request(method='GET', url=server.url)
+            sink = ChunkSink()
+            coordinator = file_downloader.DownloaderCoordinator(None, request, {'timeout': 10},
+                                                                segment_size=16 * 1024, sink=sink)
+            self.assertEqual(coordinator.start().result(), payload)
+            self.assertEqual(sink.data_length, len(payload))
+            server.fail_ranges = True
+            server.fail_status = 404
+            sink = ChunkSink()
+            coordinator = file_downloader.DownloaderCoordinator(None, request, {'timeout': 10},
+                                                                segment_size=16 * 1024, sink=sink)
+            self.assertRaises(requests.HTTPError, coordinator.start().result)
+            self.assertTrue(sink.aborted, 'aborted')
+
+    def test_auto_tune(self):
+        """
+        测试 自动调整模式
+        """
+        path = 'coordinator.auto.test.tmp'
+        payload = os.urandom(200 * 1024)
+        try:
+            with RangeHTTPServer(payload, slow_range_starts=(0,)) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=4,
+                                                                    segment_size=20 * 1024,
+                                                                    auto_tune=True,
+                                                                    tune_interval=0.1)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                summary = coordinator.get_tune_summary()
+                self.assertTrue(summary['curve'], 'throughput curve')
+                self.assertLessEqual(max(item['threads'] for item in summary['curve']), 4, 'max thread')
+        finally:
+            os.remove(path)
+
+    def test_resume_with_bitmap_journal(self):
+        """
+        测试 位图断点文件记录和续传
+        """
+        path = 'coordinator.bitmap.test.tmp'
+        journal_path = 'coordinator.bitmap.journal.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                journal = file_downloader.BitmapJournal(journal_path, block_size=4096)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=10 * 1024,
+                                                                    breakpoint_journal=journal)
+                coordinator.start().result()
+                journal = file_downloader.BitmapJournal.load(journal_path)
+                self.assertEqual(journal.find_holes(), (len(payload), []), 'no hole')
+                # 模拟部分块未完成
+                journal.close()
+                with open(journal_path, 'r+b') as fd:
+                    fd.seek(file_downloader.BitmapJournal.HEADER_SIZE + 3)
+                    fd.write(b'\0\0')
+                with open(path, 'r+b') as fd:
+                    fd.seek(3 * 4096)
+                    fd.write(b'\0' * 2 * 4096)
+                journal = file_downloader.open_breakpoint_journal(journal_path)
+                data_length, holes = journal.find_holes()
+                self.assertEqual(holes, [[3 * 4096, 5 * 4096 - 1]], 'holes')
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    breakpoint_journal=journal)
+                coordinator.start(True, data_length, holes).result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+        finally:
+            for temp_file in (path, journal_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def _resume_small_holes(self, multi_range):
+        path = 'coordinator.multi_range.test.tmp'
+        payload = os.urandom(64 * 1024)
+        holes = [(1000, 1999), (5000, 5099), (9000, 9999), (30000, 30000)]
+        try:
+            with RangeHTTPServer(payload, multi_range=multi_range) as server:
+                with open(path, 'wb') as fd:
+                    fd.write(payload)
+                with open(path, 'r+b') as fd:
+                    for start, end in holes:
+                        fd.seek(start)
+                        fd.write(b'\0' * (end - start + 1))
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=2)
+                coordinator.start(True, len(payload), holes).result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                return server.ranges
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_resume_with_multi_range(self):
+        """
+        测试 小空洞合并为一个multi-range请求
+        """
+        ranges = self._resume_small_holes(multi_range=True)
+        self.assertEqual(ranges, ['bytes=1000-1999,5000-5099,9000-9999,30000-30000'])
+
+    def test_resume_multi_range_fallback(self):
+        """
+        测试 服务端返回200完整响应时退回逐段请求
+        """
+        ranges = self._resume_small_holes(multi_range=False)
+        self.assertEqual(ranges[0], 'bytes=1000-1999,5000-5099,9000-9999,30000-30000')
+        self.assertEqual(sorted(ranges[1:]), sorted(['bytes=1000-1999', 'bytes=5000-5099',
+                                                     'bytes=9000-9999', 'bytes=30000-30000']))
+
+    def test_verify_crc_and_digest(self):
+        """
+        测试 续传时抽查段CRC32 损坏的段重新下载 结束后校验SHA-256
+        """
+        path = 'coordinator.verify.test.tmp'
+        breakpoint_path = 'coordinator.verify.breakpoint.test.tmp'
+        payload = os.urandom(100 * 1024)
+        sha256 = hashlib.sha256(payload).hexdigest()
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=10 * 1024,
+                                                                    finished_segment_file=breakpoint_path,
+                                                                    verify_digest=True,
+                                                                    expected_digest='sha256:%s' % sha256)
+                coordinator.start().result()
+                self.assertEqual(len(file_downloader.read_segment_digests(breakpoint_path)), 10)
+                with open(path, 'r+b') as fd:
+                    fd.seek(25 * 1024)
+                    fd.write(bytes([payload[25 * 1024] ^ 0xff]))
+                data_length, holes = file_downloader.BreakpointFile(breakpoint_path).find_holes()
+                self.assertEqual(holes, [], 'no hole')
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=10 * 1024,
+                                                                    finished_segment_file=breakpoint_path,
+                                                                    verify_resume=-1,
+                                                                    verify_digest=True,
+                                                                    expected_digest='sha256:%s' % sha256)
+                coordinator.start(True, data_length, holes).result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                os.remove(path)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    verify_digest=True,
+                                                                    expected_digest='sha256:%s' % ('0' * 64))
+                with self.assertRaises(file_downloader.IntegrityException):
+                    coordinator.start().result()
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def test_mirror_sources(self):
+        """
+        测试 多源下载 长度不一致的源在探测时丢弃 连续失败的源在下载中丢弃
+        """
+        path = 'coordinator.mirror.test.tmp'
+        payload = os.urandom(128 * 1024)
+        try:
+            with RangeHTTPServer(payload) as good, RangeHTTPServer(payload, fail_ranges=True) as failing, \
+                    RangeHTTPServer(payload[:-1]) as different:
+                sources = [requests.Request(method='GET', url=server.url) for server in (good, failing, different)]
+                # 缩短退避等待 失败源没有在探测时丢弃时 也能在正常源下载完之前达到连续失败次数
+                coordinator = file_downloader.DownloaderCoordinator(path, sources, {'timeout': 10},
+                                                                    max_thread=4,
+                                                                    segment_size=8 * 1024,
+                                                                    retry_policy=file_downloader.RetryPolicy(
+                                                                        base_delay=0.01))
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                stats = coordinator.get_source_stats()
+                self.assertEqual([source['dropped'] for source in stats], [False, True, True])
+                self.assertEqual(stats[0]['downloaded_bytes'], len(payload))
+                self.assertEqual(different.request_count, 1, 'only probe')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_retry_keeps_partial_bytes(self):
+        """
+        测试 连接中断后从最后写入的位置继续 大段内记录检查点
+        """
+        path = 'coordinator.partial.test.tmp'
+        breakpoint_path = 'coordinator.partial.breakpoint.test.tmp'
+        payload = os.urandom(256 * 1024)
+        try:
+            with RangeHTTPServer(payload, truncate_once_starts=[64 * 1024]) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(
+                    path, request, {'timeout': 10},
+                    max_thread=2,
+                    segment_size=64 * 1024,
+                    finished_segment_file=breakpoint_path,
+                    write_buffer_size=4 * 1024,
+                    checkpoint_size=16 * 1024,
+                    retry_policy=file_downloader.RetryPolicy(base_delay=0.01))
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertIn('bytes=%s-%s' % (96 * 1024, 128 * 1024 - 1), server.ranges, 'resume from half')
+                digests = file_downloader.read_segment_digests(breakpoint_path)
+                self.assertGreater(len(digests), 4, 'checkpoints inside segments')
+                self.assertEqual(file_downloader.verify_segment_digests(path, digests), [])
+                self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).find_holes(), (len(payload), []))
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def test_fatal_status_fails_fast(self):
+        """
+        测试 404不重试 整个下载失败
+        """
+        path = 'coordinator.fatal.test.tmp'
+        payload = os.urandom(64 * 1024)
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, len(payload))
+            with RangeHTTPServer(payload, fail_ranges=True, fail_status=404) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    max_thread=2,
+                                                                    segment_size=8 * 1024)
+                with self.assertRaises(requests.HTTPError):
+                    coordinator.start(True, len(payload), [[0, len(payload) - 1]]).result()
+                self.assertLessEqual(server.request_count, 2, 'at most one request per thread')
+                self.assertTrue(coordinator.get_all_failed_segment())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_probe_without_range_support(self):
+        """
+        测试 服务端不支持Range时探测响应就是完整的文件
+        """
+        path = 'coordinator.no_range.test.tmp'
+        payload = os.urandom(64 * 1024)
+        try:
+            with RangeHTTPServer(payload, accept_ranges=False) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=8 * 1024)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertEqual(server.request_count, 1, 'only probe')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_discover_data_length(self):
+        """
+        测试 Content-Range没有总长度时 用单字节Range请求找出总长度 包括恰好在2倍边界上的长度
+        """
+        for length in (16 * 1024, 16 * 1024 + 1, 32 * 1024, 100 * 1000):
+            with RangeHTTPServer(os.urandom(length), hide_length=True) as server, requests.Session() as session:
+                request = requests.Request(method='GET', url=server.url)
+                self.assertEqual(file_downloader.discover_data_length(session, request, {'timeout': 10},
+                                                                      16 * 1024 - 1), length)
+                self.assertLessEqual(server.request_count, 20, 'doubling then binary search')
+        with RangeHTTPServer(os.urandom(1024), accept_ranges=False) as server, requests.Session() as session:
+            request = requests.Request(method='GET', url=server.url)
+            self.assertEqual(file_downloader.discover_data_length(session, request, {'timeout': 10}, 0), -1)
+
+    def test_disable_segment(self):
+        """
+        测试 force_segment为False时探测返回206仍然分段 探测返回200时用探测响应单连接下载完整文件
+        """
+        path = 'coordinator.single.test.tmp'
+        payload = os.urandom(100 * 1024)
+        try:
+            for accept_ranges in (True, False):
+                with RangeHTTPServer(payload, accept_ranges=accept_ranges) as server:
+                    request = requests.Request(method='GET', url=server.url)
+                    coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                        force_segment=False,
+                                                                        segment_size=16 * 1024,
+                                                                        progress_interval=0)
+                    coordinator.start().result()
+                    with open(path, 'rb') as fd:
+                        self.assertEqual(fd.read(), payload, 'file content')
+                    if accept_ranges:
+                        self.assertIn('bytes=16384-32767', server.ranges, 'segmented')
+                    else:
+                        self.assertEqual(server.request_count, 1, 'probe response is the whole file')
+                os.remove(path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_segment_without_length_and_accept_ranges(self):
+        """
+        测试 服务端不返回总长度和Accept-Ranges但支持Range时 确定长度后分段下载 不支持Range的chunked响应仍然单连接下载
+        """
+        path = 'coordinator.unknown_length.test.tmp'
+        payload = os.urandom(100 * 1024 + 123)
+        try:
+            with RangeHTTPServer(payload, advertise_ranges=False, hide_length=True) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    force_segment=False,
+                                                                    segment_size=16 * 1024,
+                                                                    verify_digest=True,
+                                                                    progress_interval=0)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertIn('bytes=16384-32767', server.ranges, 'segmented')
+            os.remove(path)
+            with RangeHTTPServer(payload, accept_ranges=False, hide_length=True) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=16 * 1024,
+                                                                    progress_interval=0)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertEqual(server.request_count, 1, 'chunked probe response is the whole file')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_resume_changed_file(self):
+        """
+        测试 续传时If-Range不匹配 从头重新下载
+        """
+        path = 'coordinator.changed.test.tmp'
+        breakpoint_path = 'coordinator.changed.breakpoint.test.tmp'
+        payload = os.urandom(64 * 1024)
+        changed_payload = os.urandom(80 * 1024)
+        try:
+            with RangeHTTPServer(payload, etag='"v1"') as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=8 * 1024,
+                                                                    finished_segment_file=breakpoint_path)
+                coordinator.start().result()
+                self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).validators(), ('"v1"', None))
+                server.payload, server.etag = changed_payload, '"v2"'
+                del server.ranges[:]
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=8 * 1024,
+                                                                    finished_segment_file=breakpoint_path)
+                coordinator.start(True, len(payload), [[0, 8 * 1024 - 1]]).result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), changed_payload, 'file content')
+                self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).validators(), ('"v2"', None))
+                self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).find_holes(),
+                                 (len(changed_payload), []))
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
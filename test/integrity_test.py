@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+测试 完整性校验
+"""
+import base64
+import hashlib
+import os
+import unittest
+import zlib
+
+import src.integrity as integrity
+
+
+class TestIntegrity(unittest.TestCase):
+
+    def test_verify_segment_digests(self):
+        path = 'integrity.test.tmp'
+        payload = os.urandom(300 * 1024)
+        digests = {(start, start + 100 * 1024 - 1): zlib.crc32(payload[start:start + 100 * 1024])
+                   for start in range(0, len(payload), 100 * 1024)}
+        try:
+            with open(path, 'wb') as fd:
+                fd.write(payload)
+            self.assertEqual(integrity.verify_segment_digests(path, digests), [])
+            with open(path, 'r+b') as fd:
+                fd.seek(150 * 1024)
+                fd.write(bytes([payload[150 * 1024] ^ 0xff]))
+            self.assertEqual(integrity.verify_segment_digests(path, digests), [(100 * 1024, 200 * 1024 - 1)])
+            self.assertEqual(integrity.file_digest(path, 'sha256', block_size=64 * 1024),
+                             hashlib.sha256(open(path, 'rb').read()).hexdigest())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_verify_without_pread(self):
+        """
+        测试 不支持pread的平台用seek + read校验
+        """
+        path = 'integrity.seek.test.tmp'
+        payload = os.urandom(300 * 1024)
+        digests = {(start, start + 50 * 1024 - 1): zlib.crc32(payload[start:start + 50 * 1024])
+                   for start in range(0, len(payload), 50 * 1024)}
+        os_pread = os.pread
+        try:
+            with open(path, 'wb') as fd:
+                fd.write(payload)
+            del os.pread
+            self.assertEqual(integrity.verify_segment_digests(path, digests, max_workers=4), [])
+        finally:
+            os.pread = os_pread
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_parse_digest(self):
+        digest = hashlib.sha256(b'data').digest()
+        self.assertEqual(integrity.parse_expected_digest('SHA-256:%s' % digest.hex().upper()),
+                         ('sha256', digest.hex()))
+        self.assertEqual(integrity.get_digest_from_headers({'Digest': 'MD5=xxxx, SHA-256=%s'
+                                                            % base64.b64encode(digest).decode()}),
+                         ('sha256', digest.hex()))
+        md5 = hashlib.md5(b'data').digest()
+        self.assertEqual(integrity.get_digest_from_headers({'Content-MD5': base64.b64encode(md5).decode()}),
+                         ('md5', md5.hex()))
+        self.assertIsNone(integrity.get_digest_from_headers({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+测试 性能指标和进度
+"""
+import json
+import os
+import unittest
+
+import requests
+
+import src.file_downloader as file_downloader
+from src.metrics import Metrics, ProgressReporter
+from test.range_http_server import RangeHTTPServer
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot_and_prometheus(self):
+        metrics = Metrics()
+        metrics.inc('retries_total', error='ConnectionError')
+        metrics.inc('retries_total', 2, error='ConnectionError')
+        metrics.set_gauge('speed_bytes_per_second', 10)
+        for value in (0.002, 0.02, 2):
+            metrics.observe('ttfb_seconds', value)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'retries_total{error="ConnectionError"}': 3})
+        histogram = snapshot['histograms']['ttfb_seconds']
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['max'], 2)
+        self.assertEqual(histogram['buckets'][-1], ['+Inf', 3])
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE filedownloader_retries_total counter', text)
+        self.assertIn('filedownloader_retries_total{error="ConnectionError"} 3', text)
+        self.assertIn('filedownloader_ttfb_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('filedownloader_ttfb_seconds_count 3', text)
+
+    def test_progress_reporter(self):
+        samples = [0, 100, 300]
+        reporter = ProgressReporter(1000, lambda: samples[0], interval=60, alpha=0.5)
+        reporter.start()
+        samples.pop(0)
+        reporter._last_time -= 1
+        reporter.report()
+        self.assertAlmostEqual(reporter.speed, 100, delta=5)
+        samples.pop(0)
+        reporter._last_time -= 1
+        reporter.report()
+        self.assertAlmostEqual(reporter.speed, 150, delta=5)
+        self.assertAlmostEqual(reporter.eta(), 700 / reporter.speed, delta=0.1)
+        reporter.stop()
+
+    def test_coordinator_metrics(self):
+        path = 'coordinator.metrics.test.tmp'
+        metrics_path = 'coordinator.metrics.json.test.tmp'
+        payload = os.urandom(100 * 1024)
+        events = []
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                metrics = Metrics()
+                metrics.add_listener(lambda event, fields: events.append(event))
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=10 * 1024,
+                                                                    metrics=metrics,
+                                                                    metrics_file=metrics_path)
+                coordinator.start().result()
+                with open(metrics_path) as fd:
+                    snapshot = json.load(fd)
+                self.assertEqual(snapshot['counters']['bytes_total'], len(payload))
+                self.assertEqual(snapshot['histograms']['ttfb_seconds']['count'], 10)
+                self.assertGreater(snapshot['histograms']['write_latency_seconds']['count'], 0)
+                self.assertEqual(events.count('segment_finish'), 10)
+                self.assertEqual(events.count('segment_start'), 10)
+        finally:
+            for temp_file in (path, metrics_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
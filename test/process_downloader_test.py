@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+多进程下载测试
+"""
+import os
+import unittest
+
+import requests
+
+import src.file_downloader as file_downloader
+import src.process_downloader as process_downloader
+from test.range_http_server import RangeHTTPServer
+
+
+class TestProcessDownloaderCoordinator(unittest.TestCase):
+
+    def test_download(self):
+        """
+        测试 段分给多个子进程 断点记录和连接统计汇总到父进程
+        """
+        path = 'process.test.tmp'
+        breakpoint_path = 'process.breakpoint.test.tmp'
+        payload = os.urandom(256 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = process_downloader.ProcessDownloaderCoordinator(
+                    path, request, {'timeout': 10},
+                    processes=2,
+                    threads_per_process=2,
+                    segment_size=16 * 1024,
+                    finished_segment_file=breakpoint_path,
+                    verify_digest=True)
+                coordinator.start().result()
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+                self.assertEqual(file_downloader.BreakpointFile(breakpoint_path).find_holes(), (len(payload), []))
+                self.assertEqual(coordinator.get_connection_stats()['requests'], 16, 'probe and segments')
+                self.assertEqual(server.request_count, 16)
+        finally:
+            for temp_file in (path, breakpoint_path):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def test_fatal_error_in_worker_process(self):
+        """
+        测试 子进程中的404传回父进程 future抛出HTTPError
+        """
+        path = 'process.fatal.test.tmp'
+        payload = os.urandom(64 * 1024)
+        try:
+            file_downloader.create_empty_fix_size_binary_file(path, len(payload))
+            with RangeHTTPServer(payload, fail_ranges=True, fail_status=404) as server:
+                request = requests.Request(method='GET', url=server.url)
+                coordinator = process_downloader.ProcessDownloaderCoordinator(path, request, {'timeout': 10},
+                                                                              processes=2,
+                                                                              segment_size=8 * 1024)
+                with self.assertRaises(requests.HTTPError) as context:
+                    coordinator.start(True, len(payload), [[0, len(payload) - 1]]).result()
+                self.assertEqual(context.exception.response.status_code, 404)
+                self.assertTrue(coordinator.get_all_failed_segment())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_rebuild_error(self):
+        error = process_downloader.rebuild_error(*process_downloader.describe_error(
+            file_downloader.ResourceChangedException('changed')))
+        self.assertIsInstance(error, file_downloader.ResourceChangedException)
+        error = process_downloader.rebuild_error('UnknownError', 'message')
+        self.assertIsInstance(error, process_downloader.ProcessWorkerException)
+
+
+if __name__ == '__main__':
+    unittest.main()
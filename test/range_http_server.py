@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+测试和基准测试用本地HTTP服务 支持Range和keep-alive
+可以注入网络条件和故障 每个连接带宽上限 往返时延 随机连接重置 随机返回比请求短的区间
+基准测试时在独立进程中运行 数据由seed确定 客户端可以用make_payload生成同样的数据校验下载结果
+
+python -m test.range_http_server --port 8000 --size 64 --bandwidth 10485760 --rtt 0.05 --reset_rate 0.01
+"""
+import argparse
+import http.server
+import random
+import re
+import socket
+import struct
+import threading
+import time
+
+SEND_CHUNK_SIZE = 16 * 1024
+
+
+def make_payload(size, seed=0, block_size=1024 * 1024):
+    """
+    :return: 由seed确定的size字节数据
+    """
+    blocks = []
+    for index in range(0, size, block_size):
+        length = min(block_size, size - index)
+        blocks.append(random.Random(seed + index).getrandbits(length * 8).to_bytes(length, 'little'))
+    return b''.join(blocks)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+        # 模拟建立连接的握手时延
+        if self.server.rtt > 0:
+            time.sleep(self.server.rtt)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def _handle(self, send_body):
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.ranges.append(self.headers.get('Range'))
+        payload = self.server.payload
+        start, end = 0, len(payload) - 1
+        status = 200
+        if self.server.etag and self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            return
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and if_range and if_range != self.server.etag:
+            # 文件已经改变 返回完整响应
+            range_header = None
+        if (range_header and self.server.fail_ranges) or self.server.fail_all:
+            self.send_response(self.server.fail_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        multi_match = re.match(r'bytes=(\d+-\d+(?:,\d+-\d+)+)$', range_header or '')
+        if multi_match and self.server.accept_ranges and self.server.multi_range:
+            self._send_multipart(multi_match.group(1), send_body)
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+        total = '*' if self.server.hide_length else len(payload)
+        if match and self.server.accept_ranges:
+            start = int(match.group(1))
+            if start >= len(payload):
+                self.send_response(416)
+                if not self.server.hide_length:
+                    self.send_header('Content-Range', 'bytes */%s' % len(payload))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            status = 206
+            if end > start and self.server.chance(self.server.short_rate):
+                # 合法但比请求短的区间 客户端需要补充下载剩余部分
+                end = start + (end - start) // 2
+        body = payload[start:end + 1]
+        if self.server.rtt > 0:
+            time.sleep(self.server.rtt)
+        self.send_response(status)
+        if self.server.accept_ranges and self.server.advertise_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, total))
+        if status == 200 and self.server.hide_length:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            if send_body:
+                for index in range(0, len(body), 4096):
+                    chunk = body[index:index + 4096]
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.write(b'0\r\n\r\n')
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        with self.server.lock:
+            truncate = start in self.server.truncate_once_starts
+            self.server.truncate_once_starts.discard(start)
+        if truncate:
+            # 只发送一半数据后断开连接
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        reset_at = int(len(body) * self.server.uniform()) if self.server.chance(self.server.reset_rate) else None
+        if self.server.bandwidth > 0 or reset_at is not None:
+            self._send_paced(body, reset_at)
+        elif start in self.server.slow_range_starts:
+            for index in range(0, len(body), 1024):
+                self.wfile.write(body[index:index + 1024])
+                self.wfile.flush()
+                time.sleep(0.01)
+        else:
+            self.wfile.write(body)
+
+    def _send_paced(self, body, reset_at):
+        """按带宽上限发送 到达reset_at时重置连接"""
+        bandwidth = self.server.bandwidth
+        begin = time.monotonic()
+        offset = 0
+        while offset < len(body):
+            chunk_end = min(len(body), offset + SEND_CHUNK_SIZE)
+            if reset_at is not None and chunk_end > reset_at:
+                self.wfile.write(body[offset:reset_at])
+                self._reset()
+                return
+            self.wfile.write(body[offset:chunk_end])
+            offset = chunk_end
+            if bandwidth > 0:
+                delay = begin + offset / bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _reset(self):
+        """SO_LINGER为0时关闭连接发送RST"""
+        self.close_connection = True
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def _send_multipart(self, ranges, send_body):
+        payload = self.server.payload
+        boundary = 'TEST_BOUNDARY'
+        body = b''
+        for item in ranges.split(','):
+            start, end = (int(value) for value in item.split('-'))
+            end = min(end, len(payload) - 1)
+            body += ('\r\n--%s\r\nContent-Type: application/octet-stream\r\n'
+                     'Content-Range: bytes %s-%s/%s\r\n\r\n' % (boundary, start, end, len(payload))).encode()
+            body += payload[start:end + 1]
+        body += ('\r\n--%s--\r\n' % boundary).encode()
+        self.send_response(206)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class RangeHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    payload: 服务的数据
+    accept_ranges: 是否支持Range请求
+    slow_range_starts: 从这些位置开始的Range请求慢速返回(每10ms 1KB)
+    multi_range: 是否支持multi-range请求 不支持时返回200完整响应
+    fail_ranges: Range请求都返回fail_status
+    fail_status: fail_ranges或fail_all时返回的状态码
+    fail_all: 所有请求都返回fail_status
+    truncate_once_starts: 从这些位置开始的Range请求第一次只返回一半数据就断开连接
+    etag: 响应的ETag If-Range不匹配时返回200完整响应 If-None-Match匹配时返回304
+    advertise_ranges: 是否返回Accept-Ranges头 为False时仍然支持Range
+    hide_length: 不返回总长度 Content-Range为bytes start-end/* 416不带总长度 200响应用chunked编码
+    port: 监听端口 0为随机端口
+    bandwidth: 每个连接每秒字节数 0不限制
+    rtt: 建立连接和每个请求的时延(秒)
+    reset_rate: 每个响应在响应体中途重置连接的概率
+    short_rate: 每个Range请求只返回前一半区间的概率
+    seed: 故障注入的随机数种子
+    """
+    daemon_threads = True
+
+    def __init__(self, payload, accept_ranges=True, slow_range_starts=(), multi_range=True, fail_ranges=False,
+                 fail_status=503, truncate_once_starts=(), etag=None, advertise_ranges=True, hide_length=False,
+                 port=0, bandwidth=0, rtt=0.0, reset_rate=0.0, short_rate=0.0, seed=0, fail_all=False):
+        super().__init__(('127.0.0.1', port), RangeRequestHandler)
+        self.payload = payload
+        self.accept_ranges = accept_ranges
+        self.slow_range_starts = set(slow_range_starts)
+        self.multi_range = multi_range
+        self.fail_ranges = fail_ranges
+        self.fail_status = fail_status
+        self.fail_all = fail_all
+        self.truncate_once_starts = set(truncate_once_starts)
+        self.etag = etag
+        self.advertise_ranges = advertise_ranges
+        self.hide_length = hide_length
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.reset_rate = reset_rate
+        self.short_rate = short_rate
+        self._random = random.Random(seed)
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.connection_count = 0
+        self.request_count = 0
+        self._thread = None
+
+    def chance(self, rate):
+        return rate > 0 and self.uniform() < rate
+
+    def uniform(self):
+        with self.lock:
+            return self._random.random()
+
+    def handle_error(self, request, client_address):
+        # 客户端主动断开连接和注入的连接重置属于正常情况
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/file' % self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, required=True, help='listen port')
+    parser.add_argument('--size', type=int, default=64, help='payload size in MB')
+    parser.add_argument('--seed', type=int, default=0, help='payload and fault seed')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second per connection, 0 is unlimited')
+    parser.add_argument('--rtt', type=float, default=0.0, help='delay in seconds per connection and request')
+    parser.add_argument('--reset_rate', type=float, default=0.0, help='probability to reset a response')
+    parser.add_argument('--short_rate', type=float, default=0.0, help='probability to send half of the range')
+    parser.add_argument('--no_accept_ranges', default=False, action='store_true',
+                        help='do not send Accept-Ranges header')
+    args = parser.parse_args()
+    payload = make_payload(args.size * 1024 * 1024, args.seed)
+    server = RangeHTTPServer(payload,
+                             advertise_ranges=not args.no_accept_ranges,
+                             port=args.port,
+                             bandwidth=args.bandwidth,
+                             rtt=args.rtt,
+                             reset_rate=args.reset_rate,
+                             short_rate=args.short_rate,
+                             seed=args.seed)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
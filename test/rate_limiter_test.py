@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+测试 带宽限速
+"""
+import os
+import threading
+import time
+import unittest
+
+import requests
+
+import src.file_downloader as file_downloader
+from src.rate_limiter import RateLimiter, TokenBucket
+from test.range_http_server import RangeHTTPServer
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(0)
+        self.assertEqual(bucket.reserve(10 * 1024 * 1024), 0, 'unlimited')
+        bucket.set_rate(1024 * 1024, burst=64 * 1024)
+        self.assertEqual(bucket.reserve(64 * 1024), 0, 'burst')
+        self.assertAlmostEqual(bucket.reserve(512 * 1024), 0.5, delta=0.05)
+        # 调整速率后欠账按新速率偿还
+        bucket.set_rate(4 * 1024 * 1024, burst=64 * 1024)
+        self.assertAlmostEqual(bucket.reserve(0), 0.125, delta=0.05)
+
+    def test_shared_limiter(self):
+        limiter = RateLimiter(rate=1024 * 1024)
+        start = time.monotonic()
+
+        def consume():
+            for _ in range(16):
+                limiter.consume('a', 16 * 1024)
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 共1MB 其中64KB由初始令牌覆盖
+        self.assertGreater(time.monotonic() - start, 0.8)
+        limiter = RateLimiter(per_host_rate=1024 * 1024)
+        limiter.set_host_rate('b', 0)
+        self.assertEqual(limiter.reserve('b', 10 * 1024 * 1024), 0, 'host b is unlimited')
+        self.assertGreater(limiter.reserve('a', 2 * 1024 * 1024), 1)
+
+    def test_coordinator_rate_limit(self):
+        path = 'coordinator.rate.test.tmp'
+        payload = os.urandom(512 * 1024)
+        try:
+            with RangeHTTPServer(payload) as server:
+                request = requests.Request(method='GET', url=server.url)
+                limiter = RateLimiter(rate=1024 * 1024)
+                coordinator = file_downloader.DownloaderCoordinator(path, request, {'timeout': 10},
+                                                                    segment_size=64 * 1024,
+                                                                    rate_limiter=limiter)
+                start = time.monotonic()
+                coordinator.start().result()
+                self.assertGreater(time.monotonic() - start, 0.35)
+                with open(path, 'rb') as fd:
+                    self.assertEqual(fd.read(), payload, 'file content')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+有序流式下载测试
+"""
+import io
+import os
+import unittest
+
+import requests
+
+import src.file_downloader as file_downloader
+import src.stream_downloader as stream_downloader
+from test.range_http_server import RangeHTTPServer
+
+
+class _WindowRecordingDownloader(stream_downloader.OrderedStreamDownloader):
+    """记录重排缓冲区中同时存在的最大段数"""
+    max_buffered = 0
+
+    def _next_segment(self):
+        index = super()._next_segment()
+        with self._cond:
+            self.max_buffered = max(self.max_buffered, len(self._buffers))
+        return index
+
+
+class TestOrderedStreamDownloader(unittest.TestCase):
+
+    def setUp(self):
+        file_downloader.be_quiet()
+
+    def test_iter_content_in_order(self):
+        """
+        测试 第一段慢速返回时 后面的段先完成 输出仍然按顺序 缓冲区不超过窗口
+        """
+        payload = os.urandom(128 * 1024)
+        with RangeHTTPServer(payload, slow_range_starts=(0,)) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = _WindowRecordingDownloader(request, {'timeout': 10}, max_thread=4,
+                                                    segment_size=16 * 1024, max_buffer_size=48 * 1024)
+            self.assertEqual(b''.join(downloader.iter_content()), payload)
+            self.assertEqual(downloader.data_length, len(payload))
+            self.assertLessEqual(downloader.max_buffered, 3, 'window is 3 segments')
+            self.assertEqual(server.request_count, 8, 'probe is the first segment')
+            self.assertEqual(server.ranges[0], 'bytes=0-16383')
+
+    def test_copy_to_and_open(self):
+        """
+        测试 写入文件对象 以及作为只读文件对象读取
+        """
+        payload = os.urandom(100 * 1024 + 7)
+        with RangeHTTPServer(payload) as server:
+            request = requests.Request(method='GET', url=server.url)
+            output = io.BytesIO()
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, segment_size=16 * 1024)
+            self.assertEqual(downloader.copy_to(output), len(payload))
+            self.assertEqual(output.getvalue(), payload)
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, segment_size=16 * 1024)
+            with downloader.open() as fileobj:
+                self.assertEqual(fileobj.read(10), payload[:10])
+                self.assertEqual(fileobj.read(), payload[10:])
+
+    def test_without_range_support(self):
+        """
+        测试 服务端不支持Range时 探测响应就是完整数据 只有一个请求
+        """
+        payload = os.urandom(64 * 1024)
+        with RangeHTTPServer(payload, accept_ranges=False) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, segment_size=16 * 1024)
+            self.assertEqual(b''.join(downloader.iter_content()), payload)
+            self.assertEqual(server.request_count, 1)
+
+    def test_unknown_length(self):
+        """
+        测试 Content-Range没有总长度时 确定长度后仍然并行下载
+        """
+        payload = os.urandom(64 * 1024 + 5)
+        with RangeHTTPServer(payload, hide_length=True) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, segment_size=16 * 1024)
+            self.assertEqual(b''.join(downloader.iter_content()), payload)
+            self.assertEqual(downloader.data_length, len(payload))
+            self.assertIn('bytes=16384-32767', server.ranges)
+
+    def test_resume_truncated_segment(self):
+        """
+        测试 段中途断开后 从已经收到的位置继续 已经输出的数据不重复
+        """
+        payload = os.urandom(64 * 1024)
+        with RangeHTTPServer(payload, truncate_once_starts=(16 * 1024,)) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = stream_downloader.OrderedStreamDownloader(
+                request, {'timeout': 10}, segment_size=16 * 1024,
+                retry_policy=file_downloader.RetryPolicy(base_delay=0.01))
+            self.assertEqual(b''.join(downloader.iter_content()), payload)
+            self.assertIn('bytes=24576-32767', server.ranges)
+
+    def test_fatal_error(self):
+        """
+        测试 段返回404时迭代抛出HTTPError 窗口为1段 读取第一段时第二段还没有请求
+        """
+        payload = os.urandom(64 * 1024)
+        with RangeHTTPServer(payload) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, segment_size=16 * 1024,
+                                                                   max_buffer_size=16 * 1024)
+            chunks = downloader.iter_content()
+            next(chunks)
+            server.fail_ranges = True
+            server.fail_status = 404
+            with self.assertRaises(requests.HTTPError):
+                for _ in chunks:
+                    pass
+
+    def test_close_early(self):
+        """
+        测试 提前结束迭代后停止领取新的段
+        """
+        payload = os.urandom(256 * 1024)
+        with RangeHTTPServer(payload) as server:
+            request = requests.Request(method='GET', url=server.url)
+            downloader = stream_downloader.OrderedStreamDownloader(request, {'timeout': 10}, max_thread=2,
+                                                                   segment_size=16 * 1024,
+                                                                   max_buffer_size=32 * 1024)
+            chunks = downloader.iter_content()
+            chunk = next(chunks)
+            self.assertEqual(chunk, payload[:len(chunk)])
+            chunks.close()
+            self.assertLessEqual(downloader._next_index, 2, 'only segments in window are requested')
+            self.assertIsNone(downloader._next_segment())